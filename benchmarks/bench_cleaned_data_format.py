@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cleaned_data_io import read_cleaned_data, write_parquet
+
+# Column lists of the tables the loaders build from the cleaned data
+TABLE_COLUMNS = {
+    "patient_demographics": ['patient_id', 'age', 'age_group', 'gender', 'patient_demographics_other_fields'],
+    "patient_visits": ['patient_id', 'visit_id', 'visit_date', 'visit_frequency', 'diagnosis', 'medication', 'patients_visits_other_fields'],
+    "patient_lab_results": ['patient_id', 'visit_id', 'lab_test_id', 'test_date', 'test_name', 'result_value', 'result_unit', 'reference_range', 'patient_lab_results_notes'],
+    "patient_medications": ['patient_id', 'medication_id', 'visit_id', 'medication', 'dosage_mg', 'start_date', 'end_date', 'patient_medications_notes'],
+    "physician_assignments": ['patient_id', 'visit_id', 'physician_id', 'physician_name', 'assignment_date', 'department']
+}
+
+# Scale data/cleaned_data.csv up to about "rows" rows, making IDs unique per copy
+def make_cleaned_data(rows):
+    sample = pd.read_csv(os.path.join("data", "cleaned_data.csv"))
+    copies = max(1, rows // len(sample))
+    frames = []
+    for copy in range(copies):
+        frame = sample.copy()
+        for column in ["patient_id", "visit_id", "lab_test_id", "medication_id", "physician_id"]:
+            frame[column] = frame[column].astype(str) + f"_{copy}"
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+# Return the seconds taken by a call
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the CSV and Parquet formats for data/cleaned_data.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    df = make_cleaned_data(args.rows)
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "cleaned_data.csv")
+        parquet_path = os.path.join(directory, "cleaned_data.parquet")
+        missing_path = os.path.join(directory, "missing.parquet")
+
+        csv_write = timed(df.to_csv, csv_path, index=False)
+        parquet_write = timed(write_parquet, df, parquet_path)
+        print(f"{len(df):,} rows")
+        print(f"{'':<28} {'CSV':>12} {'Parquet':>12}")
+        print(f"{'write seconds':<28} {csv_write:>12.3f} {parquet_write:>12.3f}")
+        print(f"{'size MB':<28} {os.path.getsize(csv_path) / 1024 ** 2:>12.1f} {os.path.getsize(parquet_path) / 1024 ** 2:>12.1f}")
+        # The CSV path used to parse the whole file once per script; projection makes that cost per table instead
+        print(f"{'read all seconds':<28} {timed(pd.read_csv, csv_path):>12.3f} {timed(pd.read_parquet, parquet_path):>12.3f}")
+        for table, columns in TABLE_COLUMNS.items():
+            csv_read = timed(read_cleaned_data, columns, parquet_path=missing_path, csv_path=csv_path)
+            parquet_read = timed(read_cleaned_data, columns, parquet_path=parquet_path)
+            print(f"{'read ' + table:<28} {csv_read:>12.3f} {parquet_read:>12.3f}")
+
+if __name__ == "__main__":
+    main()
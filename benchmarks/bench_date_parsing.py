@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from date_parsing import parse_dates
+
+# Build a date column the way the source files hold one: ISO dates over "days" days, with some missing and invalid
+def make_dates(rows, days, seed=42):
+    rng = np.random.default_rng(seed)
+    dates = (np.datetime64("2022-01-01") + rng.integers(0, days, rows).astype("timedelta64[D]")).astype(str).astype(object)
+    dates[rng.random(rows) < 0.02] = None
+    dates[rng.random(rows) < 0.001] = "not a date"
+    return pd.Series(dates, name="visit_date")
+
+# The previous date step of clean_data: infer the format, parse every row, format back to text
+def parse_and_format(series):
+    return pd.to_datetime(series, errors="coerce").dt.strftime("%Y-%m-%d")
+
+# Time a function on a fresh copy of the column
+def timed(func, series):
+    series = series.copy()
+    start = time.perf_counter()
+    func(series)
+    return time.perf_counter() - start
+
+# Compare the previous date step with parse_dates on text and on categorical columns (as load_data reads them)
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the date parsing of clean_data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--days", type=int, default=730, help="Distinct dates in the column")
+    args = parser.parse_args()
+
+    print(f"{'rows':>12} {'infer+strftime':>15} {'parse_dates':>12} {'categorical':>12} {'speedup':>8}")
+    for rows in args.sizes:
+        dates = make_dates(rows, args.days)
+        before = timed(parse_and_format, dates)
+        after = timed(parse_dates, dates)
+        categorical = timed(parse_dates, dates.astype("category"))
+        print(f"{rows:>12,} {before:>15.3f} {after:>12.3f} {categorical:>12.3f} {before / after:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import etl_pipeline
+from bulk_load import DEFAULT_BATCH_SIZE, append_table, drop_duplicate_keys
+from deferred_load import BUILD_WORKERS, finish_deferred_load, prepare_deferred_load
+from synthetic_data import generate_dataset, patients_for_rows
+
+# Schema the tables are created from
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql", "schema.sql")
+
+# Tables in load order with their primary keys (as in load_to_postgresdb)
+TABLES = {
+    "patient_demographics": ["patient_id"],
+    "patient_visits": ["visit_id"],
+    "patient_lab_results": ["lab_test_id"],
+    "patient_medications": ["medication_id"],
+    "physician_assignments": ["patient_id", "visit_id", "physician_id"],
+}
+
+# Variants compared: keys, constraints and indexes kept during the load, built after it, and built after an UNLOGGED load
+VARIANTS = {
+    "immediate": {"defer": False, "unlogged": False},
+    "deferred": {"defer": True, "unlogged": False},
+    "deferred_unlogged": {"defer": True, "unlogged": True},
+}
+
+# Build the five loader tables from a synthetic dataset, cleaned like the pipeline does. Rows that would break a
+# key or foreign key are removed, so every variant loads the same rows and none of them fails half way.
+def make_tables(rows):
+    tables = etl_pipeline.build_tables(dict(etl_pipeline.clean_data(generate_dataset(patients_for_rows(rows)))))
+    tables = {name: drop_duplicate_keys(tables[name].dropna(subset=keys), name, keys) for name, keys in TABLES.items()}
+    patients = set(tables["patient_demographics"]["patient_id"])
+    visits = set(tables["patient_visits"]["visit_id"])
+    for name, table in tables.items():
+        keep = table["patient_id"].isin(patients)
+        if name != "patient_visits" and "visit_id" in table:
+            keep &= table["visit_id"].isin(visits)
+        tables[name] = table[keep]
+    return tables
+
+# Load the tables one variant at a time and return the seconds of each phase
+def run_variant(engine, tables, defer, unlogged, workers, batch_size):
+    phases = {}
+    start = time.perf_counter()
+    objects = prepare_deferred_load(engine, list(tables), SCHEMA_PATH, defer=defer, unlogged=unlogged)
+    phases["prepare_tables"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for name, table in tables.items():
+        append_table(table, name, engine, batch_size=batch_size)
+    phases["load"] = time.perf_counter() - start
+    finished, failures = finish_deferred_load(engine, list(tables), objects, unlogged=unlogged, workers=workers)
+    phases.update(finished)
+    for failure in failures:
+        print(f"Could not restore {failure['object']}: {failure['error']}")
+    return phases
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare loading with keys, constraints and indexes in place against building them after the load.")
+    parser.add_argument("--url", default=os.getenv("BENCH_POSTGRES_URL"), help="SQLAlchemy URL of a scratch database (or BENCH_POSTGRES_URL)")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Synthetic source rows over all five source tables")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=BUILD_WORKERS, help="Connections that build indexes and validate constraints")
+    parser.add_argument("--schema", default="bench_deferred_load", help="Scratch schema the tables are created in")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("--url or BENCH_POSTGRES_URL is required")
+
+    with create_engine(args.url).begin() as connection:
+        connection.exec_driver_sql(f'CREATE SCHEMA IF NOT EXISTS "{args.schema}"')
+    engine = create_engine(args.url, connect_args={"options": f"-csearch_path={args.schema}"})
+    tables = make_tables(args.rows)
+    print(f"Loading {sum(len(table) for table in tables.values()):,} rows into {len(tables)} tables")
+
+    results = {name: run_variant(engine, tables, workers=args.workers, batch_size=args.batch_size, **options)
+               for name, options in VARIANTS.items()}
+    phases = list(dict.fromkeys(phase for result in reversed(list(results.values())) for phase in result))
+    print(f"{'phase':<22}" + "".join(f" {name:>18}" for name in results))
+    for phase in phases + ["total"]:
+        row = [sum(result.values()) if phase == "total" else result.get(phase) for result in results.values()]
+        print(f"{phase:<22}" + "".join(f" {'-' if seconds is None else f'{seconds:.2f}':>18}" for seconds in row))
+
+if __name__ == "__main__":
+    main()
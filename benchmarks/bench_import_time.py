@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Repository root: the modules are imported from there, as the scripts run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules whose import cost is measured
+DEFAULT_MODULES = ["etl_pipeline", "load_to_postgresdb", "load_to_supabasedb", "python_integration"]
+
+# Libraries that should only be imported when they are used (plotting, database drivers)
+HEAVY_MODULES = ["matplotlib", "seaborn", "matplotlib_venn", "psycopg2"]
+
+# Parse the stderr of `python -X importtime` into (depth, module, self µs, cumulative µs) per imported module
+def parse_importtime(output):
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        imports.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+# Import one module in a fresh interpreter under -X importtime.
+# Returns the module's cumulative import time in seconds, its slowest direct imports and the heavy libraries it pulled in.
+def measure_import(module, env):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    imports = parse_importtime(result.stderr)
+    total = next((cumulative for depth, name, _, cumulative in imports if depth == 0 and name == module), None)
+    direct = sorted(((name, cumulative) for depth, name, _, cumulative in imports if depth == 1), key=lambda item: -item[1])
+    loaded = sorted({name.split(".")[0] for _, name, _, _ in imports} & set(HEAVY_MODULES))
+    error = result.stderr.strip().splitlines()[-1] if result.returncode != 0 else None
+    return {"seconds": total / 1e6 if total is not None else None, "slowest_imports": direct[:5],
+            "heavy_modules": loaded, "error": error}
+
+# Measure the import cost of each module, taking the median of several fresh interpreters
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import cost of the pipeline modules with python -X importtime.")
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per module; the median is reported")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    # The database settings are left out, so importing a module must not need them
+    env = {key: value for key, value in os.environ.items() if not key.startswith(("POSTGRES_", "SUPABASE_"))}
+    results = {}
+    print(f"{'module':<22} {'import s':>9} {'heavy modules':<28} slowest direct imports")
+    for module in args.modules:
+        runs = [measure_import(module, env) for _ in range(args.repeat)]
+        seconds = [run["seconds"] for run in runs if run["seconds"] is not None]
+        last = runs[-1]
+        results[module] = {"median_seconds": statistics.median(seconds) if seconds else None, **last}
+        if last["error"]:
+            print(f"{module:<22} {'failed':>9} {last['error']}")
+            continue
+        slowest = ", ".join(f"{name} {cumulative / 1e3:.0f}ms" for name, cumulative in last["slowest_imports"][:3])
+        print(f"{module:<22} {results[module]['median_seconds']:>9.3f} {', '.join(last['heavy_modules']) or '-':<28} {slowest}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from etl_pipeline import apply_lab_rules
+
+# Lab tests used to build the synthetic frame: (test_name, unit, reference_range, mean, std)
+LAB_TESTS = [
+    ("Blood Glucose", "mg/dL", "70-110", 95, 20),
+    ("Cholesterol", "mg/dL", "125-200", 180, 30),
+    ("Hemoglobin", "g/dL", "12-16", 14, 2),
+]
+
+# Build a synthetic patient_lab_results frame with the same columns as data/patient_lab_results.csv
+def make_lab_results(rows, seed=42):
+    rng = np.random.default_rng(seed)
+    test_index = rng.integers(0, len(LAB_TESTS), rows)
+    names, units, ranges, means, stds = (np.array(column, dtype=object) for column in zip(*LAB_TESTS))
+    values = rng.normal(means[test_index].astype(float), stds[test_index].astype(float)).round(1)
+    values[rng.random(rows) < 0.05] = np.nan
+    notes = np.where(rng.random(rows) < 0.5, None, "Reviewed")
+    return pd.DataFrame({
+        "patient_id": [f"P{i % 100000:06d}" for i in range(rows)],
+        "lab_test_id": [f"L{i:08d}" for i in range(rows)],
+        "result_value": values,
+        "result_unit": units[test_index],
+        "reference_range": ranges[test_index],
+        "notes": notes,
+    })
+
+# Time apply_lab_rules at each size and report how the cost grows relative to the smallest size
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized lab result rules.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 10_000_000])
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'rows':>12} {'seconds':>10} {'rows/sec':>14} {'time ratio':>11} {'size ratio':>11}")
+    for rows in args.sizes:
+        df = make_lab_results(rows)
+        start = time.perf_counter()
+        apply_lab_rules(df)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = (rows, elapsed)
+        print(f"{rows:>12,} {elapsed:>10.3f} {rows / elapsed:>14,.0f} "
+              f"{elapsed / baseline[1]:>11.1f} {rows / baseline[0]:>11.1f}")
+
+if __name__ == "__main__":
+    main()
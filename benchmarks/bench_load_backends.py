@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Date, Float, String, create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bulk_load import DEFAULT_BATCH_SIZE, LOAD_BACKENDS, replace_table
+
+lab_results_dtype = {
+    "patient_id": String(10),
+    "visit_id": String(50),
+    "lab_test_id": String(50),
+    "test_date": Date(),
+    "test_name": String(255),
+    "result_value": Float(),
+    "result_unit": String(50),
+    "reference_range": String(50),
+    "patient_lab_results_notes": String(255)
+}
+
+# Build a patient_lab_results table shaped like the cleaned output
+def make_lab_results(rows, seed=42):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "patient_id": [f"P{i % 10000:05d}" for i in range(rows)],
+        "visit_id": [f"V{i % 50000:06d}" for i in range(rows)],
+        "lab_test_id": [f"L{i:08d}" for i in range(rows)],
+        "test_date": pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 365, rows), unit="D"),
+        "test_name": rng.choice(["BLOOD GLUCOSE", "CHOLESTEROL", "HEMOGLOBIN"], rows),
+        "result_value": rng.normal(100, 20, rows).round(1),
+        "result_unit": "MG/DL",
+        "reference_range": rng.choice(["70-110", "125-200", "12000-16000"], rows),
+        "patient_lab_results_notes": rng.choice(["NORMAL", "LOW", "HIGH", "UNKNOWN"], rows)
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare load backends against a PostgreSQL database.")
+    parser.add_argument("--url", default=os.getenv("BENCH_POSTGRES_URL"), help="SQLAlchemy URL of a scratch database (or BENCH_POSTGRES_URL)")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("--url or BENCH_POSTGRES_URL is required")
+
+    engine = create_engine(args.url)
+    data = make_lab_results(args.rows)
+    print(f"{'backend':<10} {'rows/sec':>12}")
+    for backend in LOAD_BACKENDS:
+        rows_per_second = replace_table(data, "bench_patient_lab_results", engine, lab_results_dtype,
+                                        backend=backend, batch_size=args.batch_size)
+        print(f"{backend:<10} {rows_per_second:>12,.0f}")
+
+if __name__ == "__main__":
+    main()
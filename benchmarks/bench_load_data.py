@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import etl_pipeline
+
+# Write copies of the sample source files scaled up to roughly "rows" rows each, with IDs made unique per copy
+def write_scaled_sources(directory, rows):
+    for key, filename in etl_pipeline.files.items():
+        sample = pd.read_csv(os.path.join("data", filename), dtype=str)
+        copies = max(1, rows // len(sample))
+        frames = []
+        for copy in range(copies):
+            frame = sample.copy()
+            for column in frame.columns:
+                if column.endswith("_id"):
+                    frame[column] = frame[column] + f"_{copy}"
+            frames.append(frame)
+        pd.concat(frames).to_csv(os.path.join(directory, filename), index=False)
+
+# Previous behaviour: read every file one after another and let pandas guess the dtypes
+def load_data_sequential():
+    return {key: pd.read_csv(os.path.join(etl_pipeline.base_path, filename)) for key, filename in etl_pipeline.files.items()}
+
+# Time a loader and clean_data on what it returns (the best of "repeat" runs of each), and report the total
+# in-memory size of the loaded frames, strings included
+def measure(loader, repeat):
+    load_times, clean_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = loader()
+        load_times.append(time.perf_counter() - start)
+        memory = sum(df.memory_usage(deep=True).sum() for df in data.values())
+        start = time.perf_counter()
+        etl_pipeline.clean_data(data)
+        clean_times.append(time.perf_counter() - start)
+    return min(load_times), min(clean_times), memory
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sequential inferred-dtype loading with parallel schema loading.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Approximate rows per source file")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per loader; the best time is reported")
+    args = parser.parse_args()
+
+    loaders = [("sequential, inferred", load_data_sequential),
+               ("schemas, pandas", lambda: etl_pipeline.load_data(engine="pandas")),
+               ("schemas, arrow", lambda: etl_pipeline.load_data(engine="arrow"))]
+    with tempfile.TemporaryDirectory() as directory:
+        write_scaled_sources(directory, args.rows)
+        etl_pipeline.base_path = directory
+        print(f"{'loader':<22} {'load s':>10} {'clean s':>10} {'total s':>10} {'memory MB':>12}")
+        for name, loader in loaders:
+            elapsed, cleaning, memory = measure(loader, args.repeat)
+            print(f"{name:<22} {elapsed:>10.3f} {cleaning:>10.3f} {elapsed + cleaning:>10.3f} {memory / 1024 ** 2:>12.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pyarrow as pa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import etl_pipeline
+from csv_engines import PARSE_ENGINES
+from synthetic_data import generate_dataset, patients_for_rows, write_dataset
+
+# Columns read by the projected runs
+PROJECTED_COLUMNS = ["patient_id", "lab_test_id", "result_value"]
+
+# Time one read of a source file; returns the seconds taken
+def timed_read(key, engine, columns):
+    start = time.perf_counter()
+    etl_pipeline.read_source_file(key, engine, columns)
+    return time.perf_counter() - start
+
+# Parse one synthetic source file with every engine, with all columns and with a projection, at each thread count.
+# Each read is repeated and the best time kept, so the file is in the page cache for every engine.
+def main():
+    parser = argparse.ArgumentParser(description="Compare the parse throughput of the CSV parse engines.")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="Synthetic source rows over all five files")
+    parser.add_argument("--table", default="patient_lab_results", choices=list(etl_pipeline.files))
+    parser.add_argument("--threads", type=int, nargs="+", default=[os.cpu_count() or 1], help="Arrow thread counts to try")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_parse_")
+    try:
+        write_dataset(generate_dataset(patients_for_rows(args.rows)), directory)
+        etl_pipeline.base_path = directory
+        path = os.path.join(directory, etl_pipeline.files[args.table])
+        megabytes = os.path.getsize(path) / 1024 ** 2
+        rows = sum(1 for _ in open(path)) - 1
+        print(f"{args.table}: {rows:,} rows, {megabytes:,.0f} MB")
+
+        print(f"{'engine':<8} {'threads':>7} {'columns':>9} {'seconds':>9} {'MB/sec':>9} {'rows/sec':>12}")
+        for engine in PARSE_ENGINES:
+            for threads in (args.threads if engine == "arrow" else [1]):
+                pa.set_cpu_count(threads)
+                for label, columns in (("all", None), ("projected", PROJECTED_COLUMNS)):
+                    seconds = min(timed_read(args.table, engine, columns) for _ in range(args.repeat))
+                    print(f"{engine:<8} {threads:>7} {label:>9} {seconds:>9.2f} {megabytes / seconds:>9.1f} {rows / seconds:>12,.0f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_load_backends import lab_results_dtype, make_lab_results
+from bulk_load import replace_table
+from table_migration import DEFAULT_MIGRATION_BATCH_SIZE, migrate_table_partitioned
+
+# Migrate a synthetic patient_lab_results table into a scratch schema with 1, 2, 4... partitions
+# and report how the throughput scales with the number of parallel streams
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark partition-parallel extraction against a PostgreSQL database.")
+    parser.add_argument("--url", default=os.getenv("BENCH_POSTGRES_URL"), help="SQLAlchemy URL of a scratch database (or BENCH_POSTGRES_URL)")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_MIGRATION_BATCH_SIZE)
+    parser.add_argument("--partition-column", default="lab_test_id", help="Column the table is split on (e.g. test_date)")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("--url or BENCH_POSTGRES_URL is required")
+
+    engine = create_engine(args.url, pool_size=max(args.workers) * 2)
+    replace_table(make_lab_results(args.rows), "bench_partitioned_lab_results", engine, lab_results_dtype)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE bench_partitioned_lab_results ADD PRIMARY KEY (lab_test_id)')
+        connection.exec_driver_sql("CREATE SCHEMA IF NOT EXISTS bench_migration")
+
+    baseline = None
+    print(f"{'workers':>8} {'seconds':>10} {'rows/sec':>14} {'speedup':>8}")
+    for workers in args.workers:
+        start = time.perf_counter()
+        rows = migrate_table_partitioned("bench_partitioned_lab_results", engine, engine, ["lab_test_id"], "bench_migration",
+                                         partitions=workers, partition_column=args.partition_column, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"{workers:>8} {elapsed:>10.2f} {rows / elapsed:>14,.0f} {baseline / elapsed:>8.2f}")
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP SCHEMA bench_migration CASCADE")
+        connection.exec_driver_sql("DROP TABLE bench_partitioned_lab_results")
+
+if __name__ == "__main__":
+    main()
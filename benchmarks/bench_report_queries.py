@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine, inspect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from report_queries import PATIENTS_BY_DIAGNOSIS_OR_VISIT_DATE_SQL, REPORT_INDEXES, ensure_report_indexes, execute_prepared
+
+# Scratch schema the benchmark's patient_visits is created in
+SCHEMA = "bench_reports"
+
+# The report query as it was: values formatted into the SQL text, one OR predicate
+OR_QUERY = """
+    SELECT patient_id, diagnosis, visit_date
+    FROM patient_visits
+    WHERE diagnosis = '{diagnosis}'
+    OR (visit_date BETWEEN '{start_date}' AND '{end_date}')
+"""
+
+# The OR split into two branches, one per index; the second leaves out the rows of the first,
+# so UNION ALL returns each matching visit once
+UNION_ALL_QUERY = """
+    SELECT patient_id, diagnosis, visit_date
+    FROM patient_visits
+    WHERE diagnosis = :diagnosis
+    UNION ALL
+    SELECT patient_id, diagnosis, visit_date
+    FROM patient_visits
+    WHERE visit_date BETWEEN :start_date AND :end_date
+    AND diagnosis IS DISTINCT FROM :diagnosis
+"""
+
+# Build patient_visits in the scratch schema: five visits per patient, "diagnoses" distinct diagnoses
+# (DEPRESSION is one of them) and visit dates spread over "years" years from 2015
+def create_visits(engine, rows, diagnoses, years):
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE IF EXISTS patient_visits")
+        connection.exec_driver_sql(f"""
+            CREATE TABLE patient_visits AS
+            SELECT 'P' || lpad(mod(g, {max(rows // 5, 1)})::text, 8, '0') AS patient_id,
+                   'V' || lpad(g::text, 9, '0') AS visit_id,
+                   DATE '2015-01-01' + mod(g * 7919, {years * 365})::int AS visit_date,
+                   CASE WHEN mod(g * 31, {diagnoses}) = 0 THEN 'DEPRESSION' ELSE 'DIAGNOSIS_' || mod(g * 31, {diagnoses}) END AS diagnosis
+            FROM generate_series(1::bigint, {rows}) AS g
+        """)
+        connection.exec_driver_sql("ALTER TABLE patient_visits ADD PRIMARY KEY (visit_id)")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("VACUUM ANALYZE patient_visits")
+
+# Drop the report indexes, to measure the query as it runs on a table created by a replace load
+def drop_report_indexes(engine):
+    with engine.begin() as connection:
+        for index_name in REPORT_INDEXES:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index_name}")
+
+# Plan tree as one line: node types (with the index they use) and their children in brackets
+def plan_shape(node):
+    name = node["Node Type"] + (f" {node['Index Name']}" if "Index Name" in node else "")
+    children = [plan_shape(child) for child in node.get("Plans", [])]
+    return f"{name} [{', '.join(children)}]" if children else name
+
+# EXPLAIN ANALYZE a statement: returns the plan's shape, planning and execution milliseconds
+def explain(connection, statement, params=()):
+    plan = connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", params).scalar()
+    plan = plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+    return plan_shape(plan["Plan"]), plan["Planning Time"], plan["Execution Time"]
+
+# Median seconds of running "run" (which fetches the result into a DataFrame) "repeat" times, and the rows it returned
+def time_runs(run, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = run()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds), len(df)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the plans and latency of the patients-by-diagnosis-or-visit-date report query.")
+    parser.add_argument("--url", default=os.getenv("BENCH_POSTGRES_URL"), help="SQLAlchemy URL of a scratch database (or BENCH_POSTGRES_URL)")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="Visits in the benchmark table")
+    parser.add_argument("--diagnoses", type=int, default=50, help="Distinct diagnoses")
+    parser.add_argument("--years", type=int, default=10, help="Years the visit dates are spread over")
+    parser.add_argument("--diagnosis", default="DEPRESSION")
+    parser.add_argument("--start-date", default="2023-01-01")
+    parser.add_argument("--end-date", default="2023-01-31")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per variant; the median is reported")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark table after the run, and reuse a kept one")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("--url or BENCH_POSTGRES_URL is required")
+
+    admin = create_engine(args.url)
+    with admin.begin() as connection:
+        connection.exec_driver_sql(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}")
+    engine = create_engine(args.url, connect_args={"options": f"-csearch_path={SCHEMA}"})
+    if not (args.keep and inspect(engine).has_table("patient_visits")):
+        start = time.perf_counter()
+        create_visits(engine, args.rows, args.diagnoses, args.years)
+        print(f"Created {args.rows:,} visits in {time.perf_counter() - start:.1f}s")
+
+    params = {"diagnosis": args.diagnosis, "start_date": args.start_date, "end_date": args.end_date}
+    literal_query = OR_QUERY.format(**params)
+    results = []
+
+    drop_report_indexes(engine)
+    with engine.connect() as connection:
+        results.append(("OR, literal values, no indexes", *explain(connection, literal_query),
+                        *time_runs(lambda: pd.read_sql(literal_query, connection), args.repeat)))
+
+    start = time.perf_counter()
+    ensure_report_indexes(engine)
+    print(f"Built the report indexes in {time.perf_counter() - start:.1f}s")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("ANALYZE patient_visits")
+    with engine.connect() as connection:
+        results.append(("OR, literal values, indexes", *explain(connection, literal_query),
+                        *time_runs(lambda: pd.read_sql(literal_query, connection), args.repeat)))
+
+    for variant, query in [("OR, prepared, indexes", PATIENTS_BY_DIAGNOSIS_OR_VISIT_DATE_SQL), ("UNION ALL, prepared, indexes", UNION_ALL_QUERY)]:
+        with engine.connect() as connection:
+            latency = time_runs(lambda: execute_prepared(connection, "bench_patients_by_diagnosis", query, params), args.repeat)
+            # The statement is prepared by now, so this is the plan later report runs execute
+            names = connection.info["prepared_statements"]["bench_patients_by_diagnosis"][1]
+            execute = f"EXECUTE bench_patients_by_diagnosis({', '.join(['%s'] * len(names))})"
+            results.append((variant, *explain(connection, execute, tuple(params[name] for name in names)), *latency))
+
+    print(f"\n{'variant':<32} {'plan ms':>8} {'exec ms':>9} {'median s':>9} {'rows':>10}")
+    for variant, shape, planning, execution, seconds, rows in results:
+        print(f"{variant:<32} {planning:>8.2f} {execution:>9.1f} {seconds:>9.3f} {rows:>10,}")
+    print()
+    for variant, shape, *_ in results:
+        print(f"{variant}:\n  {shape}")
+
+    engine.dispose()
+    if not args.keep:
+        with admin.begin() as connection:
+            connection.exec_driver_sql(f"DROP SCHEMA {SCHEMA} CASCADE")
+    admin.dispose()
+
+if __name__ == "__main__":
+    main()
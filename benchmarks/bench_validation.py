@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from etl_pipeline import build_tables, clean_data
+from synthetic_data import generate_dataset, patients_for_rows
+from validation import schema_rules, validate_tables
+
+# Break a share of the rows so the run has something to quarantine: negative ages and visit dates in the future
+def add_invalid_rows(tables, share, seed=42):
+    rng = np.random.default_rng(seed)
+    demographics, visits = tables["patient_demographics"].copy(), tables["patient_visits"].copy()
+    demographics.loc[rng.random(len(demographics)) < share, "age"] = -5
+    visits.loc[rng.random(len(visits)) < share, "visit_date"] = np.datetime64("2099-01-01")
+    return {**tables, "patient_demographics": demographics, "patient_visits": visits}
+
+# Time validate_tables over synthetic cleaned tables of each size, with and without the foreign keys
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pre-load validation of the cleaned tables.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 5_000_000], help="Synthetic source rows over all five files")
+    parser.add_argument("--invalid-share", type=float, default=0.01, help="Share of patients and visits made invalid")
+    args = parser.parse_args()
+
+    rules = schema_rules()
+    print(f"{'rows':>12} {'quarantined':>12} {'no FKs (s)':>11} {'with FKs (s)':>13} {'rows/sec':>12}")
+    for size in args.sizes:
+        tables = add_invalid_rows(build_tables(clean_data(generate_dataset(patients_for_rows(size)))), args.invalid_share)
+        rows = sum(len(df) for df in tables.values())
+        start = time.perf_counter()
+        validate_tables(tables, rules, check_foreign_keys=False)
+        without_keys = time.perf_counter() - start
+        start = time.perf_counter()
+        _, quarantined, _ = validate_tables(tables, rules)
+        with_keys = time.perf_counter() - start
+        print(f"{rows:>12,} {sum(len(df) for df in quarantined.values()):>12,} {without_keys:>11.2f} {with_keys:>13.2f} {rows / with_keys:>12,.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_data import DEFAULT_FANOUT, generate_dataset, patients_for_rows, write_dataset
+
+# Pipeline stages in the order they run; each one is timed separately
+STAGES = ["load_data", "clean_data", "build_tables", "save_tables", "merge_data", "save_data"]
+
+# Default sizes, in rows over all five source tables
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+
+# Default location of the results file
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Peak resident set size of the current process so far, in MB (ru_maxrss is in KB on Linux, bytes on macOS)
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+# Generate one dataset into "directory" (run in its own process, so generation does not count towards the stages' RSS)
+def generate(rows, directory, seed, results):
+    data = generate_dataset(patients_for_rows(rows), seed=seed)
+    write_dataset(data, directory)
+    results.put({key: len(df) for key, df in data.items()})
+
+# Run the selected pipeline stages on the dataset in "directory" and send back one result per stage.
+# Runs in a fresh process per size, so peak RSS only covers that size. Peak RSS is cumulative:
+# the value of a stage is the highest RSS reached up to the end of that stage.
+def run_stages(directory, stages, results):
+    import etl_pipeline
+    import pandas as pd
+    etl_pipeline.base_path = directory
+    etl_pipeline.tables_path = os.path.join(directory, "cleaned")
+    etl_pipeline.CLEANED_DATA_PARQUET = os.path.join(directory, "cleaned_data.parquet")
+
+    state = {}
+    steps = {
+        "load_data": lambda: etl_pipeline.load_data(),
+        "clean_data": lambda: etl_pipeline.clean_data(state["load_data"]),
+        "build_tables": lambda: etl_pipeline.build_tables(dict(state["clean_data"])),
+        "save_tables": lambda: etl_pipeline.save_tables(state["build_tables"]),
+        "merge_data": lambda: etl_pipeline.merge_data(state["clean_data"]),
+        "save_data": lambda: etl_pipeline.save_data(state["merge_data"]),
+    }
+    # Stages before a selected one still run (their output is its input), but only selected stages are reported
+    last = max(STAGES.index(stage) for stage in stages)
+    for stage in STAGES[:last + 1]:
+        start = time.perf_counter()
+        state[stage] = steps[stage]()
+        elapsed = time.perf_counter() - start
+        # Rows/sec is over the rows the stage works on: the source tables, or the merged frame for save_data
+        source = state["merge_data"] if stage == "save_data" else state.get("clean_data", state["load_data"])
+        rows = len(source) if isinstance(source, pd.DataFrame) else sum(len(df) for df in source.values())
+        if stage not in stages:
+            continue
+        results.put({"stage": stage, "seconds": elapsed, "rows": rows,
+                     "rows_per_second": rows / elapsed if elapsed > 0 else None, "peak_rss_mb": peak_rss_mb()})
+
+# Run "target" in a fresh spawned process and return what it put in the results queue
+def run_in_process(target, *args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=target, args=(*args, results))
+    process.start()
+    collected = []
+    while process.is_alive() or not results.empty():
+        try:
+            collected.append(results.get(timeout=0.5))
+        except Exception:
+            continue
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{target.__name__} exited with code {process.exitcode}")
+    return collected
+
+# Environment the results were measured in, so results files can be compared between versions
+def environment():
+    import numpy
+    import pandas
+    import pyarrow
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "pandas": pandas.__version__, "numpy": numpy.__version__,
+            "pyarrow": pyarrow.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+# Print each stage's time next to the time of the same size and stage in an earlier results file
+def print_comparison(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(entry["size"], entry["stage"]): entry for entry in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path}")
+    print(f"{'size':>12} {'stage':<14} {'before s':>10} {'after s':>10} {'speedup':>8}")
+    for entry in results:
+        before = baseline.get((entry["size"], entry["stage"]))
+        if before:
+            print(f"{entry['size']:>12,} {entry['stage']:<14} {before['seconds']:>10.3f} {entry['seconds']:>10.3f} "
+                  f"{before['seconds'] / entry['seconds'] if entry['seconds'] else float('inf'):>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline stages on synthetic data at several sizes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Rows over all five source tables")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Results file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare with")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'size':>12} {'stage':<14} {'seconds':>10} {'rows/sec':>14} {'peak RSS MB':>12}")
+    for size in args.sizes:
+        directory = tempfile.mkdtemp(prefix=f"bench_{size}_")
+        try:
+            start = time.perf_counter()
+            table_rows = run_in_process(generate, size, directory, args.seed)[0]
+            print(f"{size:>12,} {'(generate)':<14} {time.perf_counter() - start:>10.3f} {sum(table_rows.values()):>14,} rows")
+            for entry in run_in_process(run_stages, directory, args.stages):
+                entry["size"] = size
+                results.append(entry)
+                print(f"{size:>12,} {entry['stage']:<14} {entry['seconds']:>10.3f} {entry['rows_per_second'] or 0:>14,.0f} "
+                      f"{entry['peak_rss_mb']:>12.1f}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"environment": environment(), "seed": args.seed, "fanout": DEFAULT_FANOUT, "results": results}, f, indent=2)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        print_comparison(results, args.compare)
+
+if __name__ == "__main__":
+    main()
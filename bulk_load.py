@@ -0,0 +1,200 @@
+import csv
+import io
+import logging
+import time
+from sqlalchemy import inspect
+from metrics import add_to_span
+
+# Load backends for load_data_to_table: "copy" streams rows through PostgreSQL COPY, "insert" is pandas' default INSERT path
+LOAD_BACKENDS = ("copy", "insert")
+DEFAULT_BACKEND = "copy"
+
+# Default number of rows per batch (one COPY per batch)
+DEFAULT_BATCH_SIZE = 50_000
+
+# Load modes: "replace" drops and recreates each table, "upsert" merges rows into the existing table by primary key,
+# "deferred" recreates the tables from sql/schema.sql and builds their keys, constraints and indexes after the load
+LOAD_MODES = ("replace", "upsert", "deferred")
+DEFAULT_MODE = "replace"
+
+# Load modes of loaders that load each table on its own, without a schema file to build the tables from
+TABLE_LOAD_MODES = ("replace", "upsert")
+
+# Quote a (schema-qualified) table name for use in SQL
+def quote_table(table_name, schema=None):
+    return f'"{schema}"."{table_name}"' if schema else f'"{table_name}"'
+
+# Write rows to an in-memory CSV buffer in the format COPY ... WITH (FORMAT csv) reads; None becomes NULL
+def rows_to_csv_buffer(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+# Size of an in-memory CSV buffer (its characters, which are bytes for ASCII data), left rewound for reading
+def buffer_size(buffer):
+    size = buffer.seek(0, io.SEEK_END)
+    buffer.seek(0)
+    return size
+
+# Stream rows into a table with COPY FROM STDIN on an open DBAPI (psycopg2) cursor.
+# The size of the CSV sent is added to the open metrics spans as bytes_written.
+def copy_rows(cursor, table_name, columns, rows, schema=None):
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    buffer = rows_to_csv_buffer(rows)
+    add_to_span("bytes_written", buffer_size(buffer))
+    cursor.copy_expert(f"COPY {quote_table(table_name, schema)} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+# DataFrame.to_sql "method" that sends each batch with COPY instead of INSERT statements.
+# pandas calls it once per chunksize rows, on the connection (and transaction) of the to_sql call.
+def copy_insert(table, conn, keys, data_iter):
+    with conn.connection.cursor() as cursor:
+        copy_rows(cursor, table.name, keys, data_iter, schema=table.schema)
+
+# Replace a table with the contents of a DataFrame using the chosen backend, in batches of batch_size rows.
+# to_sql creates the table from dtype_mapping and runs every batch on one connection inside one transaction.
+# With primary_keys, the last row per key is kept and the table gets its primary key in the same transaction,
+# so a later upsert finds the key ON CONFLICT needs. Returns the rows per second achieved.
+def replace_table(data, table_name, engine, dtype_mapping, backend=DEFAULT_BACKEND, batch_size=DEFAULT_BATCH_SIZE, schema=None,
+                  primary_keys=None):
+    if backend not in LOAD_BACKENDS:
+        raise ValueError(f"Unknown load backend {backend!r}; expected one of {LOAD_BACKENDS}")
+    method = copy_insert if backend == "copy" else None
+    if primary_keys:
+        data = drop_duplicate_keys(data, table_name, primary_keys)
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        data.to_sql(table_name, connection, if_exists='replace', index=False, dtype=dtype_mapping,
+                    method=method, chunksize=batch_size, schema=schema)
+        if primary_keys:
+            add_primary_key(connection, table_name, primary_keys, schema)
+    elapsed = time.perf_counter() - start
+    rows_per_second = len(data) / elapsed if elapsed > 0 else float("inf")
+    logging.info(f"Loaded {len(data)} rows into {table_name} with {backend} in {elapsed:.2f}s ({rows_per_second:,.0f} rows/sec)")
+    return rows_per_second
+
+# Append a DataFrame to an existing table (created by sql/schema.sql) with the chosen backend, in batches of batch_size rows.
+# Column types are the table's; all batches run in one transaction. Returns the rows per second achieved.
+def append_table(data, table_name, engine, backend=DEFAULT_BACKEND, batch_size=DEFAULT_BATCH_SIZE, schema=None):
+    if backend not in LOAD_BACKENDS:
+        raise ValueError(f"Unknown load backend {backend!r}; expected one of {LOAD_BACKENDS}")
+    method = copy_insert if backend == "copy" else None
+    start = time.perf_counter()
+    data.to_sql(table_name, engine, if_exists='append', index=False, method=method, chunksize=batch_size, schema=schema)
+    elapsed = time.perf_counter() - start
+    rows_per_second = len(data) / elapsed if elapsed > 0 else float("inf")
+    logging.info(f"Appended {len(data)} rows to {table_name} with {backend} in {elapsed:.2f}s ({rows_per_second:,.0f} rows/sec)")
+    return rows_per_second
+
+# Keep the last row per primary key, logging how many rows were dropped
+def drop_duplicate_keys(data, table_name, primary_keys):
+    duplicates = data.duplicated(subset=primary_keys, keep="last")
+    if duplicates.any():
+        logging.warning(f"Dropping {duplicates.sum()} rows with a duplicate primary key from {table_name}")
+        data = data[~duplicates]
+    return data
+
+# Write a DataFrame batch to an in-memory CSV buffer for COPY; missing values become NULL
+def frame_to_csv_buffer(data):
+    buffer = io.StringIO()
+    data.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    return buffer
+
+# Build the statement that merges the staging table into the target table.
+# Rows whose content is unchanged are excluded by the WHERE clause and so are neither rewritten nor returned;
+# "xmax = 0" is true only for rows the statement inserted, which separates inserts from updates.
+def build_upsert_sql(table_name, staging_name, columns, primary_keys, schema=None):
+    target = quote_table(table_name, schema)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    key_list = ", ".join(f'"{column}"' for column in primary_keys)
+    value_columns = [column for column in columns if column not in primary_keys]
+    if value_columns:
+        assignments = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in value_columns)
+        current = ", ".join(f'{target}."{column}"' for column in value_columns)
+        incoming = ", ".join(f'EXCLUDED."{column}"' for column in value_columns)
+        conflict_action = f"DO UPDATE SET {assignments} WHERE ROW({current}) IS DISTINCT FROM ROW({incoming})"
+    else:
+        conflict_action = "DO NOTHING"
+    return (
+        f"WITH merged AS ("
+        f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM \"{staging_name}\" "
+        f"ON CONFLICT ({key_list}) {conflict_action} "
+        f"RETURNING (xmax = 0) AS inserted) "
+        f"SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged"
+    )
+
+# Add a primary key to a table
+def add_primary_key(connection, table_name, primary_keys, schema=None):
+    key_list = ", ".join(f'"{column}"' for column in primary_keys)
+    connection.exec_driver_sql(f"ALTER TABLE {quote_table(table_name, schema)} ADD PRIMARY KEY ({key_list})")
+    logging.info(f"Added primary key ({key_list}) to {table_name}")
+
+# Make sure the target table exists and has the primary key ON CONFLICT needs.
+# Tables created by sql/schema.sql or by replace_table with primary_keys already have it; a table created without
+# one (by an older replace load, for example) may hold rows sharing a key, which the primary key cannot be built
+# over: they are counted first and reported with a ValueError, leaving the table as it is.
+def ensure_primary_key(connection, data, table_name, dtype_mapping, primary_keys, schema=None):
+    inspector = inspect(connection)
+    if not inspector.has_table(table_name, schema=schema):
+        data.head(0).to_sql(table_name, connection, index=False, dtype=dtype_mapping, schema=schema)
+    if not inspector.get_pk_constraint(table_name, schema=schema).get("constrained_columns"):
+        key_list = ", ".join(f'"{column}"' for column in primary_keys)
+        duplicates = connection.exec_driver_sql(
+            f"SELECT count(*) FROM (SELECT 1 FROM {quote_table(table_name, schema)} GROUP BY {key_list} HAVING count(*) > 1) AS duplicate_keys"
+        ).scalar_one()
+        if duplicates:
+            raise ValueError(f"Cannot upsert into {table_name}: it has no primary key and several rows share a ({key_list}) "
+                             f"(duplicate keys: {duplicates}); reload it with a replace load, which keeps the last row per key")
+        add_primary_key(connection, table_name, primary_keys, schema)
+
+# Merge a DataFrame into a table keyed on primary_keys: each batch is copied into a temporary staging table,
+# then one INSERT ... ON CONFLICT DO UPDATE applies it, touching only rows whose content changed.
+# Everything runs in one transaction. Returns the number of rows inserted, updated and left unchanged.
+def upsert_table(data, table_name, engine, dtype_mapping, primary_keys, batch_size=DEFAULT_BATCH_SIZE, schema=None):
+    # ON CONFLICT cannot update the same row twice in one statement, so keep the last row per key
+    data = drop_duplicate_keys(data, table_name, primary_keys)
+
+    columns = list(data.columns)
+    staging_name = f"{table_name}_staging"
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        ensure_primary_key(connection, data, table_name, dtype_mapping, primary_keys, schema)
+        connection.exec_driver_sql(
+            f'CREATE TEMP TABLE "{staging_name}" (LIKE {quote_table(table_name, schema)} INCLUDING DEFAULTS) ON COMMIT DROP'
+        )
+        with connection.connection.cursor() as cursor:
+            column_list = ", ".join(f'"{column}"' for column in columns)
+            for offset in range(0, len(data), batch_size):
+                buffer = frame_to_csv_buffer(data.iloc[offset:offset + batch_size])
+                add_to_span("bytes_written", buffer_size(buffer))
+                cursor.copy_expert(f'COPY "{staging_name}" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+        inserted, updated = connection.exec_driver_sql(
+            build_upsert_sql(table_name, staging_name, columns, primary_keys, schema)
+        ).one()
+    elapsed = time.perf_counter() - start
+    counts = {"inserted": inserted, "updated": updated, "unchanged": len(data) - inserted - updated}
+    logging.info(f"Upserted {len(data)} rows into {table_name} in {elapsed:.2f}s: "
+                 f"{counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged")
+    return counts
+
+# Delete the rows whose primary key is listed in "keys" (a DataFrame of the primary key columns): the keys are
+# copied into a temporary staging table and removed with one DELETE ... USING. Returns the number of rows deleted.
+def delete_rows(keys, table_name, engine, primary_keys, schema=None):
+    staging_name = f"{table_name}_deleted"
+    key_list = ", ".join(f'"{column}"' for column in primary_keys)
+    matches = " AND ".join(f'{quote_table(table_name, schema)}."{column}" = "{staging_name}"."{column}"' for column in primary_keys)
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f'CREATE TEMP TABLE "{staging_name}" ON COMMIT DROP AS SELECT {key_list} FROM {quote_table(table_name, schema)} WITH NO DATA'
+        )
+        with connection.connection.cursor() as cursor:
+            buffer = frame_to_csv_buffer(keys[primary_keys])
+            add_to_span("bytes_written", buffer_size(buffer))
+            cursor.copy_expert(f'COPY "{staging_name}" ({key_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+        deleted = connection.exec_driver_sql(
+            f'DELETE FROM {quote_table(table_name, schema)} USING "{staging_name}" WHERE {matches}'
+        ).rowcount
+    logging.info(f"Deleted {deleted} of {len(keys)} deleted keys from {table_name} in {time.perf_counter() - start:.2f}s")
+    return deleted
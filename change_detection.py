@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Directory where the pipeline remembers what it emitted last run: a fingerprint per source file (state.json)
+# and, per table, the content hash of every source row next to the row's natural ID (<table>.parquet)
+STATE_DIR = os.path.join("data", ".etl_state")
+STATE_FILE = "state.json"
+
+# Subdirectory of the state directory holding the state of the last ETL run until its tables are loaded
+PENDING_DIR = "pending"
+
+# Natural ID of each source table (the primary key the loaders upsert on)
+natural_keys = {
+    "patient_demographics": ["patient_id"],
+    "patient_visits": ["visit_id"],
+    "patient_lab_results": ["lab_test_id"],
+    "physician_assignments": ["patient_id", "visit_id", "physician_id"],
+    "patient_medications": ["medication_id"]
+}
+
+# SHA-256 of a file's bytes, read in blocks; None when the file does not exist
+def file_fingerprint(path, block_size=1 << 20):
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Load the state of the last run (an empty state when there is none)
+def load_state(state_dir=STATE_DIR):
+    path = os.path.join(state_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {"files": {}}
+    with open(path) as f:
+        return json.load(f)
+
+# Persist the state of this run
+def save_state(state, state_dir=STATE_DIR):
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, STATE_FILE), "w") as f:
+        json.dump(state, f, indent=2)
+
+# Directory an ETL run writes its state to (see commit_pending_state)
+def pending_state_dir(state_dir=STATE_DIR):
+    return os.path.join(state_dir, PENDING_DIR)
+
+# Remove the state of an earlier ETL run that was never loaded, before a new run writes its own
+def clear_pending_state(state_dir=STATE_DIR):
+    shutil.rmtree(pending_state_dir(state_dir), ignore_errors=True)
+
+# Make the state of the last ETL run the one the next run compares against; the loaders call it once every table
+# is loaded. Until then an ETL run compares against the state of the last load, so running the ETL twice before
+# a load still writes every row changed since that load. Returns whether there was a pending state to commit.
+def commit_pending_state(state_dir=STATE_DIR):
+    pending = pending_state_dir(state_dir)
+    if not os.path.isdir(pending):
+        return False
+    for name in os.listdir(pending):
+        os.replace(os.path.join(pending, name), os.path.join(state_dir, name))
+    os.rmdir(pending)
+    return True
+
+# Content hash of every row (all columns, values not positions), as uint64
+def row_hashes(df):
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+# Read a frame stored in the state directory (row hashes, visit counts); None when there is none
+def read_state_frame(name, state_dir=STATE_DIR):
+    path = os.path.join(state_dir, f"{name}.parquet")
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+# Store a frame in the state directory
+def write_state_frame(df, name, state_dir=STATE_DIR):
+    os.makedirs(state_dir, exist_ok=True)
+    df.to_parquet(os.path.join(state_dir, f"{name}.parquet"), index=False)
+
+# The natural IDs of a table with the content hash of each row, as stored for the next run
+def hash_frame(df, keys, hashes):
+    return df[keys].astype(object).reset_index(drop=True).assign(row_hash=hashes)
+
+# Compare a table's rows with the hashes stored by the last run.
+# A row whose content hash was stored is unchanged; the others are new (ID not seen before) or changed.
+# Returns the mask of rows to process and the counts of new, changed, unchanged and deleted rows.
+def classify_rows(df, keys, hashes, previous):
+    if previous is None:
+        return np.ones(len(df), dtype=bool), {"new": len(df), "changed": 0, "unchanged": 0, "deleted": 0}
+    unchanged = np.isin(hashes, previous["row_hash"].to_numpy())
+    current_ids = row_hashes(df[keys].astype(object))
+    previous_ids = row_hashes(previous[keys])
+    known = np.isin(current_ids, previous_ids)
+    counts = {
+        "new": int((~unchanged & ~known).sum()),
+        "changed": int((~unchanged & known).sum()),
+        "unchanged": int(unchanged.sum()),
+        "deleted": int((~np.isin(previous_ids, current_ids)).sum())
+    }
+    return ~unchanged, counts
+
+# The natural IDs stored by the last run that are no longer in the table (none when there was no last run)
+def deleted_keys(df, keys, previous):
+    if previous is None:
+        return pd.DataFrame(columns=keys)
+    current_ids = row_hashes(df[keys].astype(object))
+    previous_ids = row_hashes(previous[keys])
+    return previous.loc[~np.isin(previous_ids, current_ids), keys].reset_index(drop=True)
@@ -0,0 +1,114 @@
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from date_parsing import DATE_COLUMNS, parse_dates
+
+# Cleaned data written by etl_pipeline.py and read by the loaders.
+# Parquet is the intermediate format; the CSV is an opt-in export kept for people who want to open the data directly.
+CLEANED_DATA_PARQUET = os.path.join("data", "cleaned_data.parquet")
+CLEANED_DATA_CSV = os.path.join("data", "cleaned_data.csv")
+
+# Directory holding one file per cleaned table (<table>.parquet, or <table>.csv from a streaming run).
+# When it exists it is the loaders' source of truth; the wide cleaned_data file is only read without it.
+CLEANED_TABLES_DIR = os.path.join("data", "cleaned")
+
+# File in the tables directory recording whether the tables hold every row or only the rows changed since the last run
+TABLES_MANIFEST = "manifest.json"
+
+# Suffix of the file listing the natural IDs of a table's rows deleted since the last load (<table>_deleted.parquet)
+DELETED_SUFFIX = "_deleted"
+
+# Convert a DataFrame to an Arrow table, dictionary-encoding string columns whose values repeat
+# (units, departments, diagnoses, IDs of parent tables). Mostly-distinct columns stay plain strings.
+def to_arrow_table(df, max_unique_ratio=0.5):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for index, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            column = table.column(index)
+            if pc.count_distinct(column).as_py() <= max_unique_ratio * len(column):
+                table = table.set_column(index, field.name, column.dictionary_encode())
+    return table
+
+# Write a DataFrame as Parquet, keeping the dtypes and dictionary encoding computed by the pipeline
+def write_parquet(df, path=CLEANED_DATA_PARQUET):
+    pq.write_table(to_arrow_table(df), path, compression="snappy")
+
+# Read a cleaned CSV file, materializing only "columns" (all columns when None).
+# CSV has no date type, so the date columns are parsed back into datetime64, as Parquet keeps them.
+def read_csv_file(path, columns=None):
+    df = pd.read_csv(path, usecols=columns)
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = parse_dates(df[column])[0]
+    return df if columns is None else df[columns]
+
+# Read the cleaned data, materializing only "columns" (all columns when None).
+# Falls back to the CSV export when no Parquet file has been written.
+def read_cleaned_data(columns=None, parquet_path=CLEANED_DATA_PARQUET, csv_path=CLEANED_DATA_CSV):
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path, columns=columns)
+    return read_csv_file(csv_path, columns)
+
+# Path of one cleaned table file with the given extension ("parquet" or "csv")
+def table_file(table_name, extension, tables_dir=CLEANED_TABLES_DIR):
+    return os.path.join(tables_dir, f"{table_name}.{extension}")
+
+# Remove the files a previous run left for a table, so a reader never picks up a stale format
+def clear_table(table_name, tables_dir=CLEANED_TABLES_DIR):
+    for extension in ("parquet", "csv"):
+        if os.path.exists(table_file(table_name, extension, tables_dir)):
+            os.remove(table_file(table_name, extension, tables_dir))
+
+# Write one cleaned table as Parquet, plus a CSV export when export_csv is set
+def write_table(df, table_name, tables_dir=CLEANED_TABLES_DIR, export_csv=False):
+    os.makedirs(tables_dir, exist_ok=True)
+    clear_table(table_name, tables_dir)
+    write_parquet(df, table_file(table_name, "parquet", tables_dir))
+    if export_csv:
+        df.to_csv(table_file(table_name, "csv", tables_dir), index=False)
+
+# Path of the file read_table reads a table from (the table's Parquet or CSV file, or the wide cleaned data)
+def table_source_path(table_name, tables_dir=CLEANED_TABLES_DIR):
+    if not os.path.isdir(tables_dir):
+        return CLEANED_DATA_PARQUET if os.path.exists(CLEANED_DATA_PARQUET) else CLEANED_DATA_CSV
+    if os.path.exists(table_file(table_name, "parquet", tables_dir)):
+        return table_file(table_name, "parquet", tables_dir)
+    return table_file(table_name, "csv", tables_dir)
+
+# Read one cleaned table, materializing only "columns" (all columns when None).
+# Uses the per-table files when the tables directory exists and projects the wide cleaned data otherwise.
+def read_table(table_name, columns=None, tables_dir=CLEANED_TABLES_DIR):
+    if not os.path.isdir(tables_dir):
+        return read_cleaned_data(columns)
+    if os.path.exists(table_file(table_name, "parquet", tables_dir)):
+        return pd.read_parquet(table_file(table_name, "parquet", tables_dir), columns=columns)
+    return read_csv_file(table_file(table_name, "csv", tables_dir), columns)
+
+# Write the natural IDs of the rows deleted from a table, or remove the file of an earlier run when there are none
+def write_deleted_keys(df, table_name, tables_dir=CLEANED_TABLES_DIR):
+    if df is None or df.empty:
+        clear_table(f"{table_name}{DELETED_SUFFIX}", tables_dir)
+    else:
+        write_table(df, f"{table_name}{DELETED_SUFFIX}", tables_dir)
+
+# The natural IDs of the rows deleted from a table since the last load (None when there are none)
+def read_deleted_keys(table_name, tables_dir=CLEANED_TABLES_DIR):
+    path = table_file(f"{table_name}{DELETED_SUFFIX}", "parquet", tables_dir)
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+# Record whether the tables directory holds every row (delta=False) or only new and changed rows (delta=True)
+def write_tables_manifest(tables_dir=CLEANED_TABLES_DIR, delta=False):
+    os.makedirs(tables_dir, exist_ok=True)
+    with open(os.path.join(tables_dir, TABLES_MANIFEST), "w") as f:
+        json.dump({"delta": delta}, f)
+
+# Whether the tables directory holds only the rows changed since the last run, which must be upserted, not replaced
+def tables_are_delta(tables_dir=CLEANED_TABLES_DIR):
+    path = os.path.join(tables_dir, TABLES_MANIFEST)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return json.load(f).get("delta", False)
@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+# Engine load_data parses the source files with ("pandas" or "arrow"), overridable from the environment (.env)
+DEFAULT_PARSE_ENGINE = os.getenv("ETL_PARSE_ENGINE", "pandas")
+
+# Bytes of a file each Arrow parse thread works on at a time
+ARROW_BLOCK_SIZE = int(os.getenv("ETL_ARROW_BLOCK_SIZE", 16 << 20))
+
+# Values read as missing: pandas' defaults, so both engines agree on what is missing
+NULL_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+               "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+# Arrow type each read dtype is parsed as (categorical columns are parsed as text, then dictionary-encoded)
+ARROW_TYPES = {"object": pa.string(), "Int64": pa.int64(), "float64": pa.float64(), "category": pa.string()}
+
+# Share of distinct values above which a declared categorical column stays text: a categorical would cost more
+# memory than it saves there
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+# Dtype pandas' parser reads each declared dtype as. Its own categorical conversion sorts the categories, which is
+# several times slower on high-cardinality IDs than reading text and converting it (see to_categorical).
+PANDAS_PARSE_DTYPES = {"category": "object"}
+
+# The dtypes pandas' parser reads a file's declared dtypes as (see PANDAS_PARSE_DTYPES)
+def pandas_dtypes(dtype):
+    return {column: PANDAS_PARSE_DTYPES.get(kind, kind) for column, kind in dtype.items()}
+
+# Convert a text column to categorical without sorting its categories. Columns whose values are mostly distinct
+# are left as they are (see CATEGORY_MAX_UNIQUE_RATIO).
+def to_categorical(series, max_unique_ratio=CATEGORY_MAX_UNIQUE_RATIO):
+    codes, uniques = pd.factorize(series)
+    if len(uniques) > max_unique_ratio * len(series):
+        return series
+    return pd.Series(pd.Categorical.from_codes(codes, uniques), index=series.index, name=series.name)
+
+# pandas' C parser: a single thread reading the file through a Python file object.
+# "dtype" maps columns to declared dtypes; "columns" restricts the columns parsed (all of them when None).
+# Categorical columns are parsed as text and converted afterwards (see PANDAS_PARSE_DTYPES).
+def read_with_pandas(path, dtype, columns=None):
+    df = pd.read_csv(path, dtype=pandas_dtypes(dtype), usecols=columns)
+    for column in df.columns:
+        if dtype.get(column) == "category":
+            df[column] = to_categorical(df[column])
+    return df if columns is None else df[columns]
+
+# Arrow's CSV reader over a memory-mapped file: blocks of the file are parsed and converted on several threads,
+# straight from the page cache, and columns left out of "columns" are skipped without being converted.
+# Columns are parsed as their declared dtype and converted to the same pandas dtypes read_with_pandas returns.
+# Categorical columns are dictionary-encoded in Arrow, so their values never become Python strings (unless they
+# are mostly distinct, see CATEGORY_MAX_UNIQUE_RATIO, when they stay text as with pandas).
+def read_with_arrow(path, dtype, columns=None):
+    convert_options = pacsv.ConvertOptions(
+        column_types={column: ARROW_TYPES[kind] for column, kind in dtype.items() if kind in ARROW_TYPES},
+        include_columns=columns or [], null_values=NULL_VALUES, strings_can_be_null=True)
+    read_options = pacsv.ReadOptions(use_threads=True, block_size=ARROW_BLOCK_SIZE)
+    with pa.memory_map(os.fspath(path)) as source:
+        table = pacsv.read_csv(source, read_options=read_options, convert_options=convert_options)
+    for index, column in enumerate(table.column_names):
+        if dtype.get(column) == "category":
+            encoded = pc.dictionary_encode(table.column(column)).unify_dictionaries()
+            if encoded.num_chunks and len(encoded.chunk(0).dictionary) <= CATEGORY_MAX_UNIQUE_RATIO * len(encoded):
+                table = table.set_column(index, column, encoded)
+    df = table.to_pandas()
+    for column, kind in dtype.items():
+        if column not in df.columns:
+            continue
+        # Missing strings come back as None where pandas reads NaN
+        if kind in ("object", "category") and df[column].dtype == object and table.column(column).null_count:
+            df[column] = df[column].fillna(np.nan)
+        # Arrow integers with missing values come back as float64; the declared nullable dtype puts them back
+        elif kind not in ("object", "float64", "category"):
+            df[column] = df[column].astype(kind)
+    return df
+
+# Parse engines by name
+PARSE_ENGINES = {"pandas": read_with_pandas, "arrow": read_with_arrow}
+
+# Parse a CSV file with the named engine
+def read_csv(path, dtype, columns=None, engine=DEFAULT_PARSE_ENGINE):
+    if engine not in PARSE_ENGINES:
+        raise ValueError(f"Unknown parse engine {engine!r}; expected one of {tuple(PARSE_ENGINES)}")
+    return PARSE_ENGINES[engine](path, dtype, columns)
@@ -0,0 +1,51 @@
+import logging
+import numpy as np
+import pandas as pd
+
+# Date columns of the source and cleaned tables
+DATE_COLUMNS = ["visit_date", "test_date", "start_date", "end_date", "assignment_date"]
+
+# Formats a date column may be written in, tried in this order (the first of equally good formats wins)
+DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d", "%m/%d/%Y", "%d/%m/%Y", "%d-%m-%Y", "%m-%d-%Y", "%d.%m.%Y", "%Y%m%d",
+                "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"]
+
+# Distinct values of a column the format is detected from
+FORMAT_SAMPLE_SIZE = 1000
+
+# The distinct values of a column with, for every row, the position of its value (-1 where missing).
+# A categorical column already holds both; other columns are factorized, which hashes each row once.
+def distinct_values(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.categories, series.cat.codes.to_numpy()
+    codes, uniques = pd.factorize(series)
+    return pd.Index(uniques), codes
+
+# Detect the format of a column from a sample of its distinct values: the format of DATE_FORMATS that parses
+# the most of them. Returns None when none of them parses a single value.
+def detect_date_format(values, formats=DATE_FORMATS, sample_size=FORMAT_SAMPLE_SIZE):
+    sample = pd.Index(values).dropna().astype(str)[:sample_size]
+    best_format, best_count = None, 0
+    for date_format in formats:
+        count = pd.to_datetime(sample, format=date_format, errors="coerce").notna().sum()
+        if count > best_count:
+            best_format, best_count = date_format, count
+    return best_format
+
+# Parse a date column into datetime64. Dates repeat heavily (many rows per visit day), so each distinct value
+# is parsed once, with one fixed format, and the rows take the parsed value of theirs.
+# date_format is detected from the values when not given; with no format found the parser infers one.
+# Columns that are already datetime64 are kept as they are.
+# Returns the parsed column and the number of non-missing values that are not valid dates (now missing).
+def parse_dates(series, date_format=None):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series, 0
+    uniques, codes = distinct_values(series)
+    if date_format is None:
+        date_format = detect_date_format(uniques)
+    if date_format is None and len(uniques):
+        logging.warning(f"No known date format matches {series.name}; inferring it")
+    parsed = pd.to_datetime(uniques.astype(str), format=date_format, errors="coerce")
+    # Position -1 (a missing value) picks the NaT appended at the end
+    values = np.append(parsed.to_numpy(dtype="datetime64[ns]"), np.datetime64("NaT", "ns"))[codes]
+    invalid = int((np.isnat(values) & (codes >= 0)).sum())
+    return pd.Series(values, index=series.index, name=series.name), invalid
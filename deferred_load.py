@@ -0,0 +1,186 @@
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from metrics import span
+
+# Schema the tables of a deferred load are created from
+SCHEMA_PATH = os.path.join("sql", "schema.sql")
+
+# Connections that rebuild indexes and validate constraints at the same time
+BUILD_WORKERS = int(os.getenv("LOAD_BUILD_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Memory each index build may sort in (PostgreSQL's default of 64MB spills large builds to disk)
+MAINTENANCE_WORK_MEM = os.getenv("LOAD_MAINTENANCE_WORK_MEM", "256MB")
+
+# Order deferred objects are dropped in: foreign keys first, since they depend on the keys they reference
+DROP_ORDER = ("foreign key", "check", "not null", "primary key", "unique", "index")
+
+# Split a schema file into its statements, without "--" comments
+def schema_statements(schema_path=SCHEMA_PATH):
+    with open(schema_path) as f:
+        schema = re.sub(r"--[^\n]*", "", f.read())
+    return [statement.strip() for statement in schema.split(";") if statement.strip()]
+
+# Drop the tables and create them again from the schema file, with all their keys, constraints and indexes.
+# The tables are dropped in one statement, so the foreign keys between them do not matter; anything else that
+# depends on them (a view, say) makes the drop fail rather than disappear with them.
+def create_tables(engine, tables, schema_path=SCHEMA_PATH):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {', '.join(tables)}")
+        for statement in schema_statements(schema_path):
+            connection.exec_driver_sql(statement)
+    logging.info(f"Created {', '.join(tables)} from {schema_path}")
+
+# Read the keys, constraints and indexes of the tables from the catalog, with the SQL that recreates each one:
+# {"table", "name", "kind", "definition"}. "definition" is the constraint clause for constraints, the CREATE INDEX
+# statement for indexes (including the unique index behind a primary key or unique constraint), and the column
+# for NOT NULL (primary key columns keep theirs, as dropping the key does not remove it).
+def deferred_objects(connection, tables):
+    rows = connection.execute(text("""
+        SELECT c.relname, con.conname,
+               CASE con.contype WHEN 'p' THEN 'primary key' WHEN 'u' THEN 'unique' WHEN 'c' THEN 'check' ELSE 'foreign key' END,
+               CASE WHEN con.contype IN ('p', 'u') THEN pg_get_indexdef(con.conindid) ELSE pg_get_constraintdef(con.oid) END
+        FROM pg_constraint con JOIN pg_class c ON c.oid = con.conrelid
+        WHERE c.relname = ANY(:tables) AND pg_table_is_visible(c.oid) AND con.contype IN ('p', 'u', 'c', 'f')
+        UNION ALL
+        SELECT c.relname, i.relname, 'index', pg_get_indexdef(i.oid)
+        FROM pg_index x JOIN pg_class c ON c.oid = x.indrelid JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE c.relname = ANY(:tables) AND pg_table_is_visible(c.oid)
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = x.indexrelid AND con.conrelid = x.indrelid)
+        UNION ALL
+        SELECT c.relname, a.attname, 'not null', a.attname
+        FROM pg_attribute a JOIN pg_class c ON c.oid = a.attrelid
+        WHERE c.relname = ANY(:tables) AND pg_table_is_visible(c.oid) AND a.attnum > 0 AND NOT a.attisdropped AND a.attnotnull
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conrelid = c.oid AND con.contype = 'p' AND a.attnum = ANY(con.conkey))
+    """), {"tables": list(tables)}).all()
+    return [{"table": table, "name": name, "kind": kind, "definition": definition} for table, name, kind, definition in rows]
+
+# Drop the deferred keys, constraints and indexes, leaving bare tables that a COPY fills without checking or
+# indexing each row
+def drop_deferred(connection, objects):
+    for kind in DROP_ORDER:
+        for item in (item for item in objects if item["kind"] == kind):
+            if kind == "index":
+                connection.exec_driver_sql(f'DROP INDEX "{item["name"]}"')
+            elif kind == "not null":
+                connection.exec_driver_sql(f'ALTER TABLE "{item["table"]}" ALTER COLUMN "{item["name"]}" DROP NOT NULL')
+            else:
+                connection.exec_driver_sql(f'ALTER TABLE "{item["table"]}" DROP CONSTRAINT "{item["name"]}"')
+
+# Switch the tables between UNLOGGED (a COPY writes no WAL) and LOGGED (the table is written to the WAL once, in bulk)
+def set_logged(connection, tables, logged):
+    for table in tables:
+        connection.exec_driver_sql(f'ALTER TABLE "{table}" SET {"LOGGED" if logged else "UNLOGGED"}')
+
+# Create the tables from the schema file and strip them down for a bulk load.
+# With defer=False the tables keep every key, constraint and index, which the load then maintains row by row.
+# unlogged=True (deferred loads only: a foreign key cannot join a logged and an unlogged table) loads without WAL.
+# Returns the deferred objects to hand to finish_deferred_load.
+def prepare_deferred_load(engine, tables, schema_path=SCHEMA_PATH, defer=True, unlogged=False):
+    with span("create_tables"):
+        create_tables(engine, tables, schema_path)
+    objects = []
+    with span("drop_deferred"), engine.begin() as connection:
+        if defer:
+            objects = deferred_objects(connection, tables)
+            drop_deferred(connection, objects)
+        if unlogged and defer:
+            set_logged(connection, tables, logged=False)
+    logging.info(f"Deferred {len(objects)} keys, constraints and indexes on {', '.join(tables)}"
+                 f"{' (tables unlogged)' if unlogged else ''}")
+    return objects
+
+# Run one statement on its own connection and transaction; returns (seconds, error message or None)
+def run_statement(engine, statement):
+    start = time.perf_counter()
+    try:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f"SET LOCAL maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'")
+            connection.exec_driver_sql(statement)
+        return time.perf_counter() - start, None
+    except Exception as e:
+        return time.perf_counter() - start, str(e).splitlines()[0]
+
+# Run statements on up to "workers" connections at once. Returns one result per (label, statement).
+def run_statements(engine, statements, workers):
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(lambda item: (item[0], *run_statement(engine, item[1])), statements)
+        return [{"object": label, "seconds": seconds, "error": error} for label, seconds, error in results]
+
+# Rebuild what prepare_deferred_load dropped, in bulk, and return the timings and failures:
+# 1. make unlogged tables LOGGED again;
+# 2. build every index in parallel, the unique indexes behind primary keys and unique constraints included
+#    (CREATE INDEX locks out writes but not other index builds on the same table); the keys are then
+#    attached to their index, which needs no further scan;
+# 3. add the CHECK and foreign key constraints as NOT VALID (a catalog change, no scan);
+# 4. VALIDATE the constraints and restore NOT NULL, in parallel across tables;
+# 5. ANALYZE the tables, so the planner has statistics for the new data.
+# A constraint that fails validation is reported and kept as NOT VALID: it applies to new rows, not to the loaded ones.
+def finish_deferred_load(engine, tables, objects, unlogged=False, workers=BUILD_WORKERS):
+    phases = {}
+    failures = []
+
+    # Log and keep the statements that failed; returns the labels of the failed ones
+    def keep_failures(results):
+        failed = [result for result in results if result["error"]]
+        for result in failed:
+            logging.error(f"Could not restore {result['object']}: {result['error']}")
+        failures.extend(failed)
+        return {result["object"] for result in failed}
+
+    start = time.perf_counter()
+    if unlogged:
+        with span("set_logged"), engine.begin() as connection:
+            set_logged(connection, tables, logged=True)
+        phases["set_logged"] = time.perf_counter() - start
+
+    keys = [item for item in objects if item["kind"] in ("primary key", "unique")]
+    indexes = [item for item in objects if item["kind"] in ("primary key", "unique", "index")]
+    start = time.perf_counter()
+    with span("build_indexes", workers=workers):
+        failed = keep_failures(run_statements(engine, [(f"{item['table']}.{item['name']}", item["definition"]) for item in indexes], workers))
+        with engine.begin() as connection:
+            for item in keys:
+                if f"{item['table']}.{item['name']}" not in failed:
+                    connection.exec_driver_sql(f'ALTER TABLE "{item["table"]}" ADD CONSTRAINT "{item["name"]}" '
+                                               f'{item["kind"].upper()} USING INDEX "{item["name"]}"')
+    phases["build_indexes"] = time.perf_counter() - start
+
+    constraints = [item for item in objects if item["kind"] in ("check", "foreign key")]
+    start = time.perf_counter()
+    with span("add_constraints"), engine.begin() as connection:
+        for item in constraints:
+            connection.exec_driver_sql(f'ALTER TABLE "{item["table"]}" ADD CONSTRAINT "{item["name"]}" {item["definition"]} NOT VALID')
+    not_null = {}
+    for item in objects:
+        if item["kind"] == "not null":
+            not_null.setdefault(item["table"], []).append(item["name"])
+    phases["add_constraints"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with span("validate_constraints", workers=workers):
+        statements = [(f"{item['table']}.{item['name']}", f'ALTER TABLE "{item["table"]}" VALIDATE CONSTRAINT "{item["name"]}"')
+                      for item in constraints]
+        # One ALTER TABLE per table restores all its NOT NULL columns with a single scan
+        statements += [(table, f'ALTER TABLE "{table}" ' + ", ".join(f'ALTER COLUMN "{column}" SET NOT NULL' for column in columns))
+                       for table, columns in not_null.items()]
+        results = run_statements(engine, statements, workers)
+        keep_failures([result for result in results if result["object"] not in not_null])
+        # When a table's NOT NULL columns cannot all be restored, restore them one at a time to find the ones holding NULLs
+        retry = [(f"{table}.{column} NOT NULL", f'ALTER TABLE "{table}" ALTER COLUMN "{column}" SET NOT NULL')
+                 for table in (result["object"] for result in results if result["object"] in not_null and result["error"])
+                 for column in not_null[table]]
+        keep_failures(run_statements(engine, retry, workers))
+    phases["validate_constraints"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with span("analyze"):
+        run_statements(engine, [(table, f'ANALYZE "{table}"') for table in tables], workers)
+    phases["analyze"] = time.perf_counter() - start
+
+    logging.info("Deferred load finished: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in phases.items())
+                 + (f"; {len(failures)} objects could not be restored" if failures else ""))
+    return phases, failures
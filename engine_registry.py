@@ -0,0 +1,105 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+# Pool settings shared by every engine, overridable from the environment (.env)
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 5))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# One engine (and pool) per target, created on first use and reused for the rest of the run
+_engines = {}
+_stats = {}
+_lock = threading.Lock()
+
+# Guards the pool statistics, which every thread checking out a connection updates
+_stats_lock = threading.Lock()
+
+# Add to pool statistics ("checkouts", "waits", ...) from any thread
+def _count(stats, **amounts):
+    with _stats_lock:
+        for key, amount in amounts.items():
+            stats[key] += amount
+
+# QueuePool that records how often a checkout had to wait for a connection to be returned, and for how long.
+# Keeps its configured max_overflow (negative for no limit) to tell when every connection is in use.
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, creator, max_overflow=10, **kwargs):
+        super().__init__(creator, max_overflow=max_overflow, **kwargs)
+        self.max_overflow = max_overflow
+        self.stats = {"checkouts": 0, "waits": 0, "wait_seconds": 0.0, "connections_opened": 0}
+
+    def _do_get(self):
+        exhausted = self.max_overflow >= 0 and self.checkedin() == 0 and self.overflow() >= self.max_overflow
+        start = time.perf_counter()
+        connection = super()._do_get()
+        if exhausted:
+            _count(self.stats, waits=1, wait_seconds=time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+# Count connections opened and checked out on an engine's pool
+def _track_pool(engine, stats):
+    engine.pool.stats = stats
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        _count(stats, connections_opened=1)
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        _count(stats, checkouts=1)
+
+# Get the pooled engine for a target ("postgres", "supabase", ...), creating it on first use.
+# Later calls return the same engine whatever url and options they pass.
+def get_engine(name, url, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT,
+               pool_recycle=POOL_RECYCLE, pool_pre_ping=POOL_PRE_PING):
+    with _lock:
+        if name not in _engines:
+            engine = create_engine(url, poolclass=InstrumentedQueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                                   pool_timeout=pool_timeout, pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+            _stats[name] = engine.pool.stats
+            _track_pool(engine, _stats[name])
+            _engines[name] = engine
+            logging.info(f"Created pooled engine for {name} (pool_size={pool_size}, max_overflow={max_overflow}, "
+                         f"pre_ping={pool_pre_ping}, recycle={pool_recycle}s)")
+        return _engines[name]
+
+# Connections an engine's pool can hand out at once (pool_size + max_overflow), or None when it has no such limit
+# or is not an InstrumentedQueuePool
+def pool_capacity(engine):
+    max_overflow = getattr(engine.pool, "max_overflow", -1)
+    return None if max_overflow < 0 else engine.pool.size() + max_overflow
+
+# Pool statistics of one engine: checkouts, waits for a free connection (count and seconds), connections opened
+def pool_stats(name):
+    with _stats_lock:
+        return dict(_stats[name])
+
+# Write the pool statistics of every engine to the log
+def log_pool_stats():
+    for name in _stats:
+        stats = pool_stats(name)
+        logging.info(f"Pool stats for {name}: {stats['checkouts']} checkouts, {stats['waits']} waits "
+                     f"({stats['wait_seconds']:.3f}s), {stats['connections_opened']} connections opened")
+
+# Log the pool statistics and close every pooled connection; runs at interpreter exit
+def dispose_engines():
+    with _lock:
+        log_pool_stats()
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _stats.clear()
+
+atexit.register(dispose_engines)
@@ -1,6 +1,19 @@
+import numpy as np
 import pandas as pd
 import os
 import logging
+import argparse
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pyarrow as pa
+from cleaned_data_io import CLEANED_DATA_CSV, CLEANED_DATA_PARQUET, CLEANED_TABLES_DIR, clear_table, table_file, write_deleted_keys, write_parquet, write_table, write_tables_manifest
+from metrics import add_to_span, profiled, span, start_metrics_server
+from csv_engines import DEFAULT_PARSE_ENGINE, PARSE_ENGINES, pandas_dtypes, read_csv, to_categorical
+from date_parsing import DATE_COLUMNS, detect_date_format, distinct_values, parse_dates
+from validation import QUARANTINE_DIR, print_validation_report, schema_rules, validate_tables, write_quarantine
+from change_detection import STATE_DIR, classify_rows, clear_pending_state, deleted_keys, file_fingerprint, hash_frame, load_state, natural_keys, pending_state_dir, read_state_frame, row_hashes, save_state, write_state_frame
 
 # Ensure logs directory exists
 log_dir = "logs"
@@ -23,6 +36,57 @@ files = {
     "patient_medications": "patient_medications.csv"
 }
 
+# Output directory for the per-table cleaned files
+tables_path = CLEANED_TABLES_DIR
+
+# Output directory for the rows validation rejects (see validation.validate_tables)
+quarantine_path = QUARANTINE_DIR
+
+# Default number of rows per chunk in streaming mode
+DEFAULT_CHUNK_SIZE = 100_000
+
+# Explicit read schema per source file. IDs that repeat across rows, and other low-cardinality values,
+# are categorical; each table's own unique key and free text stay object. age is read as text (categorical, as ages
+# repeat) and converted by clean_data (see parse_age), so a value that is not a number does not fail the whole file.
+# Dates are read as text (categorical, since they repeat) and parsed by clean_data (see date_parsing).
+# Declaring every column also means a chunk where a column happens to be empty is read like the rest of the file.
+schemas = {
+    "patient_demographics": {
+        "dtype": {"patient_id": "object", "age": "category", "gender": "category", "other_fields": "object"}
+    },
+    "patient_visits": {
+        "dtype": {"patient_id": "category", "visit_id": "object", "visit_date": "category", "diagnosis": "category",
+                  "medication": "category", "other_fields": "object"}
+    },
+    "patient_lab_results": {
+        "dtype": {"patient_id": "category", "lab_test_id": "object", "visit_id": "category", "test_name": "category",
+                  "result_value": "float64", "result_unit": "category", "reference_range": "category", "notes": "object",
+                  "test_date": "category"}
+    },
+    "physician_assignments": {
+        "dtype": {"patient_id": "category", "visit_id": "category", "physician_id": "category",
+                  "physician_name": "category", "department": "category", "assignment_date": "category"}
+    },
+    "patient_medications": {
+        "dtype": {"patient_id": "category", "medication_id": "object", "visit_id": "category", "medication": "category",
+                  "dosage": "category", "notes": "object", "start_date": "category", "end_date": "category"}
+    }
+}
+
+# Directory holding the change-detection state of the last run
+state_path = STATE_DIR
+
+# Default number of files read at the same time by load_data
+DEFAULT_LOAD_WORKERS = len(files)
+
+# Column renames applied when a cleaned source table becomes the table the loaders insert
+table_renames = {
+    "patient_demographics": {"other_fields": "patient_demographics_other_fields"},
+    "patient_visits": {"other_fields": "patients_visits_other_fields"},
+    "patient_lab_results": {"notes": "patient_lab_results_notes"},
+    "patient_medications": {"notes": "patient_medications_notes"}
+}
+
 # Function to modify reference range format (e.g., "5-10" to "5000-10000")
 def modify_range(value):
     if isinstance(value, str) and '-' in value:
@@ -31,78 +95,214 @@ def modify_range(value):
         return f"{start*1000}-{end*1000}"
     return value
 
+# Split "reference_range" values (e.g., "70-110") into numeric min/max Series; unparseable ranges become NaN
+def parse_reference_range(reference_range):
+    # Ranges repeat heavily, so only the distinct values are split and converted
+    codes, uniques = pd.factorize(reference_range)
+    bounds = pd.Series(uniques, dtype="string").str.split("-", n=1, expand=True)
+    if bounds.shape[1] < 2:
+        nan = pd.Series(float("nan"), index=reference_range.index)
+        return nan, nan
+    # Missing ranges have code -1, which selects the trailing NaN row
+    bounds = np.vstack([
+        np.column_stack([
+            pd.to_numeric(bounds[0], errors="coerce").to_numpy(dtype=float, na_value=np.nan),
+            pd.to_numeric(bounds[1], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        ]),
+        [np.nan, np.nan]
+    ])
+    return (pd.Series(bounds[codes, 0], index=reference_range.index),
+            pd.Series(bounds[codes, 1], index=reference_range.index))
+
+# Apply func to each distinct value of a categorical column instead of to each row. Values func maps together
+# are merged into one category, values it maps to NaN become missing, and missing values stay missing.
+def map_categories(series, func):
+    codes, uniques = pd.factorize(pd.Index(series.cat.categories.map(func), dtype=object))
+    row_codes = series.cat.codes.to_numpy()
+    new_codes = np.where(row_codes == -1, -1, np.append(codes, -1)[row_codes])
+    return pd.Series(pd.Categorical.from_codes(new_codes, uniques), index=series.index, name=series.name)
+
+# Uppercase a text value, leaving anything that is not a string as missing (like Series.str.upper)
+def upper_text(value):
+    return value.upper() if isinstance(value, str) else np.nan
+
+# Rewrite the reference ranges of the rows in "mask" with modify_range, once per distinct range, keeping the column
+# categorical. The converted ranges become categories whether or not a row uses them, so partitions agree.
+def convert_categorical_ranges(reference_range, mask):
+    categories = list(reference_range.cat.categories)
+    codes, uniques = pd.factorize(pd.Index(categories + [modify_range(value) for value in categories], dtype=object))
+    kept = np.append(codes[:len(categories)], -1)
+    converted = np.append(codes[len(categories):], -1)
+    row_codes = reference_range.cat.codes.to_numpy()
+    new_codes = np.where(mask, converted[row_codes], kept[row_codes])
+    return pd.Series(pd.Categorical.from_codes(new_codes, uniques), index=reference_range.index, name=reference_range.name)
+
+# Vectorized lab result rules: each rule runs once over the whole column instead of once per row
+def apply_lab_rules(df):
+    # Normalize "result_unit" to uppercase (once per distinct unit when the column is categorical)
+    if isinstance(df["result_unit"].dtype, pd.CategoricalDtype):
+        df["result_unit"] = map_categories(df["result_unit"], upper_text)
+    else:
+        df["result_unit"] = df["result_unit"].str.upper()
+
+    if "reference_range" not in df.columns:
+        return df
+
+    # Parse the reference range once, before any unit conversion
+    min_range, max_range = parse_reference_range(df["reference_range"])
+
+    # For patient_lab_results, set missing notes to "NORMAL", "LOW" or "HIGH" in a single array-level comparison.
+    # The comparison uses the values as read, so it is unaffected by the G/DL -> MG/DL scaling below.
+    if "notes" in df.columns and "result_value" in df.columns:
+        value = df["result_value"]
+        missing_notes = df["notes"].isnull() & value.notnull()
+        df.loc[missing_notes & (value >= min_range) & (value <= max_range), "notes"] = "NORMAL"
+        df.loc[missing_notes & (value < min_range), "notes"] = "LOW"
+        df.loc[missing_notes & (value > max_range), "notes"] = "HIGH"
+
+    # Assumption: For "G/DL" units, convert result_value to "MG/DL" by multiplying by 1000; also update reference_range accordingly
+    g_dl_condition = df["result_unit"] == "G/DL"
+    if isinstance(df["reference_range"].dtype, pd.CategoricalDtype):
+        df["reference_range"] = convert_categorical_ranges(df["reference_range"], g_dl_condition.to_numpy())
+    if g_dl_condition.any():
+        if "result_value" in df.columns:
+            df.loc[g_dl_condition, "result_value"] *= 1000
+        if not isinstance(df["result_unit"].dtype, pd.CategoricalDtype):
+            df.loc[g_dl_condition, "result_unit"] = "MG/DL"
+        if not isinstance(df["reference_range"].dtype, pd.CategoricalDtype):
+            # Lab ranges repeat heavily, so rewrite each distinct range once and map the result back
+            ranges = df.loc[g_dl_condition, "reference_range"]
+            converted = {value: modify_range(value) for value in ranges.dropna().unique()}
+            df.loc[g_dl_condition, "reference_range"] = ranges.map(converted)
+
+    # A categorical unit is rewritten per category, whether or not these rows use it, so that partitions
+    # of a table cleaned separately end up with the same categories
+    if isinstance(df["result_unit"].dtype, pd.CategoricalDtype):
+        df["result_unit"] = map_categories(df["result_unit"], lambda unit: "MG/DL" if unit == "G/DL" else unit)
+
+    return df
+
+# pd.read_csv options for a source file, with the dtypes pandas parses its columns as (see csv_engines.pandas_dtypes)
+def read_options(key):
+    schema = schemas.get(key, {})
+    options = {option: value for option, value in schema.items() if option != "dtype"}
+    options["dtype"] = pandas_dtypes(schema.get("dtype", {}))
+    return options
+
+# Read one source file with its explicit schema and the named parse engine (see csv_engines), materializing only
+# "columns" (all columns when None); returns the frame plus load time and in-memory size, strings included.
+def read_source_file(key, engine=DEFAULT_PARSE_ENGINE, columns=None):
+    file_path = os.path.join(base_path, files[key])
+    start = time.perf_counter()
+    with span("read_file", table=key, engine=engine) as record:
+        df = read_csv(file_path, schemas.get(key, {}).get("dtype", {}), columns, engine)
+        record.update(bytes_read=os.path.getsize(file_path), rows_out=len(df))
+    elapsed = time.perf_counter() - start
+    return df, elapsed, df.memory_usage(deep=True).sum()
+
 # Load CSV files
-def load_data():
+# The files are read concurrently by a thread pool (the CSV parser releases the GIL while tokenizing)
+# "keys" restricts the load to some of the files (all of them by default)
+# "engine" names the parse engine (csv_engines.PARSE_ENGINES); "columns" maps a file's key to the only columns to read
+def load_data(max_workers=DEFAULT_LOAD_WORKERS, keys=None, engine=DEFAULT_PARSE_ENGINE, columns=None):
     data = {}
-    for key, filename in files.items():
-        file_path = os.path.join(base_path, filename)
-        try:
-            data[key] = pd.read_csv(file_path)
-            logging.info(f"Loaded {filename} successfully.")
-        except FileNotFoundError:
-            logging.error(f"File {filename} not found.")
-        except Exception as e:
-            logging.error(f"Error loading {filename}: {e}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {key: executor.submit(read_source_file, key, engine, (columns or {}).get(key))
+                   for key in (files if keys is None else keys)}
+        for key, future in futures.items():
+            filename = files[key]
+            try:
+                data[key], elapsed, memory = future.result()
+                logging.info(f"Loaded {filename} successfully: {len(data[key])} rows in {elapsed:.3f}s, "
+                             f"{memory / 1024 ** 2:.2f} MB in memory.")
+            except FileNotFoundError:
+                logging.error(f"File {filename} not found.")
+            except Exception as e:
+                logging.error(f"Error loading {filename}: {e}")
+    logging.info(f"Loaded {len(data)} files in {time.perf_counter() - start:.3f}s")
     return data
 
+# Fill missing text with "UNKNOWN" and convert it to uppercase.
+# A categorical column is normalized once per distinct value and stays categorical; "UNKNOWN" is always one of
+# its categories, so partitions of a table cleaned separately keep identical categories.
+def normalize_text(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        normalized = map_categories(series, upper_text)
+        if "UNKNOWN" not in normalized.cat.categories:
+            normalized = normalized.cat.add_categories(["UNKNOWN"])
+        return normalized.fillna("UNKNOWN")
+    return series.astype(object).fillna("UNKNOWN").str.upper()
+
+# Strip the "mg" unit from dosages such as "5mg" and convert them to float (once per distinct dosage when categorical)
+def dosage_to_mg(dosage):
+    if isinstance(dosage.dtype, pd.CategoricalDtype):
+        values = np.append(dosage.cat.categories.astype(object).str.replace('mg', '', regex=False).astype(float), np.nan)
+        return pd.Series(values[dosage.cat.codes.to_numpy()], index=dosage.index, name=dosage.name)
+    return dosage.str.replace('mg', '', regex=False).astype(float)
+
+# Ages as numbers, converted once per distinct age when categorical. Values that are not numbers ("unknown", say)
+# become missing, and are then filled with the median like any other missing age.
+def parse_age(age):
+    if isinstance(age.dtype, pd.CategoricalDtype):
+        values = np.append(pd.to_numeric(age.cat.categories.astype(object), errors="coerce").astype(float), np.nan)
+        return pd.Series(values[age.cat.codes.to_numpy()], index=age.index, name=age.name)
+    return pd.to_numeric(age, errors="coerce").astype(float)
+
+# Median age the way clean_data takes it: after removing duplicate rows
+def source_age_median(demographics):
+    return parse_age(demographics.drop_duplicates()["age"]).median()
+
 # Clean data
-def clean_data(data):
+# Each table is timed as a "clean_table" span; ETL_PROFILE_DIR profiles the whole call (see metrics.profiled)
+# "stats" holds values precomputed over the whole source (see compute_stats) so that chunks can be cleaned independently
+@profiled
+def clean_data(data, stats=None):
     
     for key, df in data.items():
         try:
-            # Remove duplicate rows from the data
-            df.drop_duplicates(inplace=True)
-            logging.info(f"Removed duplicates in {key}")
-
-            # Assumption: If a "dosage" column exists (e.g., "5mg"), strip the unit and convert to a numeric float in mg
-            if "dosage" in df.columns:
-                df['dosage'] = df['dosage'].str.replace('mg', '', regex=False).astype(float)
-                df.rename(columns={'dosage': 'dosage_mg'}, inplace=True) # Rename to 'dosage_mg'
-
-            # Assumption: Fill missing age values with the median and convert to integer
-            if "age" in df.columns:
-                df["age"] = df["age"].fillna(df["age"].median()).astype(int)
-
-            for index, row in df.iterrows():
-
-                # Normalize "result_unit" to uppercase if it exists
+            with span("clean_table", table=key) as record:
+                record["rows_in"] = len(df)
+                # Remove duplicate rows from the data
+                df.drop_duplicates(inplace=True)
+                logging.info(f"Removed duplicates in {key}")
+
+                # Assumption: If a "dosage" column exists (e.g., "5mg"), strip the unit and convert to a numeric float in mg
+                if "dosage" in df.columns:
+                    df['dosage'] = dosage_to_mg(df['dosage'])
+                    df.rename(columns={'dosage': 'dosage_mg'}, inplace=True) # Rename to 'dosage_mg'
+
+                # Assumption: Fill missing age values with the median and convert to integer
+                if "age" in df.columns:
+                    age = parse_age(df["age"])
+                    age_median = stats["age_median"] if stats and "age_median" in stats else age.median()
+                    df["age"] = age.fillna(age_median).astype(int)
+
+                # Apply the lab result rules (unit normalization, G/DL conversion and notes) as whole-column operations
                 if "result_unit" in df.columns:
-                    df["result_unit"] = df["result_unit"].str.upper()
-
-                # Assumption: For "G/DL" units, convert result_value to "MG/DL" by multiplying by 1000; also update reference_range accordingly
-                if "result_unit" in df.columns and "reference_range" in df.columns:
-                    g_dl_condition = df["result_unit"] == "G/DL"
-                    
-                    # Update the 'result_unit' column with only mg/dl and update the'result_value' and 'reference_range' accordingly
-                    df.loc[g_dl_condition, "result_value"] *= 1000
-                    df.loc[g_dl_condition, "result_unit"] = "MG/DL"
-                    df.loc[g_dl_condition, "reference_range"] = df.loc[g_dl_condition, "reference_range"].apply(modify_range)
-                
-                # For patient_lab_results, set notes to "NORMAL", "LOW", or "HIGH" based on reference_range comparison
-                if key == "patient_lab_results" and pd.notnull(row["result_value"]) and "reference_range":
-                    if pd.isnull(row["notes"]):
-                        min_range, max_range = map(int, row["reference_range"].split("-"))
-                        if min_range <= row["result_value"] <= max_range:
-                            df.at[index, "notes"] = "NORMAL"
-                        elif row["result_value"] < min_range:
-                            df.at[index, "notes"] = "LOW"
-                        elif row["result_value"] > max_range:
-                           df.at[index, "notes"] = "HIGH"
-
-            # Convert date fields to standard format
-            for date_column in ['test_date', 'start_date', 'end_date', 'assignment_date']:
-                if date_column in df.columns:
-                    df[date_column] = pd.to_datetime(df[date_column], errors='coerce').dt.strftime('%Y-%m-%d')
+                    df = apply_lab_rules(df)
+
+                # Parse the date columns into datetime64, once per distinct date, with the format detected for the column
+                # (or given in stats["date_formats"]). Values that are not valid dates become missing and are counted.
+                invalid_dates = {}
+                for date_column in DATE_COLUMNS:
+                    if date_column in df.columns:
+                        date_format = stats.get("date_formats", {}).get(date_column) if stats else None
+                        df[date_column], invalid_dates[date_column] = parse_dates(df[date_column], date_format)
+                        if invalid_dates[date_column]:
+                            logging.warning(f"{invalid_dates[date_column]} invalid dates in {key}.{date_column} set to missing")
+                record["invalid_dates"] = sum(invalid_dates.values())
             
-            # Assumption: Fill missing string values with "UNKNOWN" and convert to uppercase
-            for col in df.select_dtypes(include=['object']).columns:
-                df[col] = df[col].fillna("UNKNOWN").str.upper()
+                # Assumption: Fill missing string values with "UNKNOWN" and convert to uppercase
+                for col in df.select_dtypes(include=['object', 'category']).columns:
+                    df[col] = normalize_text(df[col])
 
-            # Assumption: Fill missing numeric values with placeholder -999
-            for col in df.select_dtypes(include=['number']).columns:
-                df[col] = df[col].fillna(-999)
+                # Assumption: Fill missing numeric values with placeholder -999
+                for col in df.select_dtypes(include=['number']).columns:
+                    df[col] = df[col].fillna(-999)
        
-            logging.info(f"Cleaned data for {key}")
+                logging.info(f"Cleaned data for {key}")
+                record["rows_out"] = len(df)
 
         except Exception as e:
             logging.error(f"Error cleaning data for {key}: {e}")
@@ -112,6 +312,107 @@ def clean_data(data):
     return data
 
 
+# Default number of rows per partition when clean_data runs on a process pool
+DEFAULT_PARTITION_ROWS = 250_000
+
+# Directory for the Arrow files exchanged with the clean workers, memory-backed (/dev/shm) where available
+def make_exchange_dir():
+    return tempfile.mkdtemp(prefix="etl_clean_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+# Write a frame, index included, as an Arrow IPC file
+def write_arrow_frame(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+# Read a frame written by write_arrow_frame, mapping the file instead of copying it in
+def read_arrow_frame(path):
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+# Worker of clean_data_parallel: clean one partition of a table and write the result next to it
+def clean_partition(key, path, stats):
+    cleaned = clean_data({key: read_arrow_frame(path)}, stats)[key]
+    result_path = f"{path}.cleaned"
+    write_arrow_frame(cleaned, result_path)
+    return result_path
+
+# Split a table into at most "partitions" non-empty parts by row hash, so that identical rows,
+# which clean_data deduplicates, always land in the same part
+def split_partitions(df, partitions):
+    if partitions <= 1:
+        return [df]
+    bucket = pd.util.hash_pandas_object(df, index=False).to_numpy() % partitions
+    return [part for part in (df[bucket == index] for index in range(partitions)) if len(part)]
+
+# Clean data on a process pool: tables are cleaned concurrently, and tables over partition_rows rows are split
+# into partitions cleaned in parallel. Statistics over a whole table (the median age, the date formats) are computed here first
+# and passed to every worker. Frames move as Arrow IPC files in shared memory rather than as pickles,
+# and each table's partitions are put back in their original row order, so the result matches clean_data.
+def clean_data_parallel(data, stats=None, max_workers=None, partition_rows=DEFAULT_PARTITION_ROWS):
+    stats = dict(stats or {})
+    if "patient_demographics" in data and "age_median" not in stats:
+        stats["age_median"] = source_age_median(data["patient_demographics"])
+    # Every partition parses a date column with the format detected on the whole column
+    if "date_formats" not in stats:
+        stats["date_formats"] = {column: detect_date_format(distinct_values(df[column])[0])
+                                 for df in data.values() for column in DATE_COLUMNS if column in df.columns}
+
+    exchange_dir = make_exchange_dir()
+    cleaned = {}
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for key, df in data.items():
+                futures[key] = []
+                for index, part in enumerate(split_partitions(df, -(-len(df) // partition_rows))):
+                    path = os.path.join(exchange_dir, f"{key}.{index}.arrow")
+                    write_arrow_frame(part, path)
+                    futures[key].append(executor.submit(clean_partition, key, path, stats))
+                logging.info(f"Cleaning {key} in {len(futures[key])} partitions")
+            for key, parts in futures.items():
+                try:
+                    cleaned[key] = pd.concat([read_arrow_frame(future.result()) for future in parts]).sort_index()
+                except Exception as e:
+                    logging.error(f"Error cleaning data for {key} in parallel: {e}")
+    finally:
+        shutil.rmtree(exchange_dir, ignore_errors=True)
+
+    return cleaned
+
+# Derive 'age_group' from 'age' values
+def derive_age_group(age):
+    return pd.Series(np.select([age <= 35, age <= 65], ['18-35', '36-65'], '65+'), index=age.index, dtype=object)
+
+# Count the visits of each patient
+def count_visits(visits):
+    return visits.groupby("patient_id", observed=True)["visit_id"].count()
+
+# Shape one cleaned source table into the table the loaders insert, adding the columns derived for it:
+# 'age_group' on patient_demographics and 'visit_frequency' (from visit_counts) on patient_visits
+def shape_table(key, df, visit_counts):
+    df = df.rename(columns=table_renames.get(key, {}))
+    if key == "patient_demographics":
+        df["age_group"] = derive_age_group(df["age"])
+    if key == "patient_visits":
+        df["visit_frequency"] = df["patient_id"].map(visit_counts).fillna(0).astype(int)
+    return df
+
+# Build the five cleaned tables directly. Unlike merge_data there is no fan-out join:
+# each table keeps one row per source row, and the derived columns are computed on the table they belong to.
+# "visit_counts" overrides the counts taken from data["patient_visits"], for when data only holds some of the visits
+def build_tables(data, visit_counts=None):
+    if visit_counts is None:
+        visit_counts = count_visits(data["patient_visits"]) if "patient_visits" in data else pd.Series(dtype="int64")
+    tables = {}
+    for key, df in data.items():
+        try:
+            tables[key] = shape_table(key, df, visit_counts)
+        except Exception as e:
+            logging.error(f"Error building table {key}: {e}")
+    logging.info("Built cleaned tables: " + ", ".join(f"{key} ({len(df)} rows)" for key, df in tables.items()))
+    return tables
+
 # Merge datasets
 def merge_data(data):
     try:
@@ -135,10 +436,10 @@ def merge_data(data):
         merged_data = merged_data.rename(columns={"notes_x": "patient_lab_results_notes", "notes_y": "patient_medications_notes"})
         
         # Derive 'age_group' column from 'age' values
-        merged_data['age_group'] = merged_data['age'].apply(lambda x: '18-35' if x <= 35 else '36-65' if x <= 65 else '65+')
+        merged_data['age_group'] = derive_age_group(merged_data['age'])
 
         # Calculate visit frequency per patient
-        visit_counts = data["patient_visits"].groupby("patient_id")["visit_id"].count().reset_index()
+        visit_counts = count_visits(data["patient_visits"]).reset_index()
         visit_counts.rename(columns={"visit_id": "visit_frequency"}, inplace=True)
 
         # Derive 'visit frequency' column from calculated visit frequency 
@@ -154,34 +455,338 @@ def merge_data(data):
 
     return merged_data
 
-# Save cleaned and merged data
-def save_data(merged_data):
-    output_path = os.path.join(base_path, "cleaned_data.csv")
+# Count the visits of each patient from raw patient_visits rows, the way build_tables counts them after clean_data
+# (duplicate rows dropped, missing IDs filled and uppercased)
+def count_source_visits(visits):
+    visits = visits.drop_duplicates()
+    return count_visits(pd.DataFrame({"patient_id": normalize_text(visits["patient_id"]),
+                                      "visit_id": normalize_text(visits["visit_id"])}))
+
+# Work out which source rows need cleaning, comparing the source files with the state of the last run.
+# Unchanged files (same SHA-256) are not read. A changed file is read and hashed row by row, and only its rows
+# whose content hash is new are kept, plus the rows whose derived values changed with the rest of the file:
+# patient_demographics rows with a missing age when the median age moved, and all the visits of a patient
+# whose visit count changed (visit_frequency). full_rebuild ignores the stored state and keeps every row.
+# Returns the rows to clean, the stats and visit counts to clean and shape them with, the new state and a report.
+def detect_changes(full_rebuild=False, parse_engine=DEFAULT_PARSE_ENGINE):
+    state = {"files": {}} if full_rebuild else load_state(state_path)
+    fingerprints = {key: file_fingerprint(os.path.join(base_path, filename)) for key, filename in files.items()}
+    changed_files = [key for key in files
+                     if full_rebuild or fingerprints[key] is None or state["files"].get(key, {}).get("sha256") != fingerprints[key]]
+    data = load_data(keys=changed_files, engine=parse_engine)
+
+    new_state = {"files": {key: state["files"][key] for key in files if key not in changed_files and key in state["files"]},
+                 "age_median": state.get("age_median")}
+    report = {key: {"rows": new_state["files"][key]["rows"], "skipped": new_state["files"][key]["rows"], "processed": 0}
+              for key in new_state["files"]}
+    hashes = {}
+    changes = {}
+    deleted = {}
+    for key, df in data.items():
+        hashes[key] = hash_frame(df, natural_keys[key], row_hashes(df))
+        previous = None if full_rebuild else read_state_frame(key, state_path)
+        changes[key], counts = classify_rows(df, natural_keys[key], hashes[key]["row_hash"].to_numpy(), previous)
+        deleted[key] = cleaned_deleted_keys(df, natural_keys[key], previous)
+        report[key] = {"rows": len(df), **counts}
+        new_state["files"][key] = {"sha256": fingerprints[key], "rows": len(df)}
+
+    stats = {}
+    if "patient_demographics" in data:
+        age = parse_age(data["patient_demographics"]["age"])
+        stats["age_median"] = float(source_age_median(data["patient_demographics"]))
+        if stats["age_median"] != state.get("age_median"):
+            changes["patient_demographics"] |= age.isna().to_numpy()
+        new_state["age_median"] = stats["age_median"]
+
+    visit_counts = None
+    if "patient_visits" in data:
+        visits = data["patient_visits"]
+        visit_counts = count_source_visits(visits)
+        previous_counts = None if full_rebuild else read_state_frame("visit_counts", state_path)
+        if previous_counts is not None:
+            # Outer-aligned on patient_id, so patients that appeared or disappeared count as moved too
+            aligned = pd.concat([visit_counts, previous_counts.set_index("patient_id")["visit_count"]], axis=1)
+            moved = aligned.index[aligned.iloc[:, 0].ne(aligned.iloc[:, 1])]
+            changes["patient_visits"] |= normalize_text(visits["patient_id"]).isin(moved).to_numpy()
+        hashes["visit_counts"] = visit_counts.rename("visit_count").rename_axis("patient_id").reset_index()
+
+    delta = {}
+    for key, df in data.items():
+        delta[key] = df[changes[key]].copy()
+        report[key]["processed"] = len(delta[key])
+        report[key]["skipped"] = len(df) - len(delta[key])
+    report = {key: report[key] for key in files if key in report}
+    return {"data": delta, "stats": stats, "visit_counts": visit_counts, "state": new_state, "hashes": hashes, "report": report,
+            "deleted": deleted}
+
+# The natural IDs of the rows deleted from a source table since the last run, normalized the way clean_data writes
+# them. An ID that is still in the table once normalized (only its case changed, say) is not deleted.
+def cleaned_deleted_keys(df, keys, previous):
+    deleted = deleted_keys(df, keys, previous)
+    if deleted.empty:
+        return deleted
+    def normalize(frame):
+        return frame.apply(lambda column: normalize_text(column.astype(object)).astype(object))
+    deleted = normalize(deleted).drop_duplicates()
+    still_present = np.isin(row_hashes(deleted), row_hashes(normalize(df[keys])))
+    return deleted[~still_present].reset_index(drop=True)
+
+# Record the state of this run, once its tables are saved. It is written to the pending state directory and only
+# becomes the state the next run compares against when a loader has loaded the tables (see
+# change_detection.commit_pending_state), so a run that is never loaded does not lose its changes.
+def commit_changes(changes, tables):
+    pending = pending_state_dir(state_path)
+    clear_pending_state(state_path)
+    for key, df in changes["hashes"].items():
+        write_state_frame(df, key, pending)
+    for key, df in tables.items():
+        changes["state"]["files"][key]["columns"] = list(df.columns)
+    save_state(changes["state"], pending)
+
+# Save the tables of an incremental run. Tables whose source file did not change are written empty
+# (with the columns of their last run) so the loaders never pick up rows of an earlier run twice.
+# The natural IDs of the rows deleted since the last run are written next to them, for the loaders to delete.
+def save_changed_tables(changes, tables, export_csv=False):
+    skipped = {key: pd.DataFrame(columns=changes["state"]["files"][key].get("columns", []))
+               for key in changes["state"]["files"] if key not in tables}
+    save_tables({**tables, **skipped}, export_csv=export_csv)
+    for key in changes["state"]["files"]:
+        write_deleted_keys(changes["deleted"].get(key), key, tables_path)
+
+# Print how many rows of each table were skipped and processed
+def print_change_report(report):
+    print(f"{'table':<24} {'rows':>10} {'skipped':>10} {'processed':>10}")
+    for key, counts in report.items():
+        print(f"{key:<24} {counts['rows']:>10} {counts['skipped']:>10} {counts['processed']:>10}")
+        logging.info(f"Change detection for {key}: {counts['skipped']} rows skipped, {counts['processed']} processed "
+                     + ", ".join(f"{name} {counts[name]}" for name in ("new", "changed", "unchanged", "deleted") if name in counts))
+
+# Save cleaned and merged data as Parquet; the CSV export is only written when export_csv is set
+def save_data(merged_data, export_csv=False):
     try:
-        merged_data.to_csv(output_path, index=False)
-        logging.info(f"Cleaned data saved to {output_path}")
+        write_parquet(merged_data, CLEANED_DATA_PARQUET)
+        add_to_span("bytes_written", os.path.getsize(CLEANED_DATA_PARQUET))
+        logging.info(f"Cleaned data saved to {CLEANED_DATA_PARQUET}")
+        if export_csv:
+            merged_data.to_csv(CLEANED_DATA_CSV, index=False)
+            add_to_span("bytes_written", os.path.getsize(CLEANED_DATA_CSV))
+            logging.info(f"Cleaned data exported to {CLEANED_DATA_CSV}")
     except Exception as e:
         logging.error(f"Error saving cleaned data: {e}")
 
+# Save each cleaned table to data/cleaned/<table>.parquet (plus a CSV export when export_csv is set)
+def save_tables(tables, export_csv=False):
+    for key, df in tables.items():
+        try:
+            with span("save_table", table=key) as record:
+                write_table(df, key, tables_path, export_csv=export_csv)
+                record["rows_in"] = len(df)
+                for extension in ("parquet", "csv"):
+                    if os.path.exists(table_file(key, extension, tables_path)):
+                        add_to_span("bytes_written", os.path.getsize(table_file(key, extension, tables_path)))
+            logging.info(f"Cleaned table {key} saved to {table_file(key, 'parquet', tables_path)}")
+        except Exception as e:
+            logging.error(f"Error saving cleaned table {key}: {e}")
+
+# Read a source file in chunks of at most chunk_size rows
+def read_chunks(key, chunk_size, **kwargs):
+    file_path = os.path.join(base_path, files[key])
+    return pd.read_csv(file_path, chunksize=chunk_size, **read_options(key), **kwargs)
+
+# Drop rows of a chunk that were already seen in this chunk or an earlier one.
+# "seen" holds the hashes of the rows kept so far (8 bytes per distinct row) as a list of sorted runs, and the
+# updated list is returned; start with an empty list. Each chunk adds one run and the newest runs are merged while
+# the last is at least half the size of the one before, so there are O(log n) runs to search and each hash is only
+# merged O(log n) times, instead of the whole array being copied for every chunk.
+# The kept rows are returned as a copy, as clean_data assigns to the chunk's columns in place.
+def drop_seen_duplicates(chunk, seen):
+    hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+    # Looking the hashes up in sorted order walks each run front to back instead of jumping around it
+    order = np.argsort(hashes, kind="stable")
+    sorted_hashes = hashes[order]
+    already_seen = np.zeros(len(hashes), dtype=bool)
+    for run in seen:
+        positions = np.minimum(np.searchsorted(run, sorted_hashes), len(run) - 1)
+        already_seen[order] |= run[positions] == sorted_hashes
+    keep = ~already_seen & ~pd.Series(hashes).duplicated().to_numpy()
+    seen = seen + [np.sort(hashes[keep])]
+    while len(seen) > 1 and 2 * len(seen[-1]) >= len(seen[-2]):
+        seen = seen[:-2] + [np.sort(np.concatenate(seen[-2:]), kind="stable")]
+    return chunk[keep].copy(), seen
+
+# Median of a discrete distribution given as a Series of counts indexed by value
+def median_from_counts(counts):
+    counts = counts[counts > 0].sort_index()
+    total = counts.sum()
+    if total == 0:
+        return float("nan")
+    cumulative = counts.cumsum()
+    lower = counts.index[np.searchsorted(cumulative.to_numpy(), (total + 1) // 2)]
+    upper = counts.index[np.searchsorted(cumulative.to_numpy(), total // 2 + 1)]
+    return (lower + upper) / 2
+
+# Detect the format of every date column from the distinct values of the first chunk of its file, so the chunks
+# of a streaming run parse a column with one format rather than each detecting it again
+def detect_chunk_date_formats(chunk_size=DEFAULT_CHUNK_SIZE):
+    date_formats = {}
+    for key in files:
+        try:
+            with read_chunks(key, chunk_size, usecols=lambda column: column in DATE_COLUMNS) as reader:
+                first = next(reader, None)
+        except FileNotFoundError:
+            continue
+        if first is not None:
+            date_formats.update({column: detect_date_format(distinct_values(first[column])[0]) for column in first.columns})
+    return date_formats
+
+# Cheap first pass over the sources: compute the statistics clean_data needs from the whole file.
+# Ages are integers, so an exact median only needs a count per distinct age, not the ages themselves.
+def compute_stats(chunk_size=DEFAULT_CHUNK_SIZE):
+    age_counts = pd.Series(dtype="int64")
+    seen = []
+    for chunk in read_chunks("patient_demographics", chunk_size):
+        # Match clean_data, which takes the median after removing duplicate rows
+        chunk, seen = drop_seen_duplicates(chunk, seen)
+        age_counts = age_counts.add(parse_age(chunk["age"]).value_counts(), fill_value=0)
+
+    # Visits per (cleaned) patient_id, for the 'visit_frequency' column of patient_visits
+    visit_counts = pd.Series(dtype="int64")
+    seen = []
+    for chunk in read_chunks("patient_visits", chunk_size):
+        chunk, seen = drop_seen_duplicates(chunk, seen)
+        visit_counts = visit_counts.add(normalize_text(chunk["patient_id"]).value_counts(), fill_value=0)
+
+    stats = {"age_median": median_from_counts(age_counts), "visit_counts": visit_counts.astype(int),
+             "date_formats": detect_chunk_date_formats(chunk_size)}
+    logging.info(f"Computed streaming statistics: median age {stats['age_median']}, {len(visit_counts)} patients with visits")
+    return stats
+
+# Streaming mode: clean each source file chunk by chunk and append the shaped table to data/cleaned/<table>.csv.
+# Memory holds one chunk plus the row hashes that detect duplicates across chunks (8 bytes per distinct row of
+# the file, see drop_seen_duplicates); merging needs whole tables, so the merged view is not built here.
+# Each chunk is validated on its own, and its rejected rows appended to the table's quarantine CSV; foreign keys and
+# primary keys repeated across chunks need whole tables, so they are left to the database.
+def run_streaming(chunk_size=DEFAULT_CHUNK_SIZE):
+    stats = compute_stats(chunk_size)
+    rules = schema_rules()
+    os.makedirs(tables_path, exist_ok=True)
+    os.makedirs(quarantine_path, exist_ok=True)
+
+    for key in files:
+        output_path = table_file(key, "csv", tables_path)
+        try:
+            with span("stream_table", table=key) as record:
+                clear_table(key, tables_path)
+                clear_table(key, quarantine_path)
+                seen = []
+                rows_read, rows_written, rows_quarantined = 0, 0, 0
+                for index, chunk in enumerate(read_chunks(key, chunk_size)):
+                    rows_read += len(chunk)
+                    chunk, seen = drop_seen_duplicates(chunk, seen)
+                    cleaned = shape_table(key, clean_data({key: chunk}, stats)[key], stats["visit_counts"])
+                    valid, quarantined, _ = validate_tables({key: cleaned}, rules, check_foreign_keys=False)
+                    cleaned = valid[key]
+                    cleaned.to_csv(output_path, mode="w" if index == 0 else "a", header=index == 0, index=False)
+                    if len(quarantined.get(key, [])):
+                        quarantine_file = table_file(key, "csv", quarantine_path)
+                        quarantined[key].to_csv(quarantine_file, mode="a", header=not os.path.exists(quarantine_file), index=False)
+                        rows_quarantined += len(quarantined[key])
+                    rows_written += len(cleaned)
+                record.update(rows_in=rows_read, rows_out=rows_written, bytes_read=os.path.getsize(os.path.join(base_path, files[key])),
+                              bytes_written=os.path.getsize(output_path) if os.path.exists(output_path) else 0)
+            logging.info(f"Streamed {key}: {rows_read} rows read, {rows_written} rows written to {output_path}, {rows_quarantined} quarantined")
+        except FileNotFoundError:
+            logging.error(f"File {files[key]} not found.")
+        except Exception as e:
+            logging.error(f"Error streaming {key}: {e}")
 
-def main():
 
-    logging.info("ETL pipeline started.")
-    
-    print("Loading data...")
-    data = load_data()
-    
-    print("Cleaning data...")
-    cleaned_data = clean_data(data)
+# Total rows over a dict of tables
+def count_rows(data):
+    return sum(len(df) for df in data.values())
 
-    print("Merging data...")
+# workers > 1 cleans on a process pool of that many processes (see clean_data_parallel)
+# parse_engine names the engine the source files are parsed with in batch mode (streaming reads chunks with pandas)
+# Every stage is timed as a span in logs/metrics.jsonl (see metrics.span), inside one "etl_pipeline" span for the run
+def main(streaming=False, chunk_size=DEFAULT_CHUNK_SIZE, export_csv=False, wide=False, full_rebuild=False,
+         workers=1, partition_rows=DEFAULT_PARTITION_ROWS, parse_engine=DEFAULT_PARSE_ENGINE):
 
-    merged_data = merge_data(cleaned_data)
-    
-    print("Saving cleaned data...")
-    save_data(merged_data)
+    logging.info("ETL pipeline started.")
+    start_metrics_server()
+
+    with span("etl_pipeline", mode="streaming" if streaming else "batch"):
+        if streaming:
+            print(f"Streaming data in chunks of {chunk_size} rows...")
+            run_streaming(chunk_size)
+            write_tables_manifest(tables_path, delta=False)
+            # Streaming records no state, so loading its tables must not commit the state of an earlier batch run
+            clear_pending_state(state_path)
+            logging.info("ETL pipeline (streaming) completed successfully.")
+            return
+
+        # The wide merged view needs every row, so it always comes from a full rebuild
+        full_rebuild = full_rebuild or wide
+
+        print("Loading data...")
+        with span("detect_changes") as record:
+            changes = detect_changes(full_rebuild=full_rebuild, parse_engine=parse_engine)
+            record.update(rows_in=sum(counts["rows"] for counts in changes["report"].values()), rows_out=count_rows(changes["data"]),
+                          bytes_read=sum(os.path.getsize(os.path.join(base_path, files[key])) for key in changes["data"]))
+
+        print("Cleaning data...")
+        with span("clean_data", workers=workers) as record:
+            record["rows_in"] = count_rows(changes["data"])
+            if workers > 1:
+                cleaned_data = clean_data_parallel(changes["data"], changes["stats"], max_workers=workers, partition_rows=partition_rows)
+            else:
+                cleaned_data = clean_data(changes["data"], changes["stats"])
+            record["rows_out"] = count_rows(cleaned_data)
+
+        print("Saving cleaned tables...")
+        with span("build_tables") as record:
+            tables = build_tables(cleaned_data, changes["visit_counts"])
+            record.update(rows_in=count_rows(cleaned_data), rows_out=count_rows(tables))
+        # The tables only replace the database tables when no row was skipped
+        delta = any(counts["skipped"] for counts in changes["report"].values())
+        with span("validate_tables") as record:
+            record["rows_in"] = count_rows(tables)
+            # A delta run's parents may already be in the database, so only full runs check foreign keys
+            tables, quarantined, validation_report = validate_tables(tables, check_foreign_keys=not delta)
+            write_quarantine(quarantined, quarantine_path, export_csv=export_csv)
+            record["rows_out"] = count_rows(tables)
+        with span("save_tables") as record:
+            record["rows_in"] = count_rows(tables)
+            save_changed_tables(changes, tables, export_csv=export_csv)
+            write_tables_manifest(tables_path, delta=delta)
+            commit_changes(changes, tables)
+        print_change_report(changes["report"])
+        print_validation_report(validation_report)
+
+        # The wide merged view is only built on demand: its fan-out join multiplies rows per visit
+        if wide:
+            print("Merging data...")
+            with span("merge_data") as record:
+                merged_data = merge_data(cleaned_data)
+                record.update(rows_in=count_rows(cleaned_data), rows_out=len(merged_data))
+
+            print("Saving cleaned data...")
+            with span("save_data") as record:
+                record["rows_in"] = len(merged_data)
+                save_data(merged_data, export_csv=export_csv)
 
     logging.info("ETL pipeline (Load, Transform) completed successfully.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Clinical data ETL pipeline")
+    parser.add_argument("--streaming", action="store_true", help="Clean each source file in bounded chunks and write per-table files to data/cleaned/")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per chunk in streaming mode")
+    parser.add_argument("--csv", action="store_true", help="Also export the cleaned data as CSV next to the Parquet files")
+    parser.add_argument("--wide", action="store_true", help="Also build the wide merged view in data/cleaned_data.parquet")
+    parser.add_argument("--full-rebuild", action="store_true", help="Ignore the change-detection state and process every source row")
+    parser.add_argument("--workers", type=int, default=1, help="Clean on a process pool with this many processes")
+    parser.add_argument("--partition-rows", type=int, default=DEFAULT_PARTITION_ROWS, help="Rows per partition when cleaning on a process pool")
+    parser.add_argument("--parse-engine", choices=list(PARSE_ENGINES), default=DEFAULT_PARSE_ENGINE,
+                        help="Parse the source files with pandas' single-threaded reader or Arrow's multithreaded, memory-mapped one")
+    args = parser.parse_args()
+    main(streaming=args.streaming, chunk_size=args.chunk_size, export_csv=args.csv, wide=args.wide, full_rebuild=args.full_rebuild,
+         workers=args.workers, partition_rows=args.partition_rows, parse_engine=args.parse_engine)
\ No newline at end of file
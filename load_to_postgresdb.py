@@ -1,12 +1,23 @@
 import pandas as pd
 import logging
 import os
-from sqlalchemy import Date, Float, Integer, String, create_engine
+import time
+import argparse
+from sqlalchemy import Date, Float, Integer, String
 from dotenv import load_dotenv
+from change_detection import commit_pending_state
+from cleaned_data_io import read_deleted_keys, read_table, table_source_path, tables_are_delta
+from metrics import profiled, span, start_metrics_server
+from visit_summaries import sync_visit_summaries
+from bulk_load import DEFAULT_BACKEND, DEFAULT_BATCH_SIZE, DEFAULT_MODE, LOAD_BACKENDS, LOAD_MODES, append_table, delete_rows, drop_duplicate_keys, replace_table, upsert_table
+from deferred_load import BUILD_WORKERS, finish_deferred_load, prepare_deferred_load
 
 # Load environment variables
 load_dotenv()
 
+# Imported after load_dotenv so the pool settings (DB_POOL_SIZE, ...) can come from .env
+from engine_registry import get_engine
+
 # Ensure logs directory exists
 log_dir = "logs"
 os.makedirs(log_dir, exist_ok=True)
@@ -18,13 +29,9 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-# Load the cleaned and transformed data
-try:
-    final_data = pd.read_csv('data/cleaned_data.csv')
-    logging.info("Successfully loaded cleaned_data.csv")
-except Exception as e:
-    logging.error(f"Error loading cleaned_data.csv: {e}")
-    raise
+# Cleaned and transformed data. When left as None, each table reads only its own columns from
+# data/cleaned/<table>.parquet (or the wide data/cleaned_data file); set it to a DataFrame to load from memory instead.
+final_data = None
 
 # Use env variables for Postgres DB connection
 user = os.getenv("POSTGRES_USER")
@@ -34,25 +41,66 @@ port = os.getenv("POSTGRES_PORT")
 db = os.getenv("POSTGRES_DB")
 
 db_url = f"postgresql://{user}:{password}@{host}:{port}/{db}"
-try:
-    engine = create_engine(db_url)
-    logging.info("Database connection established successfully.")
-except Exception as e:
-    logging.error(f"Database connection error: {e}")
-    raise
+
+# Engine the tables are loaded into. When left as None, the pooled engine for db_url is created on first use
+# (see connect), so importing this module neither reads data nor builds an engine; set it to an Engine to load elsewhere.
+engine = None
+
+# Return the engine to load into, creating the pooled engine on first use
+def connect():
+    if engine is not None:
+        return engine
+    try:
+        return get_engine("postgres", db_url)
+    except Exception as e:
+        logging.error(f"Database connection error: {e}")
+        raise
 
 # Define a function to load data into any table
-def load_data_to_table(table_name, columns, dtype_mapping, primary_keys=None):
+# backend selects COPY ("copy") or pandas' INSERT path ("insert"); rows are sent batch_size at a time.
+# mode "replace" recreates the table, mode "upsert" merges the rows into it by primary_keys,
+# mode "deferred" appends the rows to the bare table prepared by prepare_deferred_load (see main).
+# Returns the number of rows inserted, updated, left unchanged and deleted (None if the load failed).
+# Timed as a "load_table" span (metrics.span); the COPY batches add the bytes they send to it.
+@profiled
+def load_data_to_table(table_name, columns, dtype_mapping, primary_keys=None, backend=DEFAULT_BACKEND, batch_size=DEFAULT_BATCH_SIZE, mode=DEFAULT_MODE):
     try:
-        data = final_data[columns]
+        with span("load_table", table=table_name, target="postgres") as record:
+            data = final_data[columns] if final_data is not None else read_table(table_name, columns)
+            record.update(rows_in=len(data), bytes_read=None if final_data is not None else os.path.getsize(table_source_path(table_name)))
+            logging.info(f"Read {len(data)} rows for {table_name}")
+
+            # An incremental ETL run only wrote the changed rows: replacing the table with them would drop the rest
+            if final_data is None and mode == "replace" and tables_are_delta():
+                logging.warning(f"The cleaned tables only hold changed rows; upserting {table_name} instead of replacing it")
+                mode = "upsert"
         
-        if primary_keys:
-            data = data.dropna(subset=primary_keys)
-            data = data.drop_duplicates()
+            if primary_keys:
+                data = data.dropna(subset=primary_keys)
+                data = data.drop_duplicates()
 
-        # Insert data into the table
-        data.to_sql(table_name, engine, if_exists='replace', index=False, dtype=dtype_mapping)
-        logging.info(f"Data inserted successfully into {table_name}")
+            # Insert data into the table
+            if mode == "upsert":
+                counts = upsert_table(data, table_name, connect(), dtype_mapping, primary_keys, batch_size=batch_size)
+            elif mode == "deferred":
+                # The primary key is built after the load, and a duplicate key would stop it: keep the last row per key
+                if primary_keys:
+                    data = drop_duplicate_keys(data, table_name, primary_keys)
+                append_table(data, table_name, connect(), backend=backend, batch_size=batch_size)
+                counts = {"inserted": len(data), "updated": 0, "unchanged": 0}
+            else:
+                replace_table(data, table_name, connect(), dtype_mapping, backend=backend, batch_size=batch_size,
+                              primary_keys=primary_keys)
+                counts = {"inserted": len(data), "updated": 0, "unchanged": 0}
+            # An incremental ETL run lists the keys of the rows deleted from the sources since the last load
+            counts["deleted"] = 0
+            if final_data is None and mode == "upsert" and tables_are_delta():
+                deleted = read_deleted_keys(table_name)
+                if deleted is not None and primary_keys:
+                    counts["deleted"] = delete_rows(deleted, table_name, connect(), primary_keys)
+            record.update(rows_out=counts["inserted"] + counts["updated"], mode=mode)
+            logging.info(f"Data inserted successfully into {table_name}")
+            return counts
     except Exception as e:
         logging.error(f"Error inserting data into {table_name}: {e}")
 
@@ -112,9 +160,75 @@ physician_assignments_dtype = {
     'department': String(255)
 }
 
+# Tables in load order: every table is loaded after the tables its foreign keys reference
+LOAD_TABLES = ['patient_demographics', 'patient_visits', 'patient_lab_results', 'patient_medications', 'physician_assignments']
+
+# Load every cleaned table and print how many rows each one inserted, updated and left unchanged.
+# The entry point of the script: nothing is read or connected before it runs.
+# In "deferred" mode the tables are first created from sql/schema.sql and stripped of their keys, constraints and
+# indexes (optionally made UNLOGGED); after the load these are rebuilt in bulk on build_workers connections
+# (see deferred_load) and the time of each phase is printed.
+def main(backend=DEFAULT_BACKEND, batch_size=DEFAULT_BATCH_SIZE, mode=DEFAULT_MODE, unlogged=False, build_workers=BUILD_WORKERS):
+    load_report = {}
+    phases = {}
+    start_metrics_server()
+
+    # An incremental ETL run only wrote the changed rows: recreating the tables for them would drop the rest
+    if mode == "deferred" and final_data is None and tables_are_delta():
+        logging.warning("The cleaned tables only hold changed rows; upserting them instead of a deferred load")
+        mode = "upsert"
+    if mode == "deferred":
+        start = time.perf_counter()
+        deferred = prepare_deferred_load(connect(), LOAD_TABLES, unlogged=unlogged)
+        phases["prepare_tables"] = time.perf_counter() - start
+    load_options = {"backend": backend, "batch_size": batch_size, "mode": mode}
+
+    start = time.perf_counter()
+    load_report['patient_demographics'] = load_data_to_table('patient_demographics', patient_demographics_columns, patient_demographics_dtype, primary_keys=['patient_id'], **load_options)
+    load_report['patient_visits'] = load_data_to_table('patient_visits', patient_visits_columns, patient_visits_dtype, primary_keys=['visit_id'], **load_options)
+    load_report['patient_lab_results'] = load_data_to_table('patient_lab_results', patient_lab_results_columns, patient_lab_results_dtype, primary_keys=['lab_test_id'], **load_options)
+    load_report['patient_medications'] = load_data_to_table('patient_medications', patient_medications_columns, patient_medications_dtype, primary_keys=['medication_id'], **load_options)
+    load_report['physician_assignments'] = load_data_to_table('physician_assignments', physician_assignments_columns, physician_assignments_dtype, primary_keys=['patient_id', 'visit_id', 'physician_id'], **load_options)
+    phases["load"] = time.perf_counter() - start
+
+    if mode == "deferred":
+        deferred_phases, failures = finish_deferred_load(connect(), LOAD_TABLES, deferred, unlogged=unlogged, workers=build_workers)
+        phases.update(deferred_phases)
+        print(f"{'phase':<24} {'seconds':>10}")
+        for phase, seconds in phases.items():
+            print(f"{phase:<24} {seconds:>10.2f}")
+        for failure in failures:
+            print(f"Could not restore {failure['object']}: {failure['error']}")
+
+    # The reports read summaries of patient_visits: the triggers have applied an upsert to them already,
+    # and a replace or deferred load (which recreates the table without the triggers) rebuilds them
+    if load_report['patient_visits'] is not None:
+        try:
+            sync_visit_summaries(connect())
+        except Exception as e:
+            logging.error(f"Error updating the visit summaries: {e}")
+
+    # Report how many rows each table inserted, updated, left unchanged and deleted
+    print(f"{'table':<24} {'inserted':>10} {'updated':>10} {'unchanged':>10} {'deleted':>10}")
+    for table_name, counts in load_report.items():
+        if counts is None:
+            print(f"{table_name:<24} {'failed':>10}")
+        else:
+            print(f"{table_name:<24} {counts['inserted']:>10} {counts['updated']:>10} {counts['unchanged']:>10} {counts['deleted']:>10}")
+
+    # The ETL run's change-detection state only becomes the next run's baseline once all its tables are loaded
+    if final_data is None and all(counts is not None for counts in load_report.values()) and commit_pending_state():
+        logging.info("Committed the change-detection state of the loaded ETL run")
+    return load_report
+
 if __name__ == "__main__":
-    load_data_to_table('patient_demographics', patient_demographics_columns, patient_demographics_dtype, primary_keys=['patient_id'])
-    load_data_to_table('patient_visits', patient_visits_columns, patient_visits_dtype, primary_keys=['visit_id'])
-    load_data_to_table('patient_lab_results', patient_lab_results_columns, patient_lab_results_dtype, primary_keys=['lab_test_id'])
-    load_data_to_table('patient_medications', patient_medications_columns, patient_medications_dtype, primary_keys=['medication_id'])
-    load_data_to_table('physician_assignments', physician_assignments_columns, physician_assignments_dtype, primary_keys=['patient_id', 'visit_id', 'physician_id'])
+    parser = argparse.ArgumentParser(description="Load the cleaned tables into the database")
+    parser.add_argument("--backend", choices=LOAD_BACKENDS, default=DEFAULT_BACKEND, help="COPY FROM STDIN or pandas INSERT statements")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Rows sent per batch")
+    parser.add_argument("--mode", choices=LOAD_MODES, default=DEFAULT_MODE,
+                        help="Recreate each table, upsert changed rows by primary key, or recreate the tables from sql/schema.sql "
+                             "and build their keys, constraints and indexes after the load")
+    parser.add_argument("--unlogged", action="store_true", help="Deferred mode: load into UNLOGGED tables, made LOGGED after the load")
+    parser.add_argument("--build-workers", type=int, default=BUILD_WORKERS, help="Deferred mode: connections that build indexes and validate constraints")
+    args = parser.parse_args()
+    main(backend=args.backend, batch_size=args.batch_size, mode=args.mode, unlogged=args.unlogged, build_workers=args.build_workers)
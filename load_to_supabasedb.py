@@ -1,12 +1,20 @@
 import pandas as pd
 import logging
 import os
-from sqlalchemy import Date, Float, Integer, String, create_engine
+import argparse
+from sqlalchemy import Date, Float, Integer, String
 from dotenv import load_dotenv
+from change_detection import commit_pending_state
+from cleaned_data_io import read_deleted_keys, read_table, table_source_path, tables_are_delta
+from metrics import profiled, span, start_metrics_server
+from bulk_load import DEFAULT_BACKEND, DEFAULT_BATCH_SIZE, DEFAULT_MODE, LOAD_BACKENDS, TABLE_LOAD_MODES, delete_rows, replace_table, upsert_table
 
 # Load environment variables
 load_dotenv()
 
+# Imported after load_dotenv so the pool settings (DB_POOL_SIZE, ...) can come from .env
+from engine_registry import get_engine
+
 # Ensure logs directory exists
 log_dir = "logs"
 os.makedirs(log_dir, exist_ok=True)
@@ -18,13 +26,9 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-# Load the cleaned and transformed data
-try:
-    final_data = pd.read_csv('data/cleaned_data.csv')
-    logging.info("Successfully loaded cleaned_data.csv")
-except Exception as e:
-    logging.error(f"Error loading cleaned_data.csv: {e}")
-    raise
+# Cleaned and transformed data. When left as None, each table reads only its own columns from
+# data/cleaned/<table>.parquet (or the wide data/cleaned_data file); set it to a DataFrame to load from memory instead.
+final_data = None
 
 # Use env variables for Postgres DB connection
 user = os.getenv("SUPABASE_USER")
@@ -35,24 +39,60 @@ db = os.getenv("SUPABASE_DB")
 
 SUPABASE_DB_URL = f"postgresql://{user}:{password}@{host}:{port}/{db}"
 
-try:
-    engine = create_engine(SUPABASE_DB_URL)
-    logging.info("Connected to Supabase database successfully.")
-except Exception as e:
-    logging.error(f"Database connection error: {e}")
-    raise
+# Engine the tables are loaded into. When left as None, the pooled engine for SUPABASE_DB_URL is created on first use
+# (see connect), so importing this module neither reads data nor builds an engine; set it to an Engine to load elsewhere.
+engine = None
 
-# Helper function to load data into the database
-def load_data_to_table(table_name, columns, dtype, primary_keys=None):
+# Return the engine to load into, creating the pooled engine on first use
+def connect():
+    if engine is not None:
+        return engine
     try:
-        data = final_data[columns]
+        return get_engine("supabase", SUPABASE_DB_URL)
+    except Exception as e:
+        logging.error(f"Database connection error: {e}")
+        raise
 
-        if primary_keys:
-            data = data.dropna(subset=primary_keys)
-            data = data.drop_duplicates()
+# Helper function to load data into the database
+# backend selects COPY ("copy") or pandas' INSERT path ("insert"); rows are sent batch_size at a time.
+# mode "replace" recreates the table, mode "upsert" merges the rows into it by primary_keys (there is no deferred mode here).
+# Returns the number of rows inserted, updated, left unchanged and deleted (None if the load failed).
+# Timed as a "load_table" span (metrics.span); the COPY batches add the bytes they send to it.
+@profiled
+def load_data_to_table(table_name, columns, dtype, primary_keys=None, backend=DEFAULT_BACKEND, batch_size=DEFAULT_BATCH_SIZE, mode=DEFAULT_MODE):
+    try:
+        with span("load_table", table=table_name, target="supabase") as record:
+            data = final_data[columns] if final_data is not None else read_table(table_name, columns)
+            record.update(rows_in=len(data), bytes_read=None if final_data is not None else os.path.getsize(table_source_path(table_name)))
+            logging.info(f"Read {len(data)} rows for {table_name}")
+
+            if mode not in TABLE_LOAD_MODES:
+                raise ValueError(f"Unknown load mode {mode!r}; expected one of {TABLE_LOAD_MODES}")
+
+            # An incremental ETL run only wrote the changed rows: replacing the table with them would drop the rest
+            if final_data is None and mode == "replace" and tables_are_delta():
+                logging.warning(f"The cleaned tables only hold changed rows; upserting {table_name} instead of replacing it")
+                mode = "upsert"
+
+            if primary_keys:
+                data = data.dropna(subset=primary_keys)
+                data = data.drop_duplicates()
         
-        data.to_sql(table_name, engine, if_exists='replace', index=False, dtype=dtype)
-        logging.info(f"Data inserted successfully into {table_name}")
+            if mode == "upsert":
+                counts = upsert_table(data, table_name, connect(), dtype, primary_keys, batch_size=batch_size)
+            else:
+                replace_table(data, table_name, connect(), dtype, backend=backend, batch_size=batch_size,
+                              primary_keys=primary_keys)
+                counts = {"inserted": len(data), "updated": 0, "unchanged": 0}
+            # An incremental ETL run lists the keys of the rows deleted from the sources since the last load
+            counts["deleted"] = 0
+            if final_data is None and mode == "upsert" and tables_are_delta():
+                deleted = read_deleted_keys(table_name)
+                if deleted is not None and primary_keys:
+                    counts["deleted"] = delete_rows(deleted, table_name, connect(), primary_keys)
+            record.update(rows_out=counts["inserted"] + counts["updated"], mode=mode)
+            logging.info(f"Data inserted successfully into {table_name}")
+            return counts
     except Exception as e:
         logging.error(f"Error inserting data into {table_name}: {e}")
 
@@ -114,10 +154,36 @@ physician_assignments_dtype = {
     'department': String(255)
 }
 
-if __name__ == "__main__":
-    load_data_to_table('patient_demographics', patient_demographics_columns, patient_demographics_dtype, primary_keys=['patient_id'])
-    load_data_to_table('patient_visits', patient_visits_columns, patient_visits_dtype, primary_keys=['visit_id'])
-    load_data_to_table('patient_lab_results', patient_lab_results_columns, patient_lab_results_dtype, primary_keys=['lab_test_id'])
-    load_data_to_table('patient_medications', patient_medications_columns, patient_medications_dtype, primary_keys=['medication_id'])
-    load_data_to_table('physician_assignments', physician_assignments_columns, physician_assignments_dtype, primary_keys=['patient_id', 'visit_id', 'physician_id'])
+# Load every cleaned table and print how many rows each one inserted, updated and left unchanged.
+# The entry point of the script: nothing is read or connected before it runs.
+def main(backend=DEFAULT_BACKEND, batch_size=DEFAULT_BATCH_SIZE, mode=DEFAULT_MODE):
+    load_options = {"backend": backend, "batch_size": batch_size, "mode": mode}
+    load_report = {}
+    start_metrics_server()
+
+    load_report['patient_demographics'] = load_data_to_table('patient_demographics', patient_demographics_columns, patient_demographics_dtype, primary_keys=['patient_id'], **load_options)
+    load_report['patient_visits'] = load_data_to_table('patient_visits', patient_visits_columns, patient_visits_dtype, primary_keys=['visit_id'], **load_options)
+    load_report['patient_lab_results'] = load_data_to_table('patient_lab_results', patient_lab_results_columns, patient_lab_results_dtype, primary_keys=['lab_test_id'], **load_options)
+    load_report['patient_medications'] = load_data_to_table('patient_medications', patient_medications_columns, patient_medications_dtype, primary_keys=['medication_id'], **load_options)
+    load_report['physician_assignments'] = load_data_to_table('physician_assignments', physician_assignments_columns, physician_assignments_dtype, primary_keys=['patient_id', 'visit_id', 'physician_id'], **load_options)
+
+    # Report how many rows each table inserted, updated, left unchanged and deleted
+    print(f"{'table':<24} {'inserted':>10} {'updated':>10} {'unchanged':>10} {'deleted':>10}")
+    for table_name, counts in load_report.items():
+        if counts is None:
+            print(f"{table_name:<24} {'failed':>10}")
+        else:
+            print(f"{table_name:<24} {counts['inserted']:>10} {counts['updated']:>10} {counts['unchanged']:>10} {counts['deleted']:>10}")
+
+    # The ETL run's change-detection state only becomes the next run's baseline once all its tables are loaded
+    if final_data is None and all(counts is not None for counts in load_report.values()) and commit_pending_state():
+        logging.info("Committed the change-detection state of the loaded ETL run")
+    return load_report
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the cleaned tables into the database")
+    parser.add_argument("--backend", choices=LOAD_BACKENDS, default=DEFAULT_BACKEND, help="COPY FROM STDIN or pandas INSERT statements")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Rows sent per batch")
+    parser.add_argument("--mode", choices=TABLE_LOAD_MODES, default=DEFAULT_MODE, help="Recreate each table or upsert changed rows by primary key")
+    args = parser.parse_args()
+    main(backend=args.backend, batch_size=args.batch_size, mode=args.mode)
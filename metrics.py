@@ -0,0 +1,235 @@
+import cProfile
+import functools
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # Windows: peak memory is not reported
+    resource = None
+
+# JSON-lines file every span is appended to (set ETL_METRICS_FILE to an empty string to turn it off)
+METRICS_FILE = os.getenv("ETL_METRICS_FILE", os.path.join("logs", "metrics.jsonl"))
+
+# Port of the local Prometheus text endpoint (http://127.0.0.1:<port>/metrics); off unless set
+METRICS_PORT = os.getenv("ETL_METRICS_PORT")
+
+# Directory the profiled functions write their cProfile output to; profiling is off unless set
+PROFILE_DIR = os.getenv("ETL_PROFILE_DIR")
+
+# Seconds between the RSS samples taken while a span is open (0 samples only when spans start and end)
+MEMORY_SAMPLE_INTERVAL = float(os.getenv("ETL_MEMORY_SAMPLE_INTERVAL", 0.05))
+
+# Counted fields of a span, summed per span name and labels for the Prometheus endpoint
+COUNTERS = ("rows_in", "rows_out", "bytes_read", "bytes_written")
+
+# Identifies the spans of one run of one script in the metrics file
+RUN_ID = uuid.uuid4().hex[:12]
+
+_local = threading.local()
+_lock = threading.Lock()
+_totals = {}
+_profile_lock = threading.Lock()
+_profile_numbers = itertools.count(1)
+_memory_lock = threading.Lock()
+_sampled_spans = {}
+_sampler_pid = None
+
+# Highest resident set size of the process so far, in bytes (ru_maxrss is in KB on Linux, bytes on macOS)
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Current resident set size of the process, in bytes (None where /proc is not available)
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+# Raise the RSS peak of the given span records (every open span when None) to the current RSS
+def _sample_rss(records=None):
+    rss = current_rss_bytes()
+    if rss is None:
+        return
+    with _memory_lock:
+        for record in (records if records is not None else _sampled_spans.values()):
+            record["rss_peak_bytes"] = max(record["rss_peak_bytes"] or 0, rss)
+
+# Sample the RSS of the open spans every MEMORY_SAMPLE_INTERVAL seconds, for the life of the process
+def _run_sampler():
+    while True:
+        time.sleep(MEMORY_SAMPLE_INTERVAL)
+        if _sampled_spans:
+            _sample_rss()
+
+# Start the sampler thread once per process (a forked worker does not inherit the parent's thread)
+def _start_sampler():
+    global _sampler_pid
+    with _memory_lock:
+        if _sampler_pid == os.getpid() or MEMORY_SAMPLE_INTERVAL <= 0:
+            return
+        _sampler_pid = os.getpid()
+    threading.Thread(target=_run_sampler, daemon=True).start()
+
+# Spans open on the current thread, innermost last
+def _open_spans():
+    if not hasattr(_local, "spans"):
+        _local.spans = []
+    return _local.spans
+
+# Add to a counted field (rows_in, rows_out, bytes_read, bytes_written) of every span open on the current thread,
+# so code deep in a stage (a COPY batch, a file write) can report to the stage and table spans around it
+def add_to_span(field, value):
+    for record in _open_spans():
+        record[field] = (record.get(field) or 0) + value
+
+# Append one span record to the metrics file
+def _write_record(record):
+    if not METRICS_FILE:
+        return
+    directory = os.path.dirname(METRICS_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _lock, open(METRICS_FILE, "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+# Add a finished span to the totals served by the Prometheus endpoint
+def _update_totals(record):
+    key = (record["span"], tuple(sorted(record["labels"].items())))
+    with _lock:
+        totals = _totals.setdefault(key, {"count": 0, "errors": 0, "seconds": 0.0, **{field: 0 for field in COUNTERS}})
+        totals["count"] += 1
+        totals["errors"] += record["status"] == "error"
+        totals["seconds"] += record["seconds"]
+        for field in COUNTERS:
+            totals[field] += record.get(field) or 0
+
+# Time a stage or table as a span. Yields the span's record: set its rows_in, rows_out, bytes_read and
+# bytes_written (or use add_to_span from nested code). When the block ends, the record gets the elapsed time,
+# its memory and its status ("error" if the block raised), and is appended to the metrics file.
+# Memory is measured per span: rss_start_bytes is the RSS when the span started, rss_peak_bytes the highest RSS
+# while it was open (sampled every MEMORY_SAMPLE_INTERVAL seconds, and exact when the span set the process's
+# high-water mark) and rss_growth_bytes the difference, i.e. the memory the span needed on top of what it started with.
+# Labels (table=..., target=...) identify the span in the file and in the Prometheus endpoint.
+@contextmanager
+def span(name, **labels):
+    spans = _open_spans()
+    record = {"span": name, "labels": labels, "parent": spans[-1]["span"] if spans else None,
+              **{field: None for field in COUNTERS}, "rss_start_bytes": current_rss_bytes(), "rss_peak_bytes": None}
+    spans.append(record)
+    _start_sampler()
+    _sample_rss([record])
+    with _memory_lock:
+        _sampled_spans[id(record)] = record
+    process_peak = peak_rss_bytes()
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield record
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        spans.remove(record)
+        with _memory_lock:
+            _sampled_spans.pop(id(record), None)
+        _sample_rss([record])
+        # A high-water mark set while the span was open is the span's exact peak, however short it was
+        if process_peak is not None and record["rss_peak_bytes"] is not None and peak_rss_bytes() > process_peak:
+            record["rss_peak_bytes"] = max(record["rss_peak_bytes"], peak_rss_bytes())
+        record["rss_growth_bytes"] = (record["rss_peak_bytes"] - record["rss_start_bytes"]
+                                      if record["rss_start_bytes"] is not None else None)
+        record.update({"seconds": time.perf_counter() - start, "status": status,
+                       "run_id": RUN_ID, "pid": os.getpid(), "script": os.path.basename(sys.argv[0]),
+                       "timestamp": datetime.now(timezone.utc).isoformat()})
+        _write_record(record)
+        _update_totals(record)
+        logging.info(f"{name} {' '.join(f'{key}={value}' for key, value in labels.items())}: {record['seconds']:.3f}s, "
+                     f"rows in {record['rows_in']}, rows out {record['rows_out']}, status {status}")
+
+# Render the span totals and the peak RSS in the Prometheus text exposition format
+def render_prometheus():
+    lines = []
+    with _lock:
+        totals = dict(_totals)
+    metrics = [("etl_span_runs_total", "count", "Spans finished"), ("etl_span_errors_total", "errors", "Spans that raised"),
+               ("etl_span_seconds_total", "seconds", "Seconds spent in spans")]
+    metrics += [(f"etl_{field}_total", field, f"Sum of {field} over spans") for field in COUNTERS]
+    for metric, field, description in metrics:
+        lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter"]
+        for (name, labels), values in sorted(totals.items()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in (("span", name),) + labels)
+            lines.append(f"{metric}{{{label_text}}} {values[field]}")
+    peak = peak_rss_bytes()
+    if peak is not None:
+        lines += ["# HELP etl_peak_rss_bytes Peak resident set size of the process",
+                  "# TYPE etl_peak_rss_bytes gauge", f"etl_peak_rss_bytes {peak}"]
+    return "\n".join(lines) + "\n"
+
+# Serves render_prometheus() on /metrics
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Start the Prometheus endpoint on 127.0.0.1 in a background thread, when a port is given or ETL_METRICS_PORT is set.
+# Returns the server (None when off); it stops with the process.
+def start_metrics_server(port=None):
+    port = port if port is not None else METRICS_PORT
+    if port is None or port == "":
+        return None
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", int(port)), MetricsHandler)
+    except OSError as e:
+        logging.error(f"Could not start the metrics endpoint on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
+
+# Profiling hook for hot functions. When ETL_PROFILE_DIR is set, each call runs under cProfile and its stats are
+# written to <dir>/<function>-<pid>-<n>.prof (open with `python -m pstats` or snakeviz). Calls made while
+# another profiled call is running are not profiled again. The wrapper keeps the function's name, so sampling
+# profilers such as py-spy attached to the process show it as-is.
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILE_DIR or not _profile_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                path = os.path.join(PROFILE_DIR, f"{func.__name__}-{os.getpid()}-{next(_profile_numbers)}.prof")
+                profile.dump_stats(path)
+                logging.info(f"Profile of {func.__name__} written to {path}")
+        finally:
+            _profile_lock.release()
+    return wrapper
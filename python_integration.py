@@ -1,15 +1,24 @@
+import argparse
 import pandas as pd
-from sqlalchemy import create_engine
 import logging
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib_venn import venn2
 import logging
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Imported after load_dotenv so the pool settings (DB_POOL_SIZE, ...) can come from .env
+from engine_registry import get_engine
+from metrics import span, start_metrics_server
+from query_cache import cached_query, log_cache_stats
+from report_charts import (avg_visits_per_patient_chart, patients_by_diagnosis_chart, start_rendering, visits_per_month_chart,
+                           visits_per_patient_chart, wait_for_charts)
+from report_queries import PATIENTS_BY_DIAGNOSIS_OR_VISIT_DATE_SQL, ensure_report_indexes
+from visit_summaries import MONTH_SUMMARY, PATIENT_SUMMARY, sync_visit_summaries
+from change_detection import natural_keys
+from table_migration import DEFAULT_MIGRATION_BATCH_SIZE, migrate_table_partitioned, migrate_table_streaming
+from migration_scheduler import DEFAULT_MIGRATION_WORKERS, parse_table_dependencies, print_migration_report, run_migration
+
 
 # --- PostgreSQL ---
 POSTGRES_USER = os.getenv("POSTGRES_USER")
@@ -38,18 +47,20 @@ logging.basicConfig(
 )
 
 # Connect to PostgreSQL (source database)
+# Returns the shared pooled engine, so every query of the run reuses the same connections
 def connect_postgres():
     try:
-        conn = create_engine(POSTGRES_DB_URL)
+        conn = get_engine("postgres", POSTGRES_DB_URL)
         logging.info("Successfully connected to PostgreSQL.")
         return conn
     except Exception as e:
         logging.error(f"Error connecting to PostgreSQL: {e}")
 
 # Connect to Supabase (destination database)
+# Returns the shared pooled engine, so the TLS handshake is paid once per pooled connection rather than per table
 def connect_supabase():
     try:
-        engine = create_engine(SUPABASE_DB_URL)
+        engine = get_engine("supabase", SUPABASE_DB_URL)
         logging.info("Successfully connected to Supabase.")
         return engine
     except Exception as e:
@@ -58,12 +69,49 @@ def connect_supabase():
 # Execute queries and fetch results
 def execute_query(query, connection):
     try:
-        df = pd.read_sql(query, connection)
+        with span("query") as record:
+            df = pd.read_sql(query, connection)
+            record["rows_out"] = len(df)
         logging.info(f"Query executed successfully: {query}")
         return df
     except Exception as e:
         logging.error(f"Error executing query: {e}")
 
+# Re-run the report queries instead of serving their cached results (--refresh-reports)
+refresh_reports = False
+
+# Execute a report query through the result cache (see query_cache.cached_query): while the tables it reads
+# are unchanged, the stored result in data/.report_cache/ is returned without running the query.
+# Otherwise it runs as the prepared statement statement_name, with params sent as bound parameters.
+def execute_report_query(query, connection, tables, statement_name, params=None):
+    try:
+        with span("query", statement=statement_name) as record:
+            df = cached_query(query, connection, tables, params=params, refresh=refresh_reports, statement_name=statement_name)
+            record["rows_out"] = len(df)
+        return df
+    except Exception as e:
+        logging.error(f"Error executing query: {e}")
+
+# Whether the visit summaries were checked in this run
+visit_summaries_synced = False
+
+# Make sure the visit summary tables the reports read exist and are maintained by their triggers,
+# building them from patient_visits the first time (see visit_summaries.sync_visit_summaries); once per run
+def ensure_visit_summaries(engine):
+    global visit_summaries_synced
+    if not visit_summaries_synced:
+        sync_visit_summaries(engine)
+        visit_summaries_synced = True
+
+# Whether the report indexes were checked in this run
+report_indexes_checked = False
+
+# Create the indexes the report queries use if a replace load dropped them (see report_queries.REPORT_INDEXES); once per run
+def ensure_indexes(engine):
+    global report_indexes_checked
+    if not report_indexes_checked:
+        ensure_report_indexes(engine)
+        report_indexes_checked = True
 
 # Fetch data from PostgreSQL
 def fetch_data_from_postgres(table_name):
@@ -86,164 +134,188 @@ def insert_data_into_supabase(df, table_name):
         logging.error(f"Error inserting data into Supabase table {table_name}: {e}")
 
 # Query to get visits per patient
+# Reads the per-patient summary maintained by the loads instead of counting patient_visits
 def get_visits_per_patient():
     query = f"""
-    SELECT patient_id, COUNT(*) AS number_of_visits
-    FROM patient_visits
-    GROUP BY patient_id
+    SELECT patient_id, number_of_visits
+    FROM {PATIENT_SUMMARY}
     ORDER BY patient_id;
     """
     try:
         conn = connect_postgres()
-        df = execute_query(query, conn)
+        ensure_visit_summaries(conn)
+        df = execute_report_query(query, conn, [PATIENT_SUMMARY], "visits_per_patient")
         df.to_csv(f'outputs/visits_per_patient.csv', index=False)
         logging.info("Saved visits per patient data to CSV.")
-
-        # Plot
-        plt.figure(figsize=(12, 6))
-        sns.barplot(x=df['patient_id'], y=df['number_of_visits'], color="skyblue")
-        plt.xticks(rotation=90)
-        plt.xlabel("Patient ID")
-        plt.ylabel("Number of Visits")
-        plt.title("Number of Visits Per Patient")
-        plt.savefig('outputs/visits_per_patient.png')
         return df
     except Exception as e:
         logging.error(f"Error getting visits per patient: {e}")
 
 # Filter patients by diagnosis
+# The values are bound parameters of one prepared statement, served by the diagnosis and visit_date indexes
 def get_patients_by_diagnoise_visit_date_range(diagnosis, start_date, end_date):
-    query = f"""
-    SELECT patient_id, diagnosis, visit_date
-    FROM patient_visits
-    WHERE diagnosis = '{diagnosis}'
-    OR (visit_date BETWEEN '{start_date}' AND '{end_date}')
-    """
+    query = PATIENTS_BY_DIAGNOSIS_OR_VISIT_DATE_SQL
+    params = {"diagnosis": diagnosis, "start_date": start_date, "end_date": end_date}
 
     try:
         conn = connect_postgres()
-        df = execute_query(query, conn)
+        ensure_indexes(conn)
+        df = execute_report_query(query, conn, ["patient_visits"], "patients_by_diagnosis_or_visit_date", params)
         df.to_csv(f'outputs/filtered_patients_by_diagnosis_or_visit_date_range.csv', index=False)
         logging.info("Saved patients by diagnosis to CSV.")
-
-        # Create sets of patient IDs for each group
-        df['visit_date'] = pd.to_datetime(df['visit_date'], errors='coerce')
-        depression_patients = set(df[df['diagnosis'] == diagnosis]['patient_id'])
-        visit_2023_patients = set(df[
-        (df['visit_date'] >= start_date) & 
-        (df['visit_date'] <= end_date)
-        ]['patient_id'])
-
-        # Venn diagram
-        plt.figure(figsize=(8, 6))
-        venn2([depression_patients, visit_2023_patients], 
-        set_labels=('DEPRESSION', 'Visited in 2023'),
-        set_colors=('purple', 'teal'),
-        alpha=0.6)
-
-        plt.title("Patients Diagnosed with DEPRESSION or Visited in 2023")
-        plt.savefig("outputs/filtered_patients_by_diagnosis_or_visit_date_range.png")
         return df
     except Exception as e:
         logging.error(f"Error getting patients by diagnosis_or_visit_date_range: {e}")
         print(f"Error getting patients by diagnosis_or_visit_date_range: {e}")
 
 # Aggregate number of visits per month
+# Reads the per-month summary (month 0 holds visits without a date, reported as NULL like EXTRACT gives)
 def get_avg_visits_per_month():
     query = f"""
-    SELECT EXTRACT(MONTH FROM visit_date) AS visit_month, COUNT(*) AS number_of_visits
-    FROM patient_visits
-    GROUP BY EXTRACT(MONTH FROM visit_date)
+    SELECT NULLIF(visit_month, 0)::numeric AS visit_month, number_of_visits
+    FROM {MONTH_SUMMARY}
     ORDER BY visit_month;
     """
     try:
         conn = connect_postgres()
-        df = execute_query(query, conn)
+        ensure_visit_summaries(conn)
+        df = execute_report_query(query, conn, [MONTH_SUMMARY], "visits_per_month")
         df.to_csv(f'outputs/visits_per_month.csv')
         logging.info("Saved visits per month data to CSV.")
-
-        # Plot
-        plt.figure(figsize=(10, 5))
-        sns.lineplot(x=df['visit_month'], y=df['number_of_visits'], marker="o", color="b")
-        plt.xticks(range(1, 13), ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
-        plt.xlabel("Month")
-        plt.ylabel("Number of Visits")
-        plt.title("Number of Visits Per Month")
-        plt.grid()
-        plt.savefig('outputs/visits_per_month.png')
         return df
     except Exception as e:
         logging.error(f"Error getting average visits per month: {e}")
 
 # Average visits per patient
+# Reads the per-patient summary maintained by the loads instead of counting patient_visits
 def get_avg_visits_per_patient():
     query = f"""
     SELECT patient_id, 
-       COUNT(*) AS number_of_visits,
-       AVG(COUNT(*)) OVER () AS avg_visits_per_patient
-    FROM patient_visits
-    GROUP BY patient_id
-    HAVING COUNT(*) >= 1  
+       number_of_visits,
+       AVG(number_of_visits) OVER () AS avg_visits_per_patient
+    FROM {PATIENT_SUMMARY}
+    WHERE number_of_visits >= 1
     ORDER BY patient_id;
     """
 
     try:
         conn = connect_postgres()
-        df = execute_query(query, conn)
+        ensure_visit_summaries(conn)
+        df = execute_report_query(query, conn, [PATIENT_SUMMARY], "avg_visits_per_patient")
         df.to_csv(f'outputs/avg_visits_per_patient.csv')
         logging.info("Saved average visits per patient data to CSV.")
-
-        # Plot
-        avg_visits = df['number_of_visits'].mean()
-        plt.figure(figsize=(8, 5))
-        sns.barplot(x='patient_id', y='number_of_visits', data=df, color="purple")
-        plt.axhline(avg_visits, color='red', linestyle='--', label=f'Average Visits: {avg_visits:.2f}')
-        plt.xlabel("Patient ID")
-        plt.ylabel("Number of Visits")
-        plt.title("Average Visits Per Patient")
-        plt.xticks(rotation=45)
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig('outputs/avg_visits_per_patient.png')
         return df
     except Exception as e:
         logging.error(f"Error getting average visits per patient: {e}")
 
+# Migrate one table; returns the number of rows copied
+# By default the table is streamed in batches of batch_size rows (see table_migration.migrate_table_streaming),
+# resuming after the last committed batch if an earlier run failed; streaming=False loads the whole table at once.
+# partitions > 1 splits the table into that many key ranges, streamed in parallel over separate pooled connections,
+# as many at a time as the pools hold with "tables" tables migrating at once (see table_migration.partition_threads).
+def migrate_table(table, streaming=True, batch_size=DEFAULT_MIGRATION_BATCH_SIZE, partitions=1, tables=1):
+    with span("migrate_table", table=table, target="supabase") as record:
+        record["rows_out"] = copy_table(table, streaming, batch_size, partitions, tables)
+    return record["rows_out"]
+
+# Copy one table the way migrate_table describes; returns the number of rows copied
+def copy_table(table, streaming, batch_size, partitions, tables=1):
+    if streaming and partitions > 1:
+        print(f"Streaming {table} to Supabase in {partitions} partitions of batches of {batch_size} rows...")
+        return migrate_table_partitioned(table, connect_postgres(), connect_supabase(), natural_keys[table],
+                                         schema="data_migration", partitions=partitions, batch_size=batch_size,
+                                         tables=tables)
+    if streaming:
+        print(f"Streaming {table} to Supabase in batches of {batch_size} rows...")
+        return migrate_table_streaming(table, connect_postgres(), connect_supabase(), natural_keys[table],
+                                       schema="data_migration", batch_size=batch_size)
+    print(f"Fetching data from {table}...")
+    df = fetch_data_from_postgres(table)
+    print(f"Inserting data into {table} in Supabase...")
+    insert_data_into_supabase(df, table)
+    return len(df)
+
 # Migrate data
-def migrate_data():
+# Tables are migrated concurrently by max_workers threads, in the order the foreign keys of sql/schema.sql require:
+# patient_demographics, then patient_visits, then the lab results, medications and physician assignments together.
+# Each table can also be split into "partitions" parallel streams. The pools are shared by the max_workers tables, so
+# at most (DB_POOL_SIZE + DB_MAX_OVERFLOW) / max_workers partitions of a table stream at once; size the pools for
+# max_workers * partitions connections to run them all.
+def migrate_data(streaming=True, batch_size=DEFAULT_MIGRATION_BATCH_SIZE, max_workers=DEFAULT_MIGRATION_WORKERS, partitions=1):
     tables_to_migrate = ['patient_demographics', 'patient_visits', 'patient_lab_results', 'patient_medications', 'physician_assignments']  
 
-    for table in tables_to_migrate:
+    with span("migrate_data", workers=max_workers, partitions=partitions) as record:
+        report, total = run_migration(tables_to_migrate, lambda table: migrate_table(table, streaming, batch_size, partitions, max_workers),
+                                      parse_table_dependencies(), max_workers=max_workers)
+        record["rows_out"] = sum(entry["rows"] for entry in report.values())
+    print_migration_report(report, total)
+    return report
+        
+
+# Start rendering the charts of the reports that succeeded, given as (chart builder, report DataFrame, *arguments).
+# A chart that cannot be built is logged and skipped, so it never stops the migration.
+def start_report_charts(reports):
+    charts = []
+    for build, df, *arguments in reports:
+        if df is None:
+            continue
         try:
-            logging.info(f"Starting migration for {table}...")
-            print(f"Fetching data from {table}...")
-            df = fetch_data_from_postgres(table)
-            print(f"Inserting data into {table} in Supabase...")
-            insert_data_into_supabase(df, table)
-            logging.info(f"Migration completed for {table}.")
+            charts.append(build(df, *arguments))
         except Exception as e:
-            logging.error(f"Error during migration for {table}: {e}")
-        
+            logging.error(f"Error preparing chart {build.__name__}: {e}")
+    try:
+        return start_rendering(charts)
+    except Exception as e:
+        logging.error(f"Error starting the chart workers: {e}")
 
-if __name__ == '__main__':
+# Run the reports (queries and CSV exports), then the migration; migrate_only skips the reports and charts,
+# so the plotting libraries are never imported. refresh re-runs the report queries instead of using the cache.
+# The charts are drawn in worker processes (see report_charts) while the tables migrate, and waited for at the end.
+# workers and partitions are passed to migrate_data: tables migrated at once, and parallel streams per table.
+def main(migrate_only=False, refresh=False, workers=DEFAULT_MIGRATION_WORKERS, partitions=1):
+    global refresh_reports
+    refresh_reports = refresh
+    start_metrics_server()
+    rendering = None
     try:
-        visits_per_patient_df = get_visits_per_patient()
-        print(visits_per_patient_df)
+        if not migrate_only:
+            diagnosis, start_date, end_date = 'DEPRESSION', '2023-01-01', '2023-12-31'
+            visits_per_patient_df = get_visits_per_patient()
+            print(visits_per_patient_df)
+
+            patients_by_diagnoise_or_visit_date_range_df = get_patients_by_diagnoise_visit_date_range(diagnosis, start_date, end_date)
+            print(patients_by_diagnoise_or_visit_date_range_df)
+
+            avg_visits_per_patient_df = get_avg_visits_per_patient()
+            print(avg_visits_per_patient_df)
+
+            avg_visits_per_month_df = get_avg_visits_per_month()
+            print(avg_visits_per_month_df)
+
+            log_cache_stats()
+
+            rendering = start_report_charts([
+                (visits_per_patient_chart, visits_per_patient_df),
+                (patients_by_diagnosis_chart, patients_by_diagnoise_or_visit_date_range_df, diagnosis, start_date, end_date),
+                (avg_visits_per_patient_chart, avg_visits_per_patient_df),
+                (visits_per_month_chart, avg_visits_per_month_df),
+            ])
 
-        patients_by_diagnoise_or_visit_date_range_df = get_patients_by_diagnoise_visit_date_range('DEPRESSION', '2023-01-01', '2023-12-31')
-        print(patients_by_diagnoise_or_visit_date_range_df)
-        
-        avg_visits_per_patient_df = get_avg_visits_per_patient()
-        print(avg_visits_per_patient_df)
-        
-        avg_visits_per_month_df = get_avg_visits_per_month()
-        print(avg_visits_per_month_df)
-       
-        
         print("Starting data migration process...")
-        migrate_data()
+        migrate_data(max_workers=workers, partitions=partitions)
         print("Data migration completed successfully.")
 
     except Exception as e:
         logging.error(f"Exception occurred: {e}")
-        
+    finally:
+        if rendering is not None:
+            wait_for_charts(rendering)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report on the Postgres data and migrate it to Supabase")
+    parser.add_argument("--migrate-only", action="store_true", help="Skip the reports and charts, only migrate the tables")
+    parser.add_argument("--refresh-reports", action="store_true", help="Re-run the report queries instead of serving cached results")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MIGRATION_WORKERS, help="Tables migrated at the same time")
+    parser.add_argument("--partitions", type=int, default=1, help="Key ranges each table is split into and streamed in parallel")
+    args = parser.parse_args()
+    main(migrate_only=args.migrate_only, refresh=args.refresh_reports, workers=args.workers, partitions=args.partitions)
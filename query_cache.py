@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import pandas as pd
+from sqlalchemy import text
+from report_queries import execute_prepared
+
+# Directory holding one Parquet file per cached query result
+CACHE_DIR = os.getenv("REPORT_CACHE_DIR", os.path.join("data", ".report_cache"))
+
+# Seconds a cached result is served for (0 turns the cache off), and the size the cache directory is kept under
+CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", 24 * 3600))
+CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+
+# Hits, misses and evictions of this run
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_lock = threading.Lock()
+
+# Collapse whitespace and drop the trailing semicolon, so a reformatted query keeps its cache entry
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+
+# Table holding a write counter per source table (keyed by the table's OID), and the statement-level trigger
+# that bumps it. The counter is bumped inside the writing transaction, so it changes exactly when the write commits,
+# and it is a plain table, so unlike the statistics counters it survives a crash or pg_stat_reset().
+VERSIONS_TABLE = "report_cache_versions"
+VERSION_FUNCTION = "bump_report_cache_version"
+VERSION_TRIGGER = "report_cache_version"
+
+VERSION_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {VERSION_FUNCTION}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO {VERSIONS_TABLE} AS versions (table_oid, version) VALUES (TG_RELID, 1)
+    ON CONFLICT (table_oid) DO UPDATE SET version = versions.version + 1;
+    RETURN NULL;
+END
+$$
+"""
+
+# Attach the version trigger to the tables that lack it (first run, or a replace load recreated the table).
+# Installing bumps the table's counter too, so a stamp taken before the trigger existed is never valid again.
+def ensure_version_triggers(engine, tables):
+    with engine.connect() as connection:
+        missing = connection.execute(
+            text("SELECT c.relname FROM pg_class c WHERE c.relname = ANY(:tables) AND pg_table_is_visible(c.oid) "
+                 "AND NOT EXISTS (SELECT 1 FROM pg_trigger t WHERE t.tgrelid = c.oid AND t.tgname = :trigger)"),
+            {"tables": list(tables), "trigger": VERSION_TRIGGER}
+        ).scalars().all()
+    if not missing:
+        return
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (table_oid OID PRIMARY KEY, version BIGINT NOT NULL)")
+        connection.exec_driver_sql(VERSION_FUNCTION_SQL)
+        for table in missing:
+            connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {VERSION_TRIGGER} ON "{table}"')
+            connection.exec_driver_sql(f'CREATE TRIGGER {VERSION_TRIGGER} AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "{table}" '
+                                       f"FOR EACH STATEMENT EXECUTE FUNCTION {VERSION_FUNCTION}()")
+            connection.execute(
+                text(f"INSERT INTO {VERSIONS_TABLE} AS versions (table_oid, version) VALUES (to_regclass(:table), 1) "
+                     "ON CONFLICT (table_oid) DO UPDATE SET version = versions.version + 1"),
+                {"table": f'"{table}"'}
+            )
+    logging.info(f"Attached the report cache version trigger to {', '.join(missing)}")
+
+# Version stamp of the source tables: the relation's OID (a replace load recreates the table) and its write
+# counter (see ensure_version_triggers). Reading it is a catalog and primary key lookup, not a table scan.
+def table_versions(connection, tables):
+    rows = connection.execute(
+        text(f"SELECT c.relname, c.oid, COALESCE(v.version, 0) FROM pg_class c "
+             f"LEFT JOIN {VERSIONS_TABLE} v ON v.table_oid = c.oid "
+             "WHERE c.relname = ANY(:tables) AND pg_table_is_visible(c.oid) AND c.relkind IN ('r', 'p')"),
+        {"tables": list(tables)}
+    ).all()
+    return {name: [oid, version] for name, oid, version in sorted(rows)}
+
+# Cache key of a query: its normalized text, its parameters and the version of the tables it reads
+def cache_key(query, params, versions):
+    payload = json.dumps({"query": normalize_query(query), "params": params or {}, "versions": versions}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# Path of the cached result for a key
+def cache_file(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"{key}.parquet")
+
+# Remove entries older than ttl, then the least recently used entries until the directory fits in max_bytes.
+# An entry's modification time is when it was stored and its access time when it was last served.
+def evict(cache_dir=CACHE_DIR, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+    if not os.path.isdir(cache_dir):
+        return
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".parquet"):
+            continue
+        path = os.path.join(cache_dir, name)
+        stat = os.stat(path)
+        if now - stat.st_mtime > ttl:
+            os.remove(path)
+            _stats["evictions"] += 1
+        else:
+            entries.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        _stats["evictions"] += 1
+
+# Run a report query through the cache. "tables" are the tables the query reads: their version stamp is part of
+# the key, so a result is served from disk until one of them is written to or the entry expires, without running the query.
+# refresh=True runs the query and replaces the stored result. Results are stored as Parquet.
+# With a statement_name, a miss runs the query as that prepared statement (see report_queries.execute_prepared).
+def cached_query(query, engine, tables, params=None, refresh=False, cache_dir=CACHE_DIR, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES,
+                 statement_name=None):
+    ensure_version_triggers(engine, tables)
+    with engine.connect() as connection:
+        key = cache_key(query, params, table_versions(connection, tables))
+        path = cache_file(key, cache_dir)
+        if ttl > 0 and not refresh and os.path.exists(path) and time.time() - os.path.getmtime(path) <= ttl:
+            df = pd.read_parquet(path)
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            with _lock:
+                _stats["hits"] += 1
+            logging.info(f"Report cache hit ({key[:12]}, {len(df)} rows): {normalize_query(query)[:80]}")
+            return df
+
+        start = time.perf_counter()
+        if statement_name:
+            df = execute_prepared(connection, statement_name, query, params)
+        else:
+            df = pd.read_sql(text(query), connection, params=params)
+    with _lock:
+        _stats["misses"] += 1
+    logging.info(f"Report cache miss ({key[:12]}, query ran in {time.perf_counter() - start:.3f}s): {normalize_query(query)[:80]}")
+    if ttl > 0:
+        try:
+            # Written under a temporary name and renamed, so a concurrent run never reads a partial file
+            os.makedirs(cache_dir, exist_ok=True)
+            df.to_parquet(f"{path}.{os.getpid()}.tmp", index=False)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+            with _lock:
+                evict(cache_dir, ttl, max_bytes)
+        except Exception as e:
+            logging.error(f"Could not store report cache entry {key[:12]}: {e}")
+    return df
+
+# Hits, misses and evictions so far
+def cache_stats():
+    return dict(_stats)
+
+# Write the cache statistics to the log
+def log_cache_stats():
+    logging.info(f"Report cache: {_stats['hits']} hits, {_stats['misses']} misses, {_stats['evictions']} evictions")
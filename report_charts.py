@@ -0,0 +1,141 @@
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from metrics import peak_rss_bytes, span
+
+# Above this many patients the per-patient charts show how many patients had each number of visits
+# (a histogram) instead of one bar per patient, which takes minutes to draw and cannot be read
+MAX_BARS = int(os.getenv("REPORT_CHART_MAX_BARS", 100))
+
+# Most bins a histogram is drawn with; below it every visit count gets its own bin
+HISTOGRAM_BINS = int(os.getenv("REPORT_CHART_BINS", 50))
+
+# Worker processes the charts are rendered in
+CHART_WORKERS = int(os.getenv("REPORT_CHART_WORKERS", min(4, os.cpu_count() or 1)))
+
+MONTH_LABELS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Chart of a per-patient count: one bar per patient up to MAX_BARS patients, otherwise a histogram of the counts.
+# The chart holds only what is drawn (bar values or bin counts), so it is cheap to send to a worker process.
+def patient_count_chart(name, df, column, title, path, color, average=None, figsize=(12, 6), rotation=90):
+    values = df[column].astype(float).to_numpy()
+    chart = {"name": name, "path": path, "title": title, "color": color, "figsize": figsize, "average": average}
+    if len(df) <= MAX_BARS:
+        chart.update({"kind": "bar", "labels": df["patient_id"].astype(str).tolist(), "values": values.tolist(),
+                      "xlabel": "Patient ID", "ylabel": "Number of Visits", "rotation": rotation})
+        return chart
+    low, high = (values.min(), values.max()) if len(values) else (0, 0)
+    if high - low + 1 <= HISTOGRAM_BINS:
+        edges = np.arange(low, high + 2) - 0.5
+    else:
+        edges = np.histogram_bin_edges(values, bins=HISTOGRAM_BINS)
+    counts, edges = np.histogram(values, bins=edges)
+    chart.update({"kind": "histogram", "counts": counts.tolist(), "edges": edges.tolist(),
+                  "xlabel": "Number of Visits", "ylabel": "Number of Patients"})
+    return chart
+
+# Number of visits per patient
+def visits_per_patient_chart(df):
+    return patient_count_chart("visits_per_patient", df, "number_of_visits", "Number of Visits Per Patient",
+                               "outputs/visits_per_patient.png", "skyblue")
+
+# Visits per patient with the average marked
+def avg_visits_per_patient_chart(df):
+    return patient_count_chart("avg_visits_per_patient", df, "number_of_visits", "Average Visits Per Patient",
+                               "outputs/avg_visits_per_patient.png", "purple", average=df["number_of_visits"].mean(),
+                               figsize=(8, 5), rotation=45)
+
+# Number of visits per month
+def visits_per_month_chart(df):
+    return {"name": "visits_per_month", "kind": "line", "path": "outputs/visits_per_month.png", "title": "Number of Visits Per Month",
+            "color": "b", "figsize": (10, 5), "x": df["visit_month"].astype(float).tolist(),
+            "y": df["number_of_visits"].astype(float).tolist(), "xlabel": "Month", "ylabel": "Number of Visits"}
+
+# Venn diagram of the patients with the diagnosis and the patients who visited in the date range.
+# Only the three region sizes are kept, not the patient sets.
+def patients_by_diagnosis_chart(df, diagnosis, start_date, end_date):
+    visit_dates = pd.to_datetime(df["visit_date"], errors="coerce")
+    diagnosed = set(df.loc[df["diagnosis"] == diagnosis, "patient_id"])
+    visited = set(df.loc[(visit_dates >= start_date) & (visit_dates <= end_date), "patient_id"])
+    return {"name": "patients_by_diagnosis_or_visit_date_range", "kind": "venn",
+            "path": "outputs/filtered_patients_by_diagnosis_or_visit_date_range.png", "figsize": (8, 6),
+            "title": f"Patients Diagnosed with {diagnosis} or Visited {start_date} to {end_date}",
+            "subsets": (len(diagnosed - visited), len(visited - diagnosed), len(diagnosed & visited)),
+            "set_labels": (diagnosis, f"Visited {start_date} to {end_date}")}
+
+# Draw one chart and save it; runs in a worker process. The figure is closed once saved, so its memory is released.
+# Returns the chart's name, render seconds and the worker's peak RSS (each worker renders a single chart).
+def render_chart(chart):
+    start = time.perf_counter()
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=chart["figsize"])
+    try:
+        if chart["kind"] == "bar":
+            ax.bar(chart["labels"], chart["values"], color=chart["color"])
+            ax.tick_params(axis="x", labelrotation=chart["rotation"])
+        elif chart["kind"] == "histogram":
+            edges = np.asarray(chart["edges"])
+            ax.bar(edges[:-1], chart["counts"], width=np.diff(edges), align="edge", color=chart["color"], edgecolor="white")
+        elif chart["kind"] == "line":
+            ax.plot(chart["x"], chart["y"], marker="o", color=chart["color"])
+            ax.set_xticks(range(1, 13))
+            ax.set_xticklabels(MONTH_LABELS)
+            ax.grid()
+        elif chart["kind"] == "venn":
+            from matplotlib_venn import venn2
+            venn2(subsets=chart["subsets"], set_labels=chart["set_labels"], set_colors=('purple', 'teal'), alpha=0.6, ax=ax)
+        if chart.get("average") is not None:
+            line = ax.axhline if chart["kind"] == "bar" else ax.axvline
+            line(chart["average"], color='red', linestyle='--', label=f'Average Visits: {chart["average"]:.2f}')
+            ax.legend()
+        if chart["kind"] != "venn":
+            ax.set_xlabel(chart["xlabel"])
+            ax.set_ylabel(chart["ylabel"])
+        ax.set_title(chart["title"])
+        fig.tight_layout()
+        fig.savefig(chart["path"])
+    finally:
+        plt.close(fig)
+    return {"chart": chart["name"], "seconds": time.perf_counter() - start, "peak_rss_bytes": peak_rss_bytes()}
+
+# Start rendering the charts in worker processes and return at once, so the caller can go on (with the migration)
+# while they draw. Workers are spawned, not forked, so they share no database connections with the caller.
+# On Python 3.11+ each worker renders one chart and exits (max_tasks_per_child=1), which frees the chart's memory
+# and makes its peak RSS that chart's alone; on older versions a worker's peak RSS covers the charts it drew so far.
+def start_rendering(charts, workers=CHART_WORKERS):
+    charts = [chart for chart in charts if chart is not None]
+    workers = max(1, min(workers, len(charts)))
+    options = {"max_tasks_per_child": 1} if sys.version_info >= (3, 11) else {}
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), **options)
+    logging.info(f"Rendering {len(charts)} charts in {workers} worker processes")
+    return executor, workers, [(chart["name"], executor.submit(render_chart, chart)) for chart in charts], time.perf_counter()
+
+# Wait for the charts started by start_rendering, logging each chart's render time and peak memory.
+# A chart that fails (or whose worker dies) is logged and the others are kept. Returns the results of the charts saved.
+def wait_for_charts(rendering):
+    executor, workers, pending, start = rendering
+    results = []
+    with span("wait_for_charts", workers=workers) as record:
+        try:
+            for name, future in pending:
+                try:
+                    rendered = future.result()
+                    results.append(rendered)
+                    peak = rendered["peak_rss_bytes"]
+                    logging.info(f"Rendered chart {name} in {rendered['seconds']:.2f}s"
+                                 f"{f', peak RSS {peak / 1024 ** 2:.0f} MB' if peak else ''}")
+                except Exception as e:
+                    logging.error(f"Error rendering chart {name}: {e!r}")
+        finally:
+            executor.shutdown()
+        record["rows_out"] = len(results)
+    logging.info(f"Rendered {len(results)} of {len(pending)} charts, {time.perf_counter() - start:.2f}s after rendering started")
+    return results
@@ -0,0 +1,62 @@
+import logging
+import re
+import pandas as pd
+
+# Indexes the report queries rely on, as in sql/schema.sql. A replace load recreates patient_visits without them,
+# so the reports create any that are missing before they run.
+REPORT_INDEXES = {
+    "idx_patient_visits_diagnosis": ("patient_visits", "diagnosis"),
+    "idx_patient_visits_visit_date": ("patient_visits", "visit_date"),
+}
+
+# Visits with a diagnosis or within a date range. With both report indexes PostgreSQL answers the OR with one
+# BitmapOr of the two index scans, reading each matching heap page once. A UNION ALL of two branches was measured
+# as no faster and reads the pages twice (benchmarks/bench_report_queries.py compares the forms).
+PATIENTS_BY_DIAGNOSIS_OR_VISIT_DATE_SQL = """
+    SELECT patient_id, diagnosis, visit_date
+    FROM patient_visits
+    WHERE diagnosis = :diagnosis
+    OR (visit_date BETWEEN :start_date AND :end_date)
+"""
+
+# Bind parameters (:name) of a query; "::" casts are not parameters
+BIND_PARAMETER = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+# Rewrite a query's :name parameters as the $1, $2, ... positions PREPARE takes.
+# Returns the rewritten query and the parameter names in position order (a name used twice keeps one position).
+def positional_query(query):
+    names = []
+
+    def position(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return BIND_PARAMETER.sub(position, query.strip().rstrip(";")), names
+
+# Run a query as a named server-side prepared statement and return the result as a DataFrame.
+# The statement is prepared once per database connection: the pool keeps connections open between reports, so
+# later calls with other parameter values only send EXECUTE and reuse the statement's parsed (and, once
+# PostgreSQL switches to a generic plan, planned) form. The values are sent as bound parameters, never
+# formatted into the SQL text. Prepared statements are tracked in the pooled connection's info, which is
+# cleared when the connection is replaced.
+def execute_prepared(connection, name, query, params=None):
+    prepared = connection.info.setdefault("prepared_statements", {})
+    if name not in prepared or prepared[name][0] != query:
+        if name in prepared:
+            connection.exec_driver_sql(f"DEALLOCATE {name}")
+        sql, names = positional_query(query)
+        connection.exec_driver_sql(f"PREPARE {name} AS {sql}")
+        prepared[name] = (query, names)
+        logging.info(f"Prepared report statement {name}")
+    names = prepared[name][1]
+    values = tuple((params or {})[parameter] for parameter in names)
+    if not values:
+        return pd.read_sql(f"EXECUTE {name}", connection)
+    return pd.read_sql(f"EXECUTE {name}({', '.join(['%s'] * len(values))})", connection, params=values)
+
+# Create the report indexes that are missing (CREATE INDEX IF NOT EXISTS; existing indexes are left as they are)
+def ensure_report_indexes(engine, indexes=REPORT_INDEXES):
+    with engine.begin() as connection:
+        for index_name, (table_name, column) in indexes.items():
+            connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name}({column})")
@@ -19,6 +19,8 @@ CREATE TABLE IF NOT EXISTS patient_visits (
 
 CREATE INDEX idx_patient_visits_patient ON patient_visits(patient_id);
 CREATE INDEX idx_patient_visits_visit ON patient_visits(visit_id);
+CREATE INDEX idx_patient_visits_diagnosis ON patient_visits(diagnosis);
+CREATE INDEX idx_patient_visits_visit_date ON patient_visits(visit_date);
 
 CREATE TABLE IF NOT EXISTS patient_lab_results (
     patient_id VARCHAR(10) NOT NULL,
@@ -0,0 +1,172 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# Source file names, matching etl_pipeline.files
+FILES = {
+    "patient_demographics": "patient_demographics.csv",
+    "patient_visits": "patient_visits.csv",
+    "patient_lab_results": "patient_lab_results.csv",
+    "physician_assignments": "physician_assignments.csv",
+    "patient_medications": "patient_medications.csv"
+}
+
+# Default fan-out: visits per patient, and lab results, medications and physician assignments per visit
+DEFAULT_FANOUT = {"visits_per_patient": 3.0, "labs_per_visit": 2.0, "meds_per_visit": 1.0, "physicians_per_visit": 1.0}
+
+# Default share of dirty values injected into the data
+DEFAULT_DIRT = {"missing_age": 0.05, "missing_gender": 0.02, "missing_result": 0.03, "missing_notes": 0.5,
+                "missing_medication": 0.1, "duplicate_rows": 0.01}
+
+# Lab tests: (test_name, unit, reference_range, mean, std). Hemoglobin is reported in g/dL, which the pipeline converts.
+LAB_TESTS = [
+    ("Blood Glucose", "mg/dL", "70-110", 95, 20),
+    ("Cholesterol", "mg/dL", "125-200", 180, 30),
+    ("Hemoglobin", "g/dL", "12-16", 14, 2),
+    ("Triglycerides", "mg/dL", "50-150", 120, 40),
+]
+DIAGNOSES = ["Depression", "Anxiety", "Bipolar Disorder", "Schizophrenia", "PTSD"]
+MEDICATIONS = ["Sertraline", "Escitalopram", "Fluoxetine", "Lithium", "Olanzapine", "Risperidone", "Alprazolam", "Buspirone"]
+DOSAGES = ["5mg", "10mg", "20mg", "50mg", "75mg", "100mg"]
+DEPARTMENTS = ["Psychiatry", "General Medicine", "Neurology", "Psychology"]
+PHYSICIAN_NAMES = ["Smith", "Johnson", "Lee", "Patel", "Garcia", "Brown", "Nguyen", "Kim", "Lopez", "Chen"]
+OTHER_FIELDS = ["Non-smoker", "Smoker", "Diabetic", "Hypertension", "Initial assessment", "Follow-up"]
+NOTES = ["Normal", "Slightly low", "Slightly high", "Recheck", "Initial prescription", "Increased dosage"]
+
+# Number of physicians the assignments draw from
+PHYSICIANS = 500
+
+# Rows all five tables hold together per patient for a given fan-out
+def rows_per_patient(fanout=DEFAULT_FANOUT):
+    per_visit = 1 + fanout["labs_per_visit"] + fanout["meds_per_visit"] + fanout["physicians_per_visit"]
+    return 1 + fanout["visits_per_patient"] * per_visit
+
+# Number of patients that gives about "rows" rows over all five tables
+def patients_for_rows(rows, fanout=DEFAULT_FANOUT):
+    return max(1, round(rows / rows_per_patient(fanout)))
+
+# Zero-padded IDs such as P0000001, as wide as the largest number needs
+def make_ids(prefix, numbers):
+    width = len(str(max(int(numbers.max()) if len(numbers) else 0, 1)))
+    return np.char.add(prefix, np.char.zfill(numbers.astype(str), width)).astype(object)
+
+# Pick values from "choices", leaving a share "missing" of them empty
+def choose(rng, choices, size, missing=0.0):
+    values = np.asarray(choices, dtype=object)[rng.integers(0, len(choices), size)]
+    values[rng.random(size) < missing] = None
+    return values
+
+# Repeat a share of the rows at random positions (exact duplicates, as clean_data expects to find)
+def add_duplicates(rng, df, share):
+    duplicates = df.iloc[rng.integers(0, len(df), int(len(df) * share))] if len(df) else df
+    return pd.concat([df, duplicates]).sort_index(kind="stable").reset_index(drop=True)
+
+# Generate the five source tables for "patients" patients. Every visit belongs to a generated patient, and every
+# lab result, medication and physician assignment to a generated visit (and its patient). The data is dirty the
+# way the real files are: missing ages and genders, g/dL units, "5mg" dosages, missing results, null notes and
+# duplicate rows. The same seed always gives the same data.
+def generate_dataset(patients, fanout=None, dirt=None, seed=42):
+    fanout = {**DEFAULT_FANOUT, **(fanout or {})}
+    dirt = {**DEFAULT_DIRT, **(dirt or {})}
+    rng = np.random.default_rng(seed)
+
+    patient_ids = make_ids("P", np.arange(1, patients + 1))
+    age = pd.array(rng.integers(18, 90, patients), dtype="Int64")
+    age[rng.random(patients) < dirt["missing_age"]] = pd.NA
+    demographics = pd.DataFrame({
+        "patient_id": patient_ids,
+        "age": age,
+        "gender": choose(rng, ["Male", "Female"], patients, dirt["missing_gender"]),
+        "other_fields": choose(rng, OTHER_FIELDS[:4], patients, 0.2)
+    })
+
+    # Visits are grouped by patient, in date order within each patient
+    visit_count = round(patients * fanout["visits_per_patient"])
+    visit_patient = np.sort(rng.integers(0, patients, visit_count))
+    visit_date = np.datetime64("2023-01-01") + rng.integers(0, 540, visit_count).astype("timedelta64[D]")
+    visit_ids = make_ids("V", np.arange(1, visit_count + 1))
+    visits = pd.DataFrame({
+        "patient_id": patient_ids[visit_patient],
+        "visit_id": visit_ids,
+        "visit_date": pd.to_datetime(visit_date).strftime("%Y-%m-%d"),
+        "diagnosis": choose(rng, DIAGNOSES, visit_count),
+        "medication": choose(rng, MEDICATIONS, visit_count, dirt["missing_medication"]),
+        "other_fields": choose(rng, OTHER_FIELDS[4:], visit_count, 0.3)
+    })
+
+    # Rows of a child table, each attached to a random visit
+    def child_rows(per_visit):
+        count = round(visit_count * per_visit)
+        return count, rng.integers(0, visit_count, count)
+
+    lab_count, lab_visit = child_rows(fanout["labs_per_visit"])
+    test = rng.integers(0, len(LAB_TESTS), lab_count)
+    names, units, ranges, means, stds = (np.array(column, dtype=object) for column in zip(*LAB_TESTS))
+    result_value = rng.normal(means[test].astype(float), stds[test].astype(float)).round(1)
+    result_value[rng.random(lab_count) < dirt["missing_result"]] = np.nan
+    lab_results = pd.DataFrame({
+        "patient_id": patient_ids[visit_patient[lab_visit]],
+        "lab_test_id": make_ids("L", np.arange(1, lab_count + 1)),
+        "visit_id": visit_ids[lab_visit],
+        "test_date": pd.to_datetime(visit_date[lab_visit] + np.timedelta64(1, "D")).strftime("%Y-%m-%d"),
+        "test_name": names[test],
+        "result_value": result_value,
+        "result_unit": units[test],
+        "reference_range": ranges[test],
+        "notes": choose(rng, NOTES[:4], lab_count, dirt["missing_notes"])
+    })
+
+    med_count, med_visit = child_rows(fanout["meds_per_visit"])
+    start_date = visit_date[med_visit]
+    medications = pd.DataFrame({
+        "patient_id": patient_ids[visit_patient[med_visit]],
+        "medication_id": make_ids("M", np.arange(1, med_count + 1)),
+        "visit_id": visit_ids[med_visit],
+        "medication": choose(rng, MEDICATIONS, med_count),
+        "dosage": choose(rng, DOSAGES, med_count),
+        "start_date": pd.to_datetime(start_date).strftime("%Y-%m-%d"),
+        "end_date": pd.to_datetime(start_date + rng.integers(14, 90, med_count).astype("timedelta64[D]")).strftime("%Y-%m-%d"),
+        "notes": choose(rng, NOTES[4:], med_count, dirt["missing_notes"])
+    })
+
+    # Assignments cycle through the visits, so a visit gets several distinct physicians when physicians_per_visit > 1
+    assignment_count = round(visit_count * fanout["physicians_per_visit"])
+    assignment_visit = np.arange(assignment_count) % max(visit_count, 1)
+    physician = (rng.integers(0, PHYSICIANS, assignment_count) + np.arange(assignment_count) // max(visit_count, 1)) % PHYSICIANS
+    assignments = pd.DataFrame({
+        "patient_id": patient_ids[visit_patient[assignment_visit]],
+        "visit_id": visit_ids[assignment_visit],
+        "physician_id": make_ids("PH", physician + 1),
+        "physician_name": np.char.add("Dr. ", np.asarray(PHYSICIAN_NAMES)[physician % len(PHYSICIAN_NAMES)]).astype(object),
+        "assignment_date": visits["visit_date"].to_numpy()[assignment_visit],
+        "department": np.asarray(DEPARTMENTS, dtype=object)[physician % len(DEPARTMENTS)]
+    })
+
+    data = {
+        "patient_demographics": demographics,
+        "patient_visits": visits,
+        "patient_lab_results": lab_results,
+        "physician_assignments": assignments,
+        "patient_medications": medications
+    }
+    return {key: add_duplicates(rng, df, dirt["duplicate_rows"]) for key, df in data.items()}
+
+# Write the generated tables as the pipeline's source CSV files
+def write_dataset(data, directory):
+    os.makedirs(directory, exist_ok=True)
+    for key, df in data.items():
+        df.to_csv(os.path.join(directory, FILES[key]), index=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic clinical dataset in the layout of data/*.csv")
+    parser.add_argument("--rows", type=int, default=100_000, help="Approximate number of rows over all five tables")
+    parser.add_argument("--output", default=os.path.join("data", "synthetic"), help="Directory to write the CSV files to")
+    parser.add_argument("--seed", type=int, default=42)
+    for name, value in DEFAULT_FANOUT.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=float, default=value)
+    args = parser.parse_args()
+    fanout = {name: getattr(args, name) for name in DEFAULT_FANOUT}
+    dataset = generate_dataset(patients_for_rows(args.rows, fanout), fanout=fanout, seed=args.seed)
+    write_dataset(dataset, args.output)
+    print(", ".join(f"{key}: {len(df)} rows" for key, df in dataset.items()))
@@ -0,0 +1,310 @@
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from sqlalchemy import MetaData, Table, inspect, text
+from bulk_load import copy_insert, quote_table
+from engine_registry import pool_capacity
+from metrics import span
+
+# Default number of rows per migrated batch (one server-side fetch, one COPY and one commit per batch)
+DEFAULT_MIGRATION_BATCH_SIZE = 50_000
+
+# Number of batches fetched ahead of the batch being written
+DEFAULT_PREFETCH = 1
+
+# Destination table recording, per migrated table, the last key of the last committed batch
+CHECKPOINT_TABLE = "migration_checkpoints"
+
+# Suffix of the checkpoint recording how a table's migration was planned (mode, keys, partitions...)
+PLAN_SUFFIX = "#plan"
+
+# Keyset column standing for the source row's ctid, added when no unique key orders the table (never copied)
+ROW_ID = "source_ctid"
+
+# Create the checkpoint table in the destination schema if needed
+def ensure_checkpoint_table(engine, schema):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {quote_table(CHECKPOINT_TABLE, schema)} ("
+            f"table_name TEXT PRIMARY KEY, last_key TEXT NOT NULL, rows_copied BIGINT NOT NULL, "
+            f"updated_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        )
+
+# Read the checkpoint left by an interrupted migration of a table: (last key, rows copied), or None
+def read_checkpoint(engine, table_name, schema):
+    with engine.connect() as connection:
+        row = connection.execute(
+            text(f"SELECT last_key, rows_copied FROM {quote_table(CHECKPOINT_TABLE, schema)} WHERE table_name = :table_name"),
+            {"table_name": table_name}
+        ).one_or_none()
+    return None if row is None else (json.loads(row[0]), row[1])
+
+# Insert or replace one checkpoint row; "value" is stored as JSON
+def write_checkpoint(connection, checkpoint_name, value, rows_copied, schema):
+    connection.execute(
+        text(f"INSERT INTO {quote_table(CHECKPOINT_TABLE, schema)} (table_name, last_key, rows_copied) "
+             f"VALUES (:table_name, :last_key, :rows_copied) "
+             f"ON CONFLICT (table_name) DO UPDATE SET last_key = EXCLUDED.last_key, "
+             f"rows_copied = EXCLUDED.rows_copied, updated_at = now()"),
+        {"table_name": checkpoint_name, "last_key": json.dumps(value, default=str), "rows_copied": rows_copied}
+    )
+
+# Record the last key of a batch, on the connection (and in the transaction) that wrote the batch
+def save_checkpoint(connection, table_name, last_key, rows_copied, schema):
+    write_checkpoint(connection, table_name, last_key, rows_copied, schema)
+
+# Names of the checkpoints a table's migration leaves: the table's own, its plan's and its partitions' ("table#0", ...)
+def checkpoint_names(engine, table_name, schema):
+    with engine.connect() as connection:
+        return connection.execute(
+            text(f"SELECT table_name FROM {quote_table(CHECKPOINT_TABLE, schema)} "
+                 f"WHERE table_name = :table_name OR left(table_name, length(:prefix)) = :prefix ORDER BY table_name"),
+            {"table_name": table_name, "prefix": f"{table_name}#"}
+        ).scalars().all()
+
+# Remove every checkpoint of a table's migration, once it is complete or to start it over with other settings
+def clear_migration_checkpoints(engine, table_name, schema):
+    with engine.begin() as connection:
+        connection.execute(
+            text(f"DELETE FROM {quote_table(CHECKPOINT_TABLE, schema)} "
+                 f"WHERE table_name = :table_name OR left(table_name, length(:prefix)) = :prefix"),
+            {"table_name": table_name, "prefix": f"{table_name}#"}
+        )
+
+# Plan of the interrupted migration of a table that "plan" ({"mode": ..., "keys": ..., ...}) resumes, or None when
+# the table has no checkpoints. Checkpoints left by a run in another mode, on other keys or with another partitioning
+# would be continued from the wrong place, so they raise a ValueError until clear_migration_checkpoints removes them.
+def resume_plan(engine, table_name, plan, schema):
+    ensure_checkpoint_table(engine, schema)
+    if not checkpoint_names(engine, table_name, schema):
+        return None
+    recorded = read_checkpoint(engine, f"{table_name}{PLAN_SUFFIX}", schema)
+    recorded = None if recorded is None else recorded[0]
+    if recorded is None or any(recorded.get(key) != value for key, value in plan.items()):
+        raise ValueError(f"The checkpoints of an interrupted migration of {table_name} (plan {recorded}) do not match this "
+                         f"run ({plan}); rerun with the same settings or remove them with clear_migration_checkpoints")
+    return recorded
+
+# Record the plan of a table's migration when it starts
+def save_plan(engine, table_name, plan, schema):
+    with engine.begin() as connection:
+        write_checkpoint(connection, f"{table_name}{PLAN_SUFFIX}", plan, 0, schema)
+
+# Keyset columns a table is read and checkpointed in. Resuming reads the rows after the last committed key, so the
+# keyset must be unique or the rows sharing a key across a batch boundary would be skipped: "keys" are used as they
+# are when a primary key, unique constraint or unique index of the source covers them; otherwise the primary key
+# columns are added as a tiebreaker, and for a table without one (as a replace load creates) its ctid is.
+# A ctid only stays put while the table is not updated or rewritten, which a migration source is not.
+def checkpoint_keys(source, table_name, keys):
+    inspector = inspect(source)
+    primary_key = inspector.get_pk_constraint(table_name)["constrained_columns"]
+    unique_keys = [primary_key] + [constraint["column_names"] for constraint in inspector.get_unique_constraints(table_name)]
+    unique_keys += [index["column_names"] for index in inspector.get_indexes(table_name) if index["unique"]]
+    if any(unique and set(unique) <= set(keys) for unique in unique_keys):
+        return list(keys)
+    if primary_key:
+        return list(keys) + [column for column in primary_key if column not in keys]
+    logging.warning(f"{table_name} has no unique key; ordering its migration by ({', '.join(keys)}, ctid)")
+    return list(keys) + [ROW_ID]
+
+# SQL expression of a keyset column (ROW_ID is the row's ctid)
+def key_expression(key):
+    return "ctid" if key == ROW_ID else f'"{key}"'
+
+# Keyset query reading a table in key order, starting after last_key when resuming.
+# "partition" = (column, lower, upper) restricts it to lower <= column < upper; a missing bound is open,
+# and the partition without a lower bound also takes the rows where the column is NULL.
+def build_source_query(table_name, keys, last_key=None, partition=None):
+    key_list = ", ".join(key_expression(key) for key in keys)
+    conditions = []
+    params = {}
+    if partition is not None:
+        column, lower, upper = partition
+        if lower is not None:
+            conditions.append(f'"{column}" >= :lower')
+            params["lower"] = lower
+        if upper is not None:
+            conditions.append(f'("{column}" < :upper OR "{column}" IS NULL)' if lower is None else f'"{column}" < :upper')
+            params["upper"] = upper
+    if last_key is not None:
+        values = [f"CAST(:key_{i} AS tid)" if key == ROW_ID else f":key_{i}" for i, key in enumerate(keys)]
+        conditions.append(f"({key_list}) > ({', '.join(values)})")
+        params.update({f"key_{i}": value for i, value in enumerate(last_key)})
+    query = f'SELECT *, ctid::text AS "{ROW_ID}" FROM "{table_name}"' if ROW_ID in keys else f'SELECT * FROM "{table_name}"'
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return f"{query} ORDER BY {key_list}", params
+
+# Iterate over batches while a background thread fetches up to "depth" batches ahead, so reading the next batch
+# from the source overlaps with writing the current one. Stops the fetching thread if the consumer stops early.
+def prefetch_batches(batches, depth=DEFAULT_PREFETCH):
+    pending = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    # Put an item in the queue unless the consumer has stopped; returns whether it was handed over
+    def hand_over(item):
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Fetch batches into the queue, then hand over the end marker or the exception that ended the fetch
+    def fetch():
+        try:
+            for batch in batches:
+                if not hand_over(batch):
+                    return
+            hand_over(done)
+        except Exception as e:
+            hand_over(e)
+
+    fetcher = threading.Thread(target=fetch, daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            batch = pending.get()
+            if batch is done:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stopped.set()
+        fetcher.join()
+
+# Recreate the destination table, empty, with the column types of the source table
+def create_destination_table(table_name, source, destination, schema):
+    source_table = Table(table_name, MetaData(), autoload_with=source)
+    pd.DataFrame(columns=[column.name for column in source_table.columns]).to_sql(
+        table_name, destination, if_exists="replace", index=False, schema=schema,
+        dtype={column.name: column.type for column in source_table.columns}
+    )
+
+# Copy the rows of one source query to the destination table batch by batch, holding at most prefetch + 1 batches
+# in memory. The query is read through a server-side cursor, "prefetch" batches ahead of the writes; each batch is
+# written with COPY and committed together with the checkpoint "checkpoint_name", so a failed run can resume after
+# the last committed batch. Returns the rows copied under that checkpoint, including those of earlier runs.
+# Timed as a "copy_query" span with the rows copied by this run (the COPY batches add the bytes they send).
+def copy_query(checkpoint_name, table_name, query, params, source, destination, keys, schema, rows_copied=0,
+               batch_size=DEFAULT_MIGRATION_BATCH_SIZE, prefetch=DEFAULT_PREFETCH):
+    with span("copy_query", table=checkpoint_name) as record, \
+            source.connect().execution_options(stream_results=True, max_row_buffer=batch_size) as source_connection:
+        rows_before = rows_copied
+        batches = pd.read_sql(text(query), source_connection, params=params, chunksize=batch_size)
+        for batch_number, batch in enumerate(prefetch_batches(batches, prefetch), 1):
+            # pandas yields one empty frame when the query returns no rows (a finished or empty partition)
+            if batch.empty:
+                continue
+            batch_start = time.perf_counter()
+            with destination.begin() as connection:
+                batch.drop(columns=[ROW_ID], errors="ignore").to_sql(table_name, connection, if_exists="append", index=False,
+                                                                     schema=schema, method=copy_insert)
+                rows_copied += len(batch)
+                save_checkpoint(connection, checkpoint_name, batch[keys].iloc[-1].tolist(), rows_copied, schema)
+            elapsed = time.perf_counter() - batch_start
+            logging.info(f"Migrated batch {batch_number} of {checkpoint_name}: {len(batch)} rows in {elapsed:.2f}s "
+                         f"({len(batch) / elapsed if elapsed > 0 else float('inf'):,.0f} rows/sec), {rows_copied} rows total")
+        record.update(rows_in=rows_copied - rows_before, rows_out=rows_copied - rows_before)
+    return rows_copied
+
+# Copy one table from source to destination in batches of batch_size rows through one server-side cursor (see copy_query).
+# A fresh run recreates the destination table with the source's column types; a run that finds a checkpoint resumes
+# after its last key, if the checkpoint was left by a streaming run on the same keys (see resume_plan).
+# Returns the number of rows copied.
+def migrate_table_streaming(table_name, source, destination, keys, schema, batch_size=DEFAULT_MIGRATION_BATCH_SIZE, prefetch=DEFAULT_PREFETCH):
+    keys = checkpoint_keys(source, table_name, keys)
+    plan = {"mode": "streaming", "keys": keys}
+    if resume_plan(destination, table_name, plan, schema) is None:
+        create_destination_table(table_name, source, destination, schema)
+        save_plan(destination, table_name, plan, schema)
+        last_key, rows_copied = None, 0
+    else:
+        last_key, rows_copied = read_checkpoint(destination, table_name, schema) or (None, 0)
+        logging.info(f"Resuming migration of {table_name} after key {last_key} ({rows_copied} rows already copied)")
+
+    start = time.perf_counter()
+    query, params = build_source_query(table_name, keys, last_key)
+    rows_copied = copy_query(table_name, table_name, query, params, source, destination, keys, schema,
+                             rows_copied=rows_copied, batch_size=batch_size, prefetch=prefetch)
+    clear_migration_checkpoints(destination, table_name, schema)
+    elapsed = time.perf_counter() - start
+    logging.info(f"Migrated {table_name}: {rows_copied} rows, {elapsed:.2f}s for this run")
+    return rows_copied
+
+# Split a table into "partitions" ranges of about the same number of rows on "column":
+# the boundaries are the column's quantiles, computed by the database (percentile_disc works on any sortable type)
+def compute_partition_boundaries(source, table_name, column, partitions):
+    fractions = [index / partitions for index in range(1, partitions)]
+    if not fractions:
+        return []
+    with source.connect() as connection:
+        boundaries = connection.execute(
+            text(f'SELECT percentile_disc(CAST(:fractions AS float8[])) WITHIN GROUP (ORDER BY "{column}") FROM "{table_name}"'),
+            {"fractions": fractions}
+        ).scalar_one()
+    return sorted({boundary for boundary in boundaries or [] if boundary is not None})
+
+# Partitions of a table that can stream at once without waiting for a pooled connection, out of "partitions":
+# each holds a source connection and, while writing a batch, a destination connection (two connections of the same
+# pool when source is destination), and "tables" tables migrating at the same time share the pools.
+# Pools without a known capacity (see engine_registry.pool_capacity) do not limit them.
+def partition_threads(source, destination, partitions, tables=1):
+    pools = [(source, 2)] if source.pool is destination.pool else [(source, 1), (destination, 1)]
+    threads = partitions
+    for engine, connections in pools:
+        capacity = pool_capacity(engine)
+        if capacity is not None:
+            threads = min(threads, capacity // (connections * tables))
+    return max(1, threads)
+
+# Copy one table in "partitions" ranges of "partition_column" (the first key column by default), each streamed over
+# its own pooled connection and writing its batches independently (see copy_query). At most partition_threads of
+# them run at once, so the threads never wait on the pools; "tables" is the number of tables migrating alongside.
+# The boundaries are stored in the plan checkpoint, so a resumed run splits the table the same way and every
+# partition continues after its own last committed batch; a run with another column or number of partitions is
+# refused while those checkpoints exist (see resume_plan). Returns the number of rows copied.
+def migrate_table_partitioned(table_name, source, destination, keys, schema, partitions, partition_column=None,
+                              batch_size=DEFAULT_MIGRATION_BATCH_SIZE, prefetch=DEFAULT_PREFETCH, tables=1):
+    column = partition_column or keys[0]
+    keys = checkpoint_keys(source, table_name, keys)
+    plan = {"mode": "partitioned", "keys": keys, "column": column, "partitions": partitions}
+    recorded = resume_plan(destination, table_name, plan, schema)
+    if recorded is None:
+        boundaries = compute_partition_boundaries(source, table_name, column, partitions)
+        create_destination_table(table_name, source, destination, schema)
+        save_plan(destination, table_name, {**plan, "boundaries": boundaries}, schema)
+    else:
+        boundaries = recorded["boundaries"]
+        logging.info(f"Resuming partitioned migration of {table_name} on {column} boundaries {boundaries}")
+    bounds = [None] + boundaries + [None]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+
+    # Stream one partition, continuing after its checkpoint if it has one
+    def migrate_partition(index):
+        checkpoint_name = f"{table_name}#{index}"
+        last_key, rows_copied = read_checkpoint(destination, checkpoint_name, schema) or (None, 0)
+        lower, upper = ranges[index]
+        query, params = build_source_query(table_name, keys, last_key, partition=(column, lower, upper))
+        return copy_query(checkpoint_name, table_name, query, params, source, destination, keys, schema,
+                          rows_copied=rows_copied, batch_size=batch_size, prefetch=prefetch)
+
+    threads = partition_threads(source, destination, len(ranges), tables)
+    if threads < len(ranges):
+        logging.warning(f"Streaming {threads} of the {len(ranges)} partitions of {table_name} at a time, as many as the "
+                        f"connection pools hold; raise DB_POOL_SIZE / DB_MAX_OVERFLOW to run more")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        rows_copied = sum(executor.map(migrate_partition, range(len(ranges))))
+    clear_migration_checkpoints(destination, table_name, schema)
+    elapsed = time.perf_counter() - start
+    logging.info(f"Migrated {table_name} in {len(ranges)} partitions on {column}: {rows_copied} rows, "
+                 f"{elapsed:.2f}s for this run ({rows_copied / elapsed if elapsed > 0 else float('inf'):,.0f} rows/sec)")
+    return rows_copied
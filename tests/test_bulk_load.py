@@ -0,0 +1,111 @@
+from unittest.mock import MagicMock
+
+import pandas as pd
+import pytest
+from sqlalchemy import Date, Float, String
+
+from bulk_load import build_upsert_sql, copy_insert, delete_rows, replace_table, upsert_table
+
+lab_results = pd.DataFrame({
+    "lab_test_id": ["L001", "L002", "L003"],
+    "test_date": pd.to_datetime(["2023-01-16", "2023-02-21", None]),
+    "result_value": [105.0, None, 13500.0],
+    "result_unit": ["MG/DL", "MG/DL", "MG/DL"],
+    "patient_lab_results_notes": ["NORMAL", None, "SLIGHTLY LOW, RECHECK"]
+})
+
+lab_results_dtype = {
+    "lab_test_id": String(50),
+    "test_date": Date(),
+    "result_value": Float(),
+    "result_unit": String(50),
+    "patient_lab_results_notes": String(255)
+}
+
+# Test copy_insert sends a batch as one COPY FROM STDIN with NULLs as empty unquoted fields
+def test_copy_insert_streams_batch_through_copy():
+    table = MagicMock()
+    table.name, table.schema = "patient_lab_results", "data_migration"
+    conn = MagicMock()
+    cursor = conn.connection.cursor.return_value.__enter__.return_value
+
+    copy_insert(table, conn, ["lab_test_id", "result_value"], iter([("L001", 105.0), ("L002", None)]))
+
+    sql, buffer = cursor.copy_expert.call_args[0]
+    assert sql == 'COPY "data_migration"."patient_lab_results" ("lab_test_id", "result_value") FROM STDIN WITH (FORMAT csv)'
+    assert buffer.read().splitlines() == ["L001,105.0", "L002,"]
+
+# Test an unknown backend is rejected before anything is written
+def test_replace_table_rejects_unknown_backend():
+    with pytest.raises(ValueError):
+        replace_table(lab_results, "patient_lab_results", MagicMock(), lab_results_dtype, backend="bcp")
+
+# Test the COPY backend round-trips values, NULLs and dates through a real PostgreSQL table
+@pytest.mark.requires_postgres
+def test_replace_table_copy_backend_round_trip(scratch_engine):
+    replace_table(lab_results, "test_bulk_load_lab_results", scratch_engine, lab_results_dtype, backend="copy", batch_size=2)
+    loaded = pd.read_sql("SELECT * FROM test_bulk_load_lab_results ORDER BY lab_test_id", scratch_engine)
+    assert loaded["lab_test_id"].tolist() == ["L001", "L002", "L003"]
+    assert loaded["result_value"].isnull().tolist() == [False, True, False]
+    assert str(loaded["test_date"].iloc[0]) == "2023-01-16"
+    assert pd.isnull(loaded["test_date"].iloc[2])
+    assert loaded["patient_lab_results_notes"].iloc[2] == "SLIGHTLY LOW, RECHECK"
+
+# Test the upsert statement only rewrites rows whose non-key columns changed
+def test_build_upsert_sql_skips_unchanged_rows():
+    sql = build_upsert_sql("patient_visits", "patient_visits_staging", ["visit_id", "diagnosis"], ["visit_id"])
+    assert 'ON CONFLICT ("visit_id") DO UPDATE SET "diagnosis" = EXCLUDED."diagnosis"' in sql
+    assert 'WHERE ROW("patient_visits"."diagnosis") IS DISTINCT FROM ROW(EXCLUDED."diagnosis")' in sql
+    assert "RETURNING (xmax = 0) AS inserted" in sql
+
+# Test a table made only of key columns ignores rows that already exist
+def test_build_upsert_sql_key_only_table_does_nothing_on_conflict():
+    sql = build_upsert_sql("links", "links_staging", ["patient_id", "visit_id"], ["patient_id", "visit_id"])
+    assert 'ON CONFLICT ("patient_id", "visit_id") DO NOTHING' in sql
+
+# Test a second upsert inserts new rows, updates changed rows and leaves the rest untouched
+@pytest.mark.requires_postgres
+def test_upsert_table_counts_inserted_updated_unchanged(scratch_engine):
+    first = upsert_table(lab_results, "test_bulk_load_upsert", scratch_engine, lab_results_dtype, ["lab_test_id"])
+    assert first == {"inserted": 3, "updated": 0, "unchanged": 0}
+
+    changed = lab_results.copy()
+    changed.loc[1, "result_value"] = 99.5
+    changed = pd.concat([changed, lab_results.iloc[[0]].assign(lab_test_id="L004")], ignore_index=True)
+    second = upsert_table(changed, "test_bulk_load_upsert", scratch_engine, lab_results_dtype, ["lab_test_id"], batch_size=2)
+    assert second == {"inserted": 1, "updated": 1, "unchanged": 2}
+
+    loaded = pd.read_sql("SELECT * FROM test_bulk_load_upsert ORDER BY lab_test_id", scratch_engine)
+    assert loaded["lab_test_id"].tolist() == ["L001", "L002", "L003", "L004"]
+    assert loaded["result_value"].iloc[1] == 99.5
+
+# Test a replace load keeps the last row per key and adds the primary key, so an upsert into the table works
+@pytest.mark.requires_postgres
+def test_upsert_into_replaced_table_with_duplicate_keys(scratch_engine):
+    duplicated = pd.concat([lab_results, lab_results.iloc[[1]].assign(result_value=42.0)], ignore_index=True)
+    replace_table(duplicated, "test_bulk_load_replaced", scratch_engine, lab_results_dtype, primary_keys=["lab_test_id"])
+    loaded = pd.read_sql("SELECT * FROM test_bulk_load_replaced ORDER BY lab_test_id", scratch_engine)
+    assert loaded["lab_test_id"].tolist() == ["L001", "L002", "L003"]
+    assert loaded["result_value"].iloc[1] == 42.0
+
+    changed = duplicated.iloc[[3]].assign(result_value=43.0)
+    counts = upsert_table(changed, "test_bulk_load_replaced", scratch_engine, lab_results_dtype, ["lab_test_id"])
+    assert counts == {"inserted": 0, "updated": 1, "unchanged": 0}
+
+# Test an upsert into a table without a primary key whose rows share keys fails with the duplicates named, unchanged
+@pytest.mark.requires_postgres
+def test_upsert_reports_duplicate_keys_of_table_without_primary_key(scratch_engine):
+    duplicated = pd.concat([lab_results, lab_results.iloc[[1]].assign(result_value=42.0)], ignore_index=True)
+    replace_table(duplicated, "test_bulk_load_unkeyed", scratch_engine, lab_results_dtype)
+    with pytest.raises(ValueError, match="duplicate keys: 1"):
+        upsert_table(lab_results, "test_bulk_load_unkeyed", scratch_engine, lab_results_dtype, ["lab_test_id"])
+    assert len(pd.read_sql("SELECT * FROM test_bulk_load_unkeyed", scratch_engine)) == 4
+
+# Test only the rows with a listed key are deleted, and keys no longer in the table are not counted
+@pytest.mark.requires_postgres
+def test_delete_rows(scratch_engine):
+    replace_table(lab_results, "test_bulk_load_delete", scratch_engine, lab_results_dtype)
+    deleted = delete_rows(pd.DataFrame({"lab_test_id": ["L002", "L009"]}), "test_bulk_load_delete", scratch_engine, ["lab_test_id"])
+    assert deleted == 1
+    loaded = pd.read_sql("SELECT lab_test_id FROM test_bulk_load_delete ORDER BY lab_test_id", scratch_engine)
+    assert loaded["lab_test_id"].tolist() == ["L001", "L003"]
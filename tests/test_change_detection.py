@@ -0,0 +1,40 @@
+import pandas as pd
+
+from change_detection import classify_rows, file_fingerprint, hash_frame, load_state, row_hashes, save_state
+
+previous_rows = pd.DataFrame({"lab_test_id": ["L001", "L002", "L003"], "result_value": [105.0, None, 13.5]})
+
+# Test rows are classified by content hash, and new rows told apart from changed ones by their ID
+def test_classify_rows_new_changed_unchanged_deleted():
+    previous = hash_frame(previous_rows, ["lab_test_id"], row_hashes(previous_rows))
+    current = pd.DataFrame({"lab_test_id": ["L001", "L002", "L004"], "result_value": [105.0, 99.0, 7.0]})
+
+    process, counts = classify_rows(current, ["lab_test_id"], row_hashes(current), previous)
+
+    assert process.tolist() == [False, True, True]
+    assert counts == {"new": 1, "changed": 1, "unchanged": 1, "deleted": 1}
+
+# Test every row is processed when there is no stored state
+def test_classify_rows_without_state_processes_everything():
+    process, counts = classify_rows(previous_rows, ["lab_test_id"], row_hashes(previous_rows), None)
+    assert process.all()
+    assert counts["new"] == 3
+
+# Test categorical and object columns with the same values hash the same
+def test_row_hashes_ignore_categorical_codes():
+    as_object = pd.DataFrame({"unit": ["MG/DL", "G/DL", "MG/DL"]})
+    as_category = as_object.astype(pd.CategoricalDtype(["MG/DL", "G/DL"]))
+    assert (row_hashes(as_object) == row_hashes(as_category)).all()
+
+# Test the file fingerprint follows the content and the state round-trips
+def test_file_fingerprint_and_state(tmp_path):
+    path = tmp_path / "visits.csv"
+    path.write_text("patient_id,visit_id\nP001,V001\n")
+    first = file_fingerprint(path)
+    path.write_text("patient_id,visit_id\nP001,V002\n")
+    assert file_fingerprint(path) != first
+    assert file_fingerprint(tmp_path / "missing.csv") is None
+
+    assert load_state(tmp_path / "state") == {"files": {}}
+    save_state({"files": {"patient_visits": {"sha256": first, "rows": 1}}}, tmp_path / "state")
+    assert load_state(tmp_path / "state")["files"]["patient_visits"]["rows"] == 1
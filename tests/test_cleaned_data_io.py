@@ -0,0 +1,57 @@
+import pandas as pd
+import pyarrow.parquet as pq
+
+from cleaned_data_io import read_cleaned_data, read_table, write_parquet, write_table
+
+cleaned_data = pd.DataFrame({
+    "patient_id": ["P1", "P1", "P2", "P3"],
+    "age": [30, 30, 41, 52],
+    "visit_id": ["V1", "V2", "V3", "V4"],
+    "result_unit": ["MG/DL", "MG/DL", "MG/DL", "UNKNOWN"],
+    "result_value": [105.0, -999.0, 13500.0, 90.0]
+})
+
+# Test Parquet output keeps numeric dtypes and dictionary-encodes repeated strings
+def test_write_parquet_dictionary_encodes_repeated_strings(tmp_path):
+    path = tmp_path / "cleaned_data.parquet"
+    write_parquet(cleaned_data, path)
+    schema = pq.read_schema(path)
+    assert str(schema.field("result_unit").type).startswith("dictionary")
+    assert str(schema.field("visit_id").type) == "string"
+    df = pd.read_parquet(path)
+    assert df["age"].dtype == "int64"
+    assert df["result_value"].dtype == "float64"
+
+# Test read_cleaned_data only returns the requested columns, in the requested order
+def test_read_cleaned_data_projects_columns(tmp_path):
+    path = tmp_path / "cleaned_data.parquet"
+    write_parquet(cleaned_data, path)
+    df = read_cleaned_data(["visit_id", "patient_id"], parquet_path=path)
+    assert list(df.columns) == ["visit_id", "patient_id"]
+    assert df["visit_id"].tolist() == ["V1", "V2", "V3", "V4"]
+
+# Test read_cleaned_data falls back to the CSV export when there is no Parquet file
+def test_read_cleaned_data_falls_back_to_csv(tmp_path):
+    csv_path = tmp_path / "cleaned_data.csv"
+    cleaned_data.to_csv(csv_path, index=False)
+    df = read_cleaned_data(["result_value", "patient_id"], parquet_path=tmp_path / "missing.parquet", csv_path=csv_path)
+    assert list(df.columns) == ["result_value", "patient_id"]
+    assert len(df) == 4
+
+# Test read_table prefers the per-table file and a Parquet write replaces a CSV left by streaming
+def test_write_and_read_table(tmp_path):
+    cleaned_data.to_csv(tmp_path / "patient_lab_results.csv", index=False)
+    write_table(cleaned_data, "patient_lab_results", tables_dir=tmp_path)
+    assert not (tmp_path / "patient_lab_results.csv").exists()
+    df = read_table("patient_lab_results", ["visit_id", "result_value"], tables_dir=tmp_path)
+    assert list(df.columns) == ["visit_id", "result_value"]
+    assert len(df) == 4
+
+# Test dates keep their datetime64 type through a CSV table, as they do through Parquet
+def test_read_table_parses_csv_dates(tmp_path):
+    visits = pd.DataFrame({"visit_id": ["V1", "V2"], "visit_date": pd.to_datetime(["2023-01-15", None])})
+    write_table(visits, "patient_visits", tmp_path, export_csv=True)
+    (tmp_path / "patient_visits.parquet").unlink()
+    df = read_table("patient_visits", ["visit_id", "visit_date"], tables_dir=tmp_path)
+    assert df["visit_date"].dtype == "datetime64[ns]"
+    assert df["visit_date"].isna().tolist() == [False, True]
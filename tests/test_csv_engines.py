@@ -0,0 +1,33 @@
+import pandas as pd
+import pytest
+
+import etl_pipeline
+from csv_engines import read_csv
+from etl_pipeline import load_data
+
+# Test both engines read the sample files into identical frames
+def test_engines_match_on_sample_files():
+    expected = load_data(engine="pandas")
+    actual = load_data(engine="arrow")
+    assert list(actual) == list(expected)
+    for key in expected:
+        pd.testing.assert_frame_equal(actual[key], expected[key])
+
+# Test missing values, nullable integers and column projection read the same with both engines
+def test_engines_match_on_missing_values(tmp_path):
+    path = tmp_path / "demographics.csv"
+    path.write_text('patient_id,age,gender,other_fields\nP1,34,Male,\nP2,,NA,"Smoker, former"\nP3,51,None,N/A\n')
+    dtype = {"patient_id": "object", "age": "Int64", "gender": "object", "other_fields": "object"}
+    frames = {engine: read_csv(path, dtype, engine=engine) for engine in ("pandas", "arrow")}
+    pd.testing.assert_frame_equal(frames["arrow"], frames["pandas"])
+    assert frames["arrow"]["age"].isna().tolist() == [False, True, False]
+    assert frames["arrow"]["gender"].isna().tolist() == [False, True, True]
+    assert frames["arrow"]["other_fields"].tolist()[1] == "Smoker, former"
+
+    projected = read_csv(path, dtype, columns=["age", "patient_id"], engine="arrow")
+    assert list(projected.columns) == ["age", "patient_id"]
+
+# Test an unknown engine is rejected
+def test_unknown_engine(tmp_path):
+    with pytest.raises(ValueError):
+        etl_pipeline.read_source_file("patient_visits", engine="polars")
@@ -0,0 +1,28 @@
+import pandas as pd
+
+from date_parsing import detect_date_format, parse_dates
+
+# Test the format is detected from the values, day-first dates included
+def test_detect_date_format():
+    assert detect_date_format(["2023-01-15", "2023-02-01"]) == "%Y-%m-%d"
+    assert detect_date_format(["01/15/2023", "02/01/2023"]) == "%m/%d/%Y"
+    assert detect_date_format(["15/01/2023", "01/02/2023"]) == "%d/%m/%Y"
+    assert detect_date_format(["not a date"]) is None
+
+# Test repeated, missing and invalid dates of a text or categorical column, and the count of invalid dates
+def test_parse_dates():
+    dates = pd.Series(["2023-01-15", "2023-01-15", None, "2023-02-30", "unknown"], name="visit_date")
+    for series in (dates, dates.astype("category")):
+        parsed, invalid = parse_dates(series)
+        assert parsed.dtype == "datetime64[ns]"
+        assert parsed.tolist()[:2] == [pd.Timestamp("2023-01-15")] * 2
+        assert parsed.isna().tolist() == [False, False, True, True, True]
+        assert invalid == 2
+
+# Test an explicit format is used as given, and datetime64 columns are left alone
+def test_parse_dates_with_format():
+    parsed, invalid = parse_dates(pd.Series(["03/04/2023", "2023-03-04"]), "%d/%m/%Y")
+    assert parsed.tolist()[0] == pd.Timestamp("2023-04-03")
+    assert invalid == 1
+    dates = pd.Series(pd.to_datetime(["2023-01-15"]))
+    assert parse_dates(dates)[0] is dates
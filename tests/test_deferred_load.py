@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+
+from bulk_load import append_table
+from deferred_load import deferred_objects, finish_deferred_load, prepare_deferred_load
+
+SCHEMA = """
+-- Two tables with a key, a check, a foreign key, NOT NULL columns and an index
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id VARCHAR(10) PRIMARY KEY,
+    age INT CHECK (age >= -1)
+);
+
+CREATE TABLE IF NOT EXISTS visits (
+    visit_id VARCHAR(10) PRIMARY KEY,
+    patient_id VARCHAR(10) NOT NULL,
+    diagnosis TEXT NOT NULL,
+    FOREIGN KEY (patient_id) REFERENCES patients(patient_id)
+);
+
+CREATE INDEX idx_visits_diagnosis ON visits(diagnosis);
+"""
+
+TABLES = ["patients", "visits"]
+
+@pytest.fixture
+def schema_path(tmp_path):
+    path = tmp_path / "schema.sql"
+    path.write_text(SCHEMA)
+    return str(path)
+
+# The deferred objects as {(table, name): kind}
+def object_kinds(engine):
+    with engine.connect() as connection:
+        return {(item["table"], item["name"]): item["kind"] for item in deferred_objects(connection, TABLES)}
+
+# Test the load runs on bare tables, and afterwards every key, constraint, NOT NULL and index is back
+@pytest.mark.parametrize("unlogged", [False, True])
+@pytest.mark.requires_postgres
+def test_deferred_load_restores_objects(scratch_engine, schema_path, unlogged):
+    prepare_deferred_load(scratch_engine, TABLES, schema_path, defer=False)
+    expected = object_kinds(scratch_engine)
+    assert sorted(set(expected.values())) == ["check", "foreign key", "index", "not null", "primary key"]
+
+    objects = prepare_deferred_load(scratch_engine, TABLES, schema_path, unlogged=unlogged)
+    # Only the NOT NULL of the former primary key columns is left
+    assert object_kinds(scratch_engine) == {("patients", "patient_id"): "not null", ("visits", "visit_id"): "not null"}
+    append_table(pd.DataFrame({"patient_id": ["P1", "P2"], "age": [30, 40]}), "patients", scratch_engine)
+    append_table(pd.DataFrame({"visit_id": ["V1", "V2"], "patient_id": ["P1", "P2"], "diagnosis": ["ASTHMA", "FLU"]}),
+                 "visits", scratch_engine)
+    phases, failures = finish_deferred_load(scratch_engine, TABLES, objects, unlogged=unlogged, workers=2)
+
+    assert failures == []
+    assert object_kinds(scratch_engine) == expected
+    assert list(phases) == (["set_logged"] if unlogged else []) + ["build_indexes", "add_constraints", "validate_constraints", "analyze"]
+    with scratch_engine.connect() as connection:
+        assert set(connection.exec_driver_sql("SELECT relpersistence FROM pg_class WHERE oid IN ('patients'::regclass, 'visits'::regclass)").scalars()) == {"p"}
+
+# Test rows that break a check or a NOT NULL column are reported, and the check stays NOT VALID for them
+@pytest.mark.requires_postgres
+def test_deferred_load_reports_violations(scratch_engine, schema_path):
+    objects = prepare_deferred_load(scratch_engine, TABLES, schema_path)
+    append_table(pd.DataFrame({"patient_id": ["P1"], "age": [-5]}), "patients", scratch_engine)
+    append_table(pd.DataFrame({"visit_id": ["V1"], "patient_id": ["P1"], "diagnosis": [None]}), "visits", scratch_engine)
+    phases, failures = finish_deferred_load(scratch_engine, TABLES, objects)
+
+    assert sorted(failure["object"] for failure in failures) == ["patients.patients_age_check", "visits.diagnosis NOT NULL"]
+    with scratch_engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            "SELECT convalidated FROM pg_constraint WHERE conname = 'patients_age_check'").scalar() is False
+        assert connection.exec_driver_sql(
+            "SELECT attnotnull FROM pg_attribute WHERE attrelid = 'visits'::regclass AND attname = 'patient_id'").scalar() is True
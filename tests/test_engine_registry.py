@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import text
+
+import engine_registry
+from engine_registry import dispose_engines, get_engine, pool_stats
+
+# Start every test with an empty registry
+@pytest.fixture(autouse=True)
+def clean_registry():
+    dispose_engines()
+    yield
+    dispose_engines()
+
+# Test the same pooled engine is returned for a target and its connections are reused
+def test_get_engine_reuses_engine_and_connections(tmp_path):
+    url = f"sqlite:///{tmp_path / 'registry.db'}"
+    engine = get_engine("postgres", url)
+    assert get_engine("postgres", url) is engine
+
+    for _ in range(3):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+    stats = pool_stats("postgres")
+    assert stats["checkouts"] == 3
+    assert stats["connections_opened"] == 1
+    assert stats["waits"] == 0
+
+# Test a checkout that finds every connection in use is counted as a wait
+def test_pool_counts_waits_when_exhausted(tmp_path):
+    engine = get_engine("supabase", f"sqlite:///{tmp_path / 'registry.db'}", pool_size=1, max_overflow=0, pool_timeout=5)
+    held = engine.connect()
+    released = threading.Timer(0.2, held.close)
+    released.start()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    released.join()
+
+    stats = pool_stats("supabase")
+    assert stats["waits"] == 1
+    assert stats["wait_seconds"] > 0.1
+
+# Test dispose_engines empties the registry so the next call creates a fresh engine
+def test_dispose_engines_clears_registry(tmp_path):
+    engine = get_engine("postgres", f"sqlite:///{tmp_path / 'registry.db'}")
+    dispose_engines()
+    assert "postgres" not in engine_registry._engines
+    assert get_engine("postgres", f"sqlite:///{tmp_path / 'registry.db'}") is not engine
+
+# Test checkouts from many threads at once are all counted
+def test_pool_stats_count_concurrent_checkouts(tmp_path):
+    engine = get_engine("postgres", f"sqlite:///{tmp_path / 'registry.db'}", pool_size=4, max_overflow=4)
+
+    # Check out and return a connection many times
+    def check_out():
+        for _ in range(200):
+            with engine.connect():
+                pass
+
+    threads = [threading.Thread(target=check_out) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pool_stats("postgres")["checkouts"] == 1600
+
+# Test the pool keeps its configured max_overflow, including when it is recreated
+def test_pool_keeps_max_overflow(tmp_path):
+    engine = get_engine("postgres", f"sqlite:///{tmp_path / 'registry.db'}", pool_size=2, max_overflow=3)
+    assert engine.pool.max_overflow == 3
+    recreated = engine.pool.recreate()
+    assert recreated.max_overflow == 3
+    assert recreated.stats is engine.pool.stats
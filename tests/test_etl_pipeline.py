@@ -1,10 +1,20 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import pytest
+import numpy as np
 import pandas as pd
 import os
+import warnings
 
-from etl_pipeline import load_data, clean_data, merge_data, modify_range
+import etl_pipeline
+from etl_pipeline import load_data, clean_data, merge_data, modify_range, apply_lab_rules
+from etl_pipeline import run_streaming, drop_seen_duplicates, compute_stats, median_from_counts, build_tables, detect_changes, main
+from etl_pipeline import clean_data_parallel, split_partitions
+from etl_pipeline import normalize_text, dosage_to_mg, convert_categorical_ranges
+from cleaned_data_io import read_deleted_keys, read_table, tables_are_delta
+from change_detection import commit_pending_state
 from load_to_postgresdb import load_data_to_table
+from load_to_supabasedb import load_data_to_table as supabase_load_data_to_table
+from synthetic_data import generate_dataset, write_dataset
 
 # Test data setup
 test_data = {
@@ -59,7 +69,7 @@ test_data = {
 # Define fixture to be reused across tests
 @pytest.fixture
 def sample_data():
-    return test_data.copy()
+    return {key: df.copy() for key, df in test_data.items()}
 
 # ----------------------
 # Unit Tests -----------
@@ -67,15 +77,45 @@ def sample_data():
 
 # Test whether load_data function returns all required DataFrames
 def test_load_data(mocker):
-    mocker.patch("etl_pipeline.pd.read_csv", side_effect=lambda x: test_data[os.path.basename(x).split('.')[0]])
+    mocker.patch("etl_pipeline.pd.read_csv", side_effect=lambda x, **kwargs: test_data[os.path.basename(x).split('.')[0]])
     data = load_data()
     assert set(data.keys()) == set(test_data.keys())
 
-# Test whether clean_data removes all nulls and normalizes gender values
+# Test load_data reads the sample files with their explicit schemas, leaving the dates as text for clean_data to parse
+def test_load_data_applies_schemas():
+    data = load_data()
+    assert isinstance(data["physician_assignments"]["department"].dtype, pd.CategoricalDtype)
+    assert isinstance(data["patient_demographics"]["gender"].dtype, pd.CategoricalDtype)
+    assert not pd.api.types.is_numeric_dtype(data["patient_demographics"]["age"])
+    assert not pd.api.types.is_datetime64_any_dtype(data["patient_medications"]["start_date"])
+    assert list(data.keys()) == list(etl_pipeline.files.keys())
+    cleaned = clean_data(data)
+    assert pd.api.types.is_datetime64_any_dtype(cleaned["patient_medications"]["start_date"])
+    assert pd.api.types.is_datetime64_any_dtype(cleaned["patient_visits"]["visit_date"])
+    assert pd.api.types.is_integer_dtype(cleaned["patient_demographics"]["age"])
+
+# Test an age that is not a whole number is truncated and one that is not a number is filled with the median,
+# with both engines, instead of failing the file
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_load_data_coerces_ages(pipeline_dirs, engine):
+    demographics = pipeline_dirs / "patient_demographics.csv"
+    lines = demographics.read_text().splitlines(keepends=True)
+    first, second = lines[1].split(","), lines[2].split(",")
+    first[1], second[1] = "45.5", "unknown"
+    demographics.write_text("".join([lines[0], ",".join(first), ",".join(second)] + lines[3:]))
+    data = load_data(engine=engine)
+    assert len(data["patient_demographics"]) == len(lines) - 1
+    age = clean_data(data)["patient_demographics"]["age"]
+    expected_median = pd.Series([45.5] + [float(line.split(",")[1]) for line in lines[3:] if line.split(",")[1]]).median()
+    assert age.iloc[0] == 45
+    assert age.iloc[1] == int(expected_median)
+
+# Test whether clean_data removes all nulls (except missing dates, which stay missing) and normalizes gender values
 def test_clean_data(sample_data):
     cleaned_data = clean_data(sample_data)
     assert cleaned_data["patient_demographics"].isnull().sum().sum() == 0
-    assert cleaned_data["patient_visits"].isnull().sum().sum() == 0
+    assert cleaned_data["patient_visits"].drop(columns="visit_date").isnull().sum().sum() == 0
+    assert cleaned_data["patient_visits"]["visit_date"].isna().tolist() == [False, True, False]
     assert cleaned_data["patient_medications"].isnull().sum().sum() == 0
     assert cleaned_data["physician_assignments"].isnull().sum().sum() == 0
     assert cleaned_data["patient_demographics"]["gender"].unique().tolist() == ["MALE", "FEMALE", "UNKNOWN"]
@@ -113,8 +153,8 @@ def test_load_data_to_table_calls_to_sql(mock_to_sql):
         "patient_demographics_other_fields": ["DATA"]
     })
 
-    # Patch the global final_data used in load_to_postgresdb
-    with patch("load_to_postgresdb.final_data", mock_df):
+    # Patch the global final_data used in load_to_postgresdb, and its engine so no database URL is needed
+    with patch("load_to_postgresdb.final_data", mock_df), patch("load_to_postgresdb.engine", MagicMock()):
         table_name = "patient_demographics"
         columns = ["patient_id", "age", "age_group", "gender", "patient_demographics_other_fields"]
         dtypes = {
@@ -142,12 +182,7 @@ def test_result_unit_uppercase():
 
 # Test correct conversion of values and reference ranges for G/DL to MG/DL
 def test_update_g_dl_unit():
-    df = test_data["patient_lab_results"].copy()
-    if "result_unit" in df.columns and "reference_range" in df.columns:
-        g_dl_condition = df["result_unit"] == "G/DL"
-        df.loc[g_dl_condition, "result_value"] *= 1000
-        df.loc[g_dl_condition, "result_unit"] = "MG/DL"
-        df.loc[g_dl_condition, "reference_range"] = df.loc[g_dl_condition, "reference_range"].apply(modify_range)
+    df = apply_lab_rules(test_data["patient_lab_results"].copy())
     assert df["result_unit"].iloc[0] == "MG/DL"
     assert df["result_value"].iloc[0] == 15600  
     assert df["reference_range"].iloc[0] == "12000-16000" 
@@ -194,7 +229,297 @@ def apply_lab_notes(df):
                     df.at[index, "patient_lab_results_notes"] = "HIGH"
     return df
 
+# Test vectorized lab rules set NORMAL/LOW/HIGH only where notes are missing
+def test_apply_lab_rules_notes():
+    df = pd.DataFrame({
+        "result_value": [90.0, 60.0, 120.0, 130.0, None, 13.5],
+        "result_unit": ["mg/dL", "mg/dL", "mg/dL", "mg/dL", "mg/dL", "g/dL"],
+        "reference_range": ["70-110", "70-110", "70-110", "70-110", "70-110", "12-16"],
+        "notes": [None, None, None, "Above normal", None, None]
+    })
+    df = apply_lab_rules(df)
+    assert df["notes"].tolist()[:4] == ["NORMAL", "LOW", "HIGH", "Above normal"]
+    assert pd.isnull(df["notes"].iloc[4])
+    assert df["notes"].iloc[5] == "NORMAL"
+    assert df["result_unit"].tolist() == ["MG/DL"] * 6
+    assert df["reference_range"].iloc[5] == "12000-16000"
+
+# Test clean_data on the sample files matches the original row-by-row lab rules
+def test_clean_data_lab_results_sample_files():
+    lab_results = clean_data(load_data())["patient_lab_results"].set_index("lab_test_id")
+    assert lab_results.loc["L003", "result_value"] == 13500
+    assert lab_results.loc["L003", "notes"] == "SLIGHTLY LOW"
+    assert lab_results.loc["L007", "notes"] == "NORMAL"
+    assert lab_results.loc["L009", "notes"] == "NORMAL"
+    assert lab_results.loc["L009", "reference_range"] == "12000-16000"
+    assert lab_results.loc["L006", "notes"] == "UNKNOWN"
+
 # Ensure modify_range multiplies ranges by 1000
 def test_modify_range():
     assert modify_range("12-16") == "12000-16000"
-    assert modify_range("10-20") == "10000-20000"
\ No newline at end of file
+    assert modify_range("10-20") == "10000-20000"
+
+# ----------------------
+# Cleaned Tables Tests
+# ----------------------
+
+# Test build_tables keeps one row per source row and derives age_group and visit_frequency on their own tables
+def test_build_tables_has_no_fan_out():
+    cleaned_data = clean_data(load_data())
+    tables = build_tables(cleaned_data)
+    for key, df in cleaned_data.items():
+        assert len(tables[key]) == len(df)
+    demographics = tables["patient_demographics"].set_index("patient_id")
+    assert demographics.loc["P001", "age_group"] == "18-35"
+    assert demographics.loc["P008", "age_group"] == "36-65"
+    visits = tables["patient_visits"].set_index("visit_id")
+    assert visits.loc["V001", "visit_frequency"] == 2
+    assert visits.loc["V006", "visit_frequency"] == 1
+    assert "patient_lab_results_notes" in tables["patient_lab_results"].columns
+    assert "patient_medications_notes" in tables["patient_medications"].columns
+
+# Test the lab results table matches the rows the loaders used to rebuild from the merged view
+def test_build_tables_matches_merged_view():
+    cleaned_data = clean_data(load_data())
+    lab_results = build_tables(cleaned_data)["patient_lab_results"]
+    columns = list(lab_results.columns)
+    from_merged = merge_data(cleaned_data)[columns].dropna(subset=["lab_test_id"]).drop_duplicates()
+    pd.testing.assert_frame_equal(
+        lab_results.sort_values("lab_test_id").reset_index(drop=True),
+        from_merged.sort_values("lab_test_id").reset_index(drop=True)
+    )
+
+# ----------------------
+# Streaming Mode Tests
+# ----------------------
+
+# Test the median computed from value counts matches pandas' median
+def test_median_from_counts():
+    ages = pd.Series([34, 28, 45, 50, 29, 38, 60, 22, 40, 40])
+    assert median_from_counts(ages.value_counts()) == ages.median()
+    assert median_from_counts(ages.iloc[:-1].value_counts()) == ages.iloc[:-1].median()
+
+# Test duplicate rows are dropped even when they arrive in different chunks
+def test_drop_seen_duplicates_across_chunks():
+    seen = []
+    first, seen = drop_seen_duplicates(pd.DataFrame({"a": [1, 2, 2]}), seen)
+    second, seen = drop_seen_duplicates(pd.DataFrame({"a": [2, 3, 1]}), seen)
+    assert first["a"].tolist() == [1, 2]
+    assert second["a"].tolist() == [3]
+
+# Test many chunks keep a logarithmic number of sorted runs of hashes and still catch every earlier duplicate
+def test_drop_seen_duplicates_merges_runs():
+    seen, kept = [], []
+    for start in range(0, 1000, 10):
+        chunk, seen = drop_seen_duplicates(pd.DataFrame({"a": np.arange(start, start + 20) % 1000}), seen)
+        kept += chunk["a"].tolist()
+    assert sorted(kept) == list(range(1000))
+    assert len(seen) <= 10
+    assert all((run[1:] >= run[:-1]).all() for run in seen)
+    assert sum(len(run) for run in seen) == 1000
+
+# Test the streaming statistics carry a date format per date column, detected once from the first chunk
+def test_compute_stats_detects_date_formats():
+    stats = compute_stats(chunk_size=3)
+    assert stats["date_formats"] == {column: "%Y-%m-%d" for column in
+                                     ("visit_date", "test_date", "start_date", "end_date", "assignment_date")}
+
+# Test streaming the sample files in small chunks gives the same tables as cleaning them in memory
+def test_streaming_matches_in_memory_clean(tmp_path, monkeypatch):
+    monkeypatch.setattr(etl_pipeline, "tables_path", str(tmp_path))
+    monkeypatch.setattr(etl_pipeline, "quarantine_path", str(tmp_path / "quarantine"))
+    run_streaming(chunk_size=3)
+    tables = build_tables(clean_data(load_data()))
+    for key, df in tables.items():
+        df.to_csv(tmp_path / "expected.csv", index=False)
+        streamed = pd.read_csv(tmp_path / f"{key}.csv")
+        pd.testing.assert_frame_equal(streamed, pd.read_csv(tmp_path / "expected.csv"))
+
+# Test streaming cleans chunks it owns, not views of the chunks with duplicates dropped, so pandas raises no
+# SettingWithCopyWarning on synthetic data with duplicate rows and dirty values
+def test_streaming_raises_no_warnings(tmp_path, monkeypatch):
+    write_dataset(generate_dataset(200), str(tmp_path / "data"))
+    monkeypatch.setattr(etl_pipeline, "base_path", str(tmp_path / "data"))
+    monkeypatch.setattr(etl_pipeline, "tables_path", str(tmp_path / "cleaned"))
+    monkeypatch.setattr(etl_pipeline, "quarantine_path", str(tmp_path / "quarantine"))
+    # run_streaming logs the error of a failed file rather than raising it, so the warnings are recorded, not raised
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        run_streaming(chunk_size=100)
+    assert [str(warning.message) for warning in caught] == []
+
+# Point the pipeline at a copy of the sample files, with its own tables and state directories
+@pytest.fixture
+def pipeline_dirs(tmp_path, monkeypatch):
+    source = tmp_path / "data"
+    source.mkdir()
+    for filename in etl_pipeline.files.values():
+        (source / filename).write_bytes(open(os.path.join("data", filename), "rb").read())
+    monkeypatch.setattr(etl_pipeline, "base_path", str(source))
+    monkeypatch.setattr(etl_pipeline, "tables_path", str(tmp_path / "cleaned"))
+    monkeypatch.setattr(etl_pipeline, "state_path", str(tmp_path / "state"))
+    monkeypatch.setattr(etl_pipeline, "quarantine_path", str(tmp_path / "quarantine"))
+    return source
+
+# Test a second run over unchanged files skips every row and writes empty delta tables
+def test_incremental_run_skips_unchanged_files(pipeline_dirs):
+    main()
+    assert not tables_are_delta(etl_pipeline.tables_path)
+    assert len(read_table("patient_visits", tables_dir=etl_pipeline.tables_path)) == 15
+
+    commit_pending_state(etl_pipeline.state_path)
+    main()
+    assert tables_are_delta(etl_pipeline.tables_path)
+    for key in etl_pipeline.files:
+        assert read_table(key, tables_dir=etl_pipeline.tables_path).empty
+
+# Test rows the schema would reject are written to the quarantine with their reason instead of the cleaned tables
+def test_run_quarantines_invalid_rows(pipeline_dirs):
+    with open(pipeline_dirs / "patient_visits.csv", "a") as f:
+        f.write("P002,V099,2099-09-01,Anxiety,Escitalopram,Follow-up\n")
+    main()
+    visits = read_table("patient_visits", tables_dir=etl_pipeline.tables_path)
+    assert len(visits) == 15
+    assert "V099" not in set(visits["visit_id"])
+    quarantined = read_table("patient_visits", tables_dir=etl_pipeline.quarantine_path)
+    assert quarantined["visit_id"].tolist() == ["V099"]
+    assert quarantined["reason"].tolist() == ["CHECK (visit_date <= CURRENT_DATE)"]
+
+# Test only changed rows, and the visits whose visit_frequency moved, are processed
+def test_incremental_run_processes_changed_rows(pipeline_dirs):
+    main()
+    commit_pending_state(etl_pipeline.state_path)
+    lab_results = pipeline_dirs / "patient_lab_results.csv"
+    lab_results.write_text(lab_results.read_text().replace("P001,L001,V001,2023-01-16,Blood Glucose,105,",
+                                                           "P001,L001,V001,2023-01-16,Blood Glucose,115,"))
+    with open(pipeline_dirs / "patient_visits.csv", "a") as f:
+        f.write("P002,V099,2023-09-01,Anxiety,Escitalopram,Follow-up\n")
+
+    changes = detect_changes()
+    assert changes["report"]["patient_lab_results"]["changed"] == 1
+    assert changes["report"]["patient_lab_results"]["processed"] == 1
+    assert "patient_demographics" not in changes["data"]
+    assert changes["report"]["patient_demographics"]["skipped"] == 10
+    visits = changes["data"]["patient_visits"]
+    assert changes["report"]["patient_visits"]["new"] == 1
+    assert set(visits["visit_id"]) == set(visits["visit_id"][visits["patient_id"] == "P002"])
+    assert len(visits) == 3
+
+    tables = build_tables(clean_data(changes["data"], changes["stats"]), changes["visit_counts"])
+    assert tables["patient_lab_results"]["result_value"].tolist() == [115.0]
+    assert (tables["patient_visits"]["visit_frequency"] == 3).all()
+
+# Test full_rebuild processes every row even when the state says nothing changed
+def test_full_rebuild_processes_every_row(pipeline_dirs):
+    main()
+    commit_pending_state(etl_pipeline.state_path)
+    changes = detect_changes(full_rebuild=True)
+    assert changes["report"]["patient_visits"] == {"rows": 15, "new": 15, "changed": 0, "unchanged": 0, "deleted": 0,
+                                                    "skipped": 0, "processed": 15}
+
+# Test a run that was never loaded leaves the state of the last load in place, so the next run keeps its changes
+def test_unloaded_run_keeps_its_changes(pipeline_dirs):
+    main()
+    commit_pending_state(etl_pipeline.state_path)
+    with open(pipeline_dirs / "patient_visits.csv", "a") as f:
+        f.write("P002,V099,2023-09-01,Anxiety,Escitalopram,Follow-up\n")
+    main()
+    main()
+    assert "V099" in set(read_table("patient_visits", tables_dir=etl_pipeline.tables_path)["visit_id"])
+
+    assert commit_pending_state(etl_pipeline.state_path)
+    assert not commit_pending_state(etl_pipeline.state_path)
+    main()
+    assert read_table("patient_visits", tables_dir=etl_pipeline.tables_path).empty
+
+# Test the natural IDs of deleted source rows are written for the loaders, normalized as the cleaned tables hold them
+def test_incremental_run_writes_deleted_keys(pipeline_dirs):
+    main()
+    commit_pending_state(etl_pipeline.state_path)
+    lab_results = pipeline_dirs / "patient_lab_results.csv"
+    lines = lab_results.read_text().splitlines(keepends=True)
+    lab_results.write_text("".join(line for line in lines if ",L001," not in line))
+    main()
+    assert read_deleted_keys("patient_lab_results", tables_dir=etl_pipeline.tables_path)["lab_test_id"].tolist() == ["L001"]
+    assert read_deleted_keys("patient_visits", tables_dir=etl_pipeline.tables_path) is None
+    changes = detect_changes()
+    assert changes["report"]["patient_lab_results"]["deleted"] == 1
+
+# Test the loaders delete the rows an incremental run lists as deleted
+@patch("load_to_postgresdb.engine", object())
+@patch("load_to_postgresdb.delete_rows", return_value=1)
+@patch("load_to_postgresdb.upsert_table", return_value={"inserted": 0, "updated": 0, "unchanged": 0})
+@patch("load_to_postgresdb.read_deleted_keys")
+@patch("load_to_postgresdb.tables_are_delta", return_value=True)
+@patch("load_to_postgresdb.read_table")
+def test_load_data_to_table_deletes_rows(mock_read_table, mock_delta, mock_read_deleted, mock_upsert, mock_delete):
+    mock_read_table.return_value = pd.DataFrame({"patient_id": ["P1"], "age": [30]})
+    mock_read_deleted.return_value = pd.DataFrame({"patient_id": ["P2"]})
+    counts = load_data_to_table("patient_demographics", ["patient_id", "age"], {}, primary_keys=["patient_id"])
+    assert counts["deleted"] == 1
+    assert mock_delete.call_args.args[0]["patient_id"].tolist() == ["P2"]
+
+# Test the loaders upsert instead of replacing when the cleaned tables only hold changed rows
+@patch("load_to_postgresdb.engine", object())
+@patch("load_to_postgresdb.upsert_table", return_value={"inserted": 1, "updated": 0, "unchanged": 0})
+@patch("load_to_postgresdb.replace_table")
+@patch("load_to_postgresdb.tables_are_delta", return_value=True)
+@patch("load_to_postgresdb.read_table")
+def test_load_data_to_table_upserts_delta_tables(mock_read_table, mock_delta, mock_replace, mock_upsert):
+    mock_read_table.return_value = pd.DataFrame({"patient_id": ["P1"], "age": [30]})
+    load_data_to_table("patient_demographics", ["patient_id", "age"], {}, primary_keys=["patient_id"])
+    mock_replace.assert_not_called()
+    mock_upsert.assert_called_once()
+
+# Test the Supabase loader, which has no deferred mode, refuses it rather than replacing a table with a delta
+@patch("load_to_supabasedb.engine", object())
+@patch("load_to_supabasedb.upsert_table")
+@patch("load_to_supabasedb.replace_table")
+@patch("load_to_supabasedb.tables_are_delta", return_value=True)
+@patch("load_to_supabasedb.read_table")
+def test_supabase_load_rejects_deferred_mode(mock_read_table, mock_delta, mock_replace, mock_upsert):
+    mock_read_table.return_value = pd.DataFrame({"patient_id": ["P1"], "age": [30]})
+    assert supabase_load_data_to_table("patient_demographics", ["patient_id", "age"], {}, primary_keys=["patient_id"],
+                                       mode="deferred") is None
+    mock_replace.assert_not_called()
+    mock_upsert.assert_not_called()
+
+# Test identical rows always land in the same partition, so deduplication works per partition
+def test_split_partitions_keeps_duplicates_together():
+    df = pd.DataFrame({"patient_id": ["P1", "P2", "P1", "P3", "P2"], "age": [30, 40, 30, 50, 40]})
+    parts = split_partitions(df, 3)
+    part_of = pd.concat([pd.Series(number, index=part.index) for number, part in enumerate(parts)]).sort_index()
+    assert part_of.index.tolist() == [0, 1, 2, 3, 4]
+    assert part_of[0] == part_of[2]
+    assert part_of[1] == part_of[4]
+
+# Test cleaning on a process pool, with tables split into small partitions, matches the serial clean
+def test_clean_data_parallel_matches_serial():
+    serial = clean_data(load_data())
+    parallel = clean_data_parallel(load_data(), max_workers=2, partition_rows=4)
+    assert list(parallel) == list(serial)
+    for key, df in serial.items():
+        pd.testing.assert_frame_equal(parallel[key], df)
+
+# Test categorical text is uppercased per category, merging values that differ only by case, with nulls as UNKNOWN
+def test_normalize_text_categorical():
+    series = pd.Series(["Psychiatry", "PSYCHIATRY", None, "Neurology"], dtype="category")
+    normalized = normalize_text(series)
+    assert isinstance(normalized.dtype, pd.CategoricalDtype)
+    assert normalized.tolist() == ["PSYCHIATRY", "PSYCHIATRY", "UNKNOWN", "NEUROLOGY"]
+    assert sorted(normalized.cat.categories) == ["NEUROLOGY", "PSYCHIATRY", "UNKNOWN"]
+
+# Test categorical and object dosages convert to the same mg values
+def test_dosage_to_mg_categorical_matches_object():
+    dosage = pd.Series(["5mg", "10mg", None, "5mg"])
+    expected = dosage_to_mg(dosage)
+    pd.testing.assert_series_equal(dosage_to_mg(dosage.astype("category")), expected)
+    assert expected.tolist()[:2] == [5.0, 10.0]
+
+# Test only the masked rows of a categorical reference range are converted
+def test_convert_categorical_ranges():
+    ranges = pd.Series(["12-16", "12-16", None, "70-110"], dtype="category")
+    converted = convert_categorical_ranges(ranges, np.array([True, False, True, False]))
+    assert converted.astype(object).tolist()[:2] == ["12000-16000", "12-16"]
+    assert pd.isna(converted.iloc[2])
+    assert converted.iloc[3] == "70-110"
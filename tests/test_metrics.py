@@ -0,0 +1,88 @@
+import json
+import urllib.request
+
+import numpy as np
+import pytest
+
+import metrics
+from metrics import add_to_span, profiled, render_prometheus, span, start_metrics_server
+
+@pytest.fixture
+def metrics_file(tmp_path, monkeypatch):
+    path = tmp_path / "metrics.jsonl"
+    monkeypatch.setattr(metrics, "METRICS_FILE", str(path))
+    monkeypatch.setattr(metrics, "_totals", {})
+    return path
+
+# Read the span records written to the metrics file
+def read_records(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+# Test a span records its timing, counts and memory, and nested code reports to every open span
+def test_span_writes_record_with_counts(metrics_file):
+    with span("save_tables") as outer:
+        outer["rows_in"] = 3
+        with span("save_table", table="patient_visits") as inner:
+            inner["rows_in"] = 3
+            add_to_span("bytes_written", 100)
+            add_to_span("bytes_written", 20)
+
+    inner_record, outer_record = read_records(metrics_file)
+    assert inner_record["span"] == "save_table" and inner_record["parent"] == "save_tables"
+    assert inner_record["labels"] == {"table": "patient_visits"}
+    assert inner_record["bytes_written"] == 120 and outer_record["bytes_written"] == 120
+    assert outer_record["rows_in"] == 3 and outer_record["status"] == "ok"
+    assert outer_record["seconds"] >= inner_record["seconds"] >= 0
+    assert outer_record["rss_peak_bytes"] >= outer_record["rss_start_bytes"] > 0
+    assert inner_record["run_id"] == outer_record["run_id"]
+
+# Test memory is measured per span: a span after a larger one reports its own peak, not the process's high-water mark
+def test_span_memory_is_per_span(metrics_file):
+    with span("clean_table", table="patient_lab_results"):
+        values = np.ones(64 * 1024 ** 2 // 8)
+        del values
+    with span("clean_table", table="patient_visits"):
+        values = np.ones(1024)
+
+    large, small = read_records(metrics_file)
+    assert large["rss_growth_bytes"] >= 48 * 1024 ** 2
+    assert small["rss_growth_bytes"] < 16 * 1024 ** 2
+    assert small["rss_peak_bytes"] < large["rss_peak_bytes"]
+    assert small["rss_growth_bytes"] == small["rss_peak_bytes"] - small["rss_start_bytes"]
+
+# Test a span that raises is recorded as an error and the exception propagates
+def test_span_records_errors(metrics_file):
+    with pytest.raises(ValueError):
+        with span("clean_table", table="patient_lab_results"):
+            raise ValueError("bad data")
+    assert read_records(metrics_file)[0]["status"] == "error"
+    assert 'etl_span_errors_total{span="clean_table",table="patient_lab_results"} 1' in render_prometheus()
+
+# Test the Prometheus endpoint serves the span totals
+def test_metrics_endpoint_serves_totals(metrics_file):
+    for rows in (2, 5):
+        with span("load_table", table="patient_visits", target="postgres") as record:
+            record["rows_out"] = rows
+
+    server = start_metrics_server(0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+    assert 'etl_rows_out_total{span="load_table",table="patient_visits",target="postgres"} 7' in body
+    assert 'etl_span_runs_total{span="load_table",table="patient_visits",target="postgres"} 2' in body
+    assert "etl_peak_rss_bytes" in body
+
+# Test the profiling hook writes a cProfile file only when ETL_PROFILE_DIR is set
+def test_profiled_writes_stats_when_enabled(tmp_path, monkeypatch):
+    @profiled
+    def clean_data(values):
+        return sorted(values)
+
+    monkeypatch.setattr(metrics, "PROFILE_DIR", None)
+    assert clean_data([2, 1]) == [1, 2]
+    monkeypatch.setattr(metrics, "PROFILE_DIR", str(tmp_path / "profiles"))
+    assert clean_data([3, 1]) == [1, 3]
+    assert clean_data.__name__ == "clean_data"
+    assert [path.name.split("-")[0] for path in (tmp_path / "profiles").iterdir()] == ["clean_data"]
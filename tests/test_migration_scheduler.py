@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from migration_scheduler import parse_table_dependencies, run_migration
+from table_migration import prefetch_batches
+
+tables = ['patient_demographics', 'patient_visits', 'patient_lab_results', 'patient_medications', 'physician_assignments']
+
+# Test the foreign keys of sql/schema.sql give demographics -> visits -> the three child tables
+def test_parse_table_dependencies_from_schema():
+    dependencies = parse_table_dependencies()
+    assert dependencies["patient_demographics"] == set()
+    assert dependencies["patient_visits"] == {"patient_demographics"}
+    for table in ["patient_lab_results", "patient_medications", "physician_assignments"]:
+        assert dependencies[table] == {"patient_demographics", "patient_visits"}
+
+# Test every table starts after its parents finished, and the child tables run concurrently
+def test_run_migration_respects_foreign_key_order():
+    events = []
+    lock = threading.Lock()
+    running = []
+
+    def migrate_table(table):
+        with lock:
+            events.append(("start", table))
+            running.append(table)
+        time.sleep(0.05)
+        with lock:
+            events.append(("end", table, len(running)))
+            running.remove(table)
+        return 10
+
+    report, total = run_migration(tables, migrate_table, parse_table_dependencies(), max_workers=3)
+
+    position = {event[:2]: index for index, event in enumerate(events)}
+    assert position[("end", "patient_demographics")] < position[("start", "patient_visits")]
+    for table in ["patient_lab_results", "patient_medications", "physician_assignments"]:
+        assert position[("end", "patient_visits")] < position[("start", table)]
+    assert max(event[2] for event in events if event[0] == "end") == 3
+    assert all(entry["status"] == "done" and entry["rows"] == 10 for entry in report.values())
+    assert total < sum(entry["seconds"] for entry in report.values())
+
+# Test a failed table is reported and the tables referencing it are skipped
+def test_run_migration_skips_dependents_of_failed_table():
+    def migrate_table(table):
+        if table == "patient_visits":
+            raise RuntimeError("connection lost")
+        return 1
+
+    report, _ = run_migration(tables, migrate_table, parse_table_dependencies())
+    assert report["patient_demographics"]["status"] == "done"
+    assert report["patient_visits"]["status"] == "failed"
+    for table in ["patient_lab_results", "patient_medications", "physician_assignments"]:
+        assert report[table]["status"] == "skipped"
+
+# Test prefetched batches keep their order and fetch errors reach the consumer
+def test_prefetch_batches_order_and_errors():
+    assert list(prefetch_batches(iter(range(5)), depth=2)) == [0, 1, 2, 3, 4]
+
+    def failing():
+        yield 1
+        raise RuntimeError("cursor closed")
+
+    with pytest.raises(RuntimeError):
+        list(prefetch_batches(failing()))
+
+# Test the fetching thread stops when the consumer stops early
+def test_prefetch_batches_stops_fetcher_on_early_exit():
+    fetched = []
+
+    def batches():
+        for i in range(100):
+            fetched.append(i)
+            yield i
+
+    for batch in prefetch_batches(batches(), depth=1):
+        break
+    assert len(fetched) < 5
@@ -0,0 +1,83 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import query_cache
+from query_cache import cache_key, cache_stats, cached_query, evict, normalize_query
+
+VISITS_QUERY = """
+    SELECT patient_id, COUNT(*) AS number_of_visits
+    FROM cache_test_visits
+    GROUP BY patient_id
+    ORDER BY patient_id;
+"""
+
+# Test reformatting a query keeps its key, while other parameters or table versions change it
+def test_cache_key_normalizes_query():
+    versions = {"patient_visits": [16384, 10]}
+    assert normalize_query("SELECT 1\n  FROM t ;") == "SELECT 1 FROM t"
+    assert cache_key("SELECT *\nFROM t;", None, versions) == cache_key("SELECT * FROM t", {}, versions)
+    assert cache_key("SELECT * FROM t", {"a": 1}, versions) != cache_key("SELECT * FROM t", {"a": 2}, versions)
+    assert cache_key("SELECT * FROM t", None, versions) != cache_key("SELECT * FROM t", None, {"patient_visits": [16384, 11]})
+
+# Test expired entries are removed first, then the least recently served ones until the size limit holds
+def test_evict_by_ttl_then_size(tmp_path):
+    now = time.time()
+    for name, stored, served in [("expired", now - 100, now - 100), ("old", now - 5, now - 5), ("recent", now - 5, now)]:
+        path = tmp_path / f"{name}.parquet"
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (served, stored))
+    evict(str(tmp_path), ttl=50, max_bytes=150)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["recent.parquet"]
+
+# Write the visits the cached query counts
+def write_visits(engine):
+    pd.DataFrame({"patient_id": ["P1", "P1", "P2"], "visit_id": ["V1", "V2", "V3"]}).to_sql(
+        "cache_test_visits", engine, index=False)
+
+# Test an unchanged table is served from the cache, and a write to it runs the query again straight after it commits
+@pytest.mark.requires_postgres
+def test_cached_query_hits_until_table_changes(scratch_engine, tmp_path):
+    write_visits(scratch_engine)
+    before = cache_stats()
+    first = cached_query(VISITS_QUERY, scratch_engine, ["cache_test_visits"], cache_dir=str(tmp_path))
+    second = cached_query(VISITS_QUERY, scratch_engine, ["cache_test_visits"], cache_dir=str(tmp_path))
+    pd.testing.assert_frame_equal(first, second)
+    assert cache_stats()["hits"] == before["hits"] + 1
+    assert cache_stats()["misses"] == before["misses"] + 1
+
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO cache_test_visits VALUES ('P2', 'V4')")
+    third = cached_query(VISITS_QUERY, scratch_engine, ["cache_test_visits"], cache_dir=str(tmp_path))
+    assert third["number_of_visits"].tolist() == [2, 2]
+    assert cache_stats()["misses"] == before["misses"] + 2
+    assert len(list(tmp_path.glob("*.parquet"))) == 2
+
+# Test every committed write moves the version stamp at once, a write that rolls back does not, and a table
+# recreated without the trigger gets it back with a stamp it never had before
+@pytest.mark.requires_postgres
+def test_table_versions_follow_commits(scratch_engine):
+    write_visits(scratch_engine)
+    query_cache.ensure_version_triggers(scratch_engine, ["cache_test_visits"])
+    seen = []
+    for statement in ["UPDATE cache_test_visits SET patient_id = 'P3' WHERE visit_id = 'V3'",
+                      "DELETE FROM cache_test_visits WHERE visit_id = 'V3'", "TRUNCATE cache_test_visits"]:
+        with scratch_engine.connect() as connection:
+            seen.append(query_cache.table_versions(connection, ["cache_test_visits"]))
+        with scratch_engine.begin() as connection:
+            connection.exec_driver_sql(statement)
+    with scratch_engine.connect() as connection:
+        seen.append(query_cache.table_versions(connection, ["cache_test_visits"]))
+        connection.exec_driver_sql("INSERT INTO cache_test_visits VALUES ('P9', 'V9')")
+        connection.rollback()
+        assert query_cache.table_versions(connection, ["cache_test_visits"]) == seen[-1]
+    assert len({str(versions) for versions in seen}) == 4
+
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE cache_test_visits")
+    write_visits(scratch_engine)
+    query_cache.ensure_version_triggers(scratch_engine, ["cache_test_visits"])
+    with scratch_engine.connect() as connection:
+        assert str(query_cache.table_versions(connection, ["cache_test_visits"])) not in {str(versions) for versions in seen}
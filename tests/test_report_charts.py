@@ -0,0 +1,52 @@
+import os
+
+import pandas as pd
+import pytest
+
+import report_charts
+from report_charts import (avg_visits_per_patient_chart, patients_by_diagnosis_chart, start_rendering, visits_per_month_chart,
+                           visits_per_patient_chart, wait_for_charts)
+
+VISITS_PER_PATIENT = pd.DataFrame({"patient_id": ["P1", "P2", "P3", "P4", "P5"], "number_of_visits": [1, 2, 2, 3, 7]})
+
+# Test a few patients get one bar each, and above MAX_BARS the counts become a histogram with one bin per visit count
+def test_patient_chart_switches_to_histogram(monkeypatch):
+    chart = visits_per_patient_chart(VISITS_PER_PATIENT)
+    assert chart["kind"] == "bar"
+    assert chart["labels"] == ["P1", "P2", "P3", "P4", "P5"]
+
+    monkeypatch.setattr(report_charts, "MAX_BARS", 3)
+    chart = avg_visits_per_patient_chart(VISITS_PER_PATIENT)
+    assert chart["kind"] == "histogram"
+    assert chart["edges"] == [0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5]
+    assert chart["counts"] == [1, 2, 1, 0, 0, 0, 1]
+    assert chart["average"] == 3.0
+
+# Test wide ranges of counts are binned into at most HISTOGRAM_BINS bins
+def test_histogram_bins_are_capped(monkeypatch):
+    monkeypatch.setattr(report_charts, "MAX_BARS", 3)
+    monkeypatch.setattr(report_charts, "HISTOGRAM_BINS", 4)
+    chart = visits_per_patient_chart(pd.DataFrame({"patient_id": [f"P{i}" for i in range(100)], "number_of_visits": range(100)}))
+    assert len(chart["counts"]) == 4
+    assert sum(chart["counts"]) == 100
+
+# Test the Venn chart keeps only the sizes of the diagnosed-only, visited-only and both regions
+def test_patients_by_diagnosis_chart():
+    df = pd.DataFrame({"patient_id": ["P1", "P1", "P2", "P3", "P4"],
+                       "diagnosis": ["DEPRESSION", "ASTHMA", "DEPRESSION", "ASTHMA", "DEPRESSION"],
+                       "visit_date": ["2022-05-01", "2023-03-01", "2022-01-01", "2023-06-01", "2023-02-01"]})
+    chart = patients_by_diagnosis_chart(df, "DEPRESSION", "2023-01-01", "2023-12-31")
+    assert chart["subsets"] == (1, 1, 2)
+
+# Test the charts are rendered to PNG files in worker processes, with their time and peak memory reported
+def test_render_charts(tmp_path):
+    pytest.importorskip("matplotlib")
+    pytest.importorskip("matplotlib_venn")
+    charts = [visits_per_patient_chart(VISITS_PER_PATIENT),
+              visits_per_month_chart(pd.DataFrame({"visit_month": [1.0, 2.0, None], "number_of_visits": [3, 4, 1]}))]
+    for chart in charts:
+        chart["path"] = str(tmp_path / f"{chart['name']}.png")
+    results = wait_for_charts(start_rendering(charts, workers=2))
+    assert sorted(result["chart"] for result in results) == ["visits_per_month", "visits_per_patient"]
+    assert all(result["seconds"] > 0 for result in results)
+    assert all(os.path.getsize(chart["path"]) > 0 for chart in charts)
@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+from sqlalchemy import inspect
+
+from report_queries import PATIENTS_BY_DIAGNOSIS_OR_VISIT_DATE_SQL, REPORT_INDEXES, ensure_report_indexes, execute_prepared, positional_query
+
+# The report query with its values formatted by the driver, to compare the prepared statement with
+LITERAL_QUERY = """
+    SELECT patient_id, diagnosis, visit_date
+    FROM patient_visits
+    WHERE diagnosis = %(diagnosis)s
+    OR (visit_date BETWEEN %(start_date)s AND %(end_date)s)
+"""
+
+# Test :name parameters become positions, a repeated name keeps its position and casts are left alone
+def test_positional_query():
+    sql, names = positional_query("SELECT a::numeric FROM t WHERE b = :x OR c = :y OR d = :x;")
+    assert sql == "SELECT a::numeric FROM t WHERE b = $1 OR c = $2 OR d = $1"
+    assert names == ["x", "y"]
+
+# Write the visits the report query reads
+def write_visits(engine):
+    pd.DataFrame({
+        "patient_id": ["P1", "P1", "P2", "P3", "P4", "P5"],
+        "visit_id": ["V1", "V2", "V3", "V4", "V5", "V6"],
+        "visit_date": pd.to_datetime(["2023-03-01", "2023-03-01", "2022-05-01", "2023-07-01", None, "2023-09-01"]).date,
+        "diagnosis": ["DEPRESSION", "DEPRESSION", "DEPRESSION", "ASTHMA", "DEPRESSION", None]
+    }).to_sql("patient_visits", engine, index=False)
+
+# Test the prepared report query returns the same visits as the query with its values in the text,
+# and that other parameter values reuse the statement prepared on the connection
+@pytest.mark.requires_postgres
+def test_prepared_query_matches_literal_query(scratch_engine):
+    write_visits(scratch_engine)
+    with scratch_engine.connect() as connection:
+        for params in [{"diagnosis": "DEPRESSION", "start_date": "2023-01-01", "end_date": "2023-12-31"},
+                       {"diagnosis": "ASTHMA", "start_date": "2022-01-01", "end_date": "2022-12-31"}]:
+            expected = pd.read_sql(LITERAL_QUERY, connection, params=params)
+            actual = execute_prepared(connection, "patients_by_diagnosis", PATIENTS_BY_DIAGNOSIS_OR_VISIT_DATE_SQL, params)
+            columns = list(expected.columns)
+            pd.testing.assert_frame_equal(actual.sort_values(columns, na_position="first").reset_index(drop=True),
+                                          expected.sort_values(columns, na_position="first").reset_index(drop=True))
+        prepared = connection.exec_driver_sql("SELECT name FROM pg_prepared_statements").scalars().all()
+        assert prepared == ["patients_by_diagnosis"]
+
+# Test the missing report indexes are created, and a second call leaves them as they are
+@pytest.mark.requires_postgres
+def test_ensure_report_indexes(scratch_engine):
+    write_visits(scratch_engine)
+    ensure_report_indexes(scratch_engine)
+    ensure_report_indexes(scratch_engine)
+    indexes = {index["name"]: index["column_names"] for index in inspect(scratch_engine).get_indexes("patient_visits")}
+    assert indexes == {name: [column] for name, (_, column) in REPORT_INDEXES.items()}
@@ -0,0 +1,38 @@
+import pandas as pd
+
+from synthetic_data import generate_dataset, patients_for_rows, write_dataset
+
+# Test every child row points at a generated visit, and every visit at a generated patient
+def test_generated_data_is_referentially_consistent():
+    data = generate_dataset(200, seed=1)
+    patients = set(data["patient_demographics"]["patient_id"])
+    visits = data["patient_visits"].drop_duplicates()
+    visit_patient = dict(zip(visits["visit_id"], visits["patient_id"]))
+
+    assert set(visits["patient_id"]) <= patients
+    assert visits["visit_id"].is_unique
+    for key in ["patient_lab_results", "patient_medications", "physician_assignments"]:
+        df = data[key]
+        assert set(df["visit_id"]) <= set(visit_patient)
+        assert (df["visit_id"].map(visit_patient) == df["patient_id"]).all()
+
+# Test the same seed gives the same data and another seed different data
+def test_generated_data_is_seeded():
+    first, second, other = generate_dataset(100, seed=7), generate_dataset(100, seed=7), generate_dataset(100, seed=8)
+    for key in first:
+        pd.testing.assert_frame_equal(first[key], second[key])
+    assert not first["patient_lab_results"].equals(other["patient_lab_results"])
+
+# Test the data carries the dirt the pipeline cleans, and the size follows the requested rows
+def test_generated_data_is_dirty_and_sized(tmp_path):
+    data = generate_dataset(patients_for_rows(20_000), dirt={"duplicate_rows": 0.05}, seed=3)
+    assert 19_000 < sum(len(df) for df in data.values()) < 22_000
+    assert data["patient_demographics"]["age"].isna().any()
+    assert data["patient_lab_results"]["result_value"].isna().any()
+    assert (data["patient_lab_results"]["result_unit"] == "g/dL").any()
+    assert data["patient_medications"]["dosage"].str.endswith("mg").all()
+    assert data["patient_visits"].duplicated().any()
+
+    write_dataset(data, tmp_path)
+    demographics = pd.read_csv(tmp_path / "patient_demographics.csv")
+    assert len(demographics) == len(data["patient_demographics"])
@@ -0,0 +1,216 @@
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import table_migration
+from engine_registry import InstrumentedQueuePool
+from table_migration import (ROW_ID, build_source_query, checkpoint_keys, checkpoint_names, clear_migration_checkpoints,
+                             compute_partition_boundaries, migrate_table_partitioned, migrate_table_streaming,
+                             partition_threads, read_checkpoint)
+
+# Test a resumed read starts strictly after the last committed key, in key order
+def test_build_source_query_resumes_after_last_key():
+    query, params = build_source_query("physician_assignments", ["patient_id", "visit_id"], ["P002", "V003"])
+    assert query == ('SELECT * FROM "physician_assignments" WHERE ("patient_id", "visit_id") > (:key_0, :key_1) '
+                     'ORDER BY "patient_id", "visit_id"')
+    assert params == {"key_0": "P002", "key_1": "V003"}
+
+# Test partition ranges are half-open and the first partition also takes NULLs of the partition column
+def test_build_source_query_partition_ranges():
+    query, params = build_source_query("patient_lab_results", ["lab_test_id"], partition=("test_date", None, "2023-03-01"))
+    assert 'WHERE ("test_date" < :upper OR "test_date" IS NULL) ORDER BY "lab_test_id"' in query
+    query, params = build_source_query("patient_lab_results", ["lab_test_id"], ["L007"], partition=("test_date", "2023-03-01", None))
+    assert 'WHERE "test_date" >= :lower AND ("lab_test_id") > (:key_0)' in query
+    assert params == {"lower": "2023-03-01", "key_0": "L007"}
+
+# Test a keyset without a unique key reads and resumes by ctid, which is selected under its own name
+def test_build_source_query_row_id_tiebreaker():
+    query, params = build_source_query("patient_visits", ["patient_id", ROW_ID], ["P002", "(0,7)"])
+    assert query == (f'SELECT *, ctid::text AS "{ROW_ID}" FROM "patient_visits" '
+                     'WHERE ("patient_id", ctid) > (:key_0, CAST(:key_1 AS tid)) ORDER BY "patient_id", ctid')
+    assert params == {"key_0": "P002", "key_1": "(0,7)"}
+
+# A source table of 10 visits in the scratch schema, and an empty "test_migration" schema to copy it to
+@pytest.fixture
+def source_visits(scratch_engine):
+    visits = pd.DataFrame({
+        "visit_id": [f"V{i:03d}" for i in range(10)],
+        "patient_id": [f"P{i % 3:03d}" for i in range(10)],
+        "visit_date": pd.to_datetime("2023-01-01") + pd.to_timedelta(range(10), unit="D")
+    })
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("DROP SCHEMA IF EXISTS test_migration CASCADE")
+        connection.exec_driver_sql("CREATE SCHEMA test_migration")
+        visits.to_sql("test_migration_visits", connection, index=False)
+        connection.exec_driver_sql("ALTER TABLE test_migration_visits ADD PRIMARY KEY (visit_id)")
+    yield
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("DROP SCHEMA test_migration CASCADE")
+
+# Test a table is copied batch by batch and the checkpoint is removed once it is complete
+@pytest.mark.requires_postgres
+def test_migrate_table_streaming_copies_every_batch(scratch_engine, source_visits):
+    rows = migrate_table_streaming("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                   schema="test_migration", batch_size=3)
+    assert rows == 10
+    copied = pd.read_sql('SELECT * FROM test_migration.test_migration_visits ORDER BY visit_id', scratch_engine)
+    assert copied["visit_id"].tolist() == [f"V{i:03d}" for i in range(10)]
+    assert read_checkpoint(scratch_engine, "test_migration_visits", "test_migration") is None
+
+# Test a run that fails part-way resumes after its last committed batch without duplicating rows
+@pytest.mark.requires_postgres
+def test_migrate_table_streaming_resumes_after_failure(scratch_engine, source_visits):
+    save_checkpoint = table_migration.save_checkpoint
+    calls = []
+
+    # Fail while writing the third batch's checkpoint, after the first two batches were committed
+    def failing_checkpoint(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 3:
+            raise RuntimeError("connection lost")
+        return save_checkpoint(*args, **kwargs)
+
+    with patch("table_migration.save_checkpoint", side_effect=failing_checkpoint):
+        with pytest.raises(RuntimeError):
+            migrate_table_streaming("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                    schema="test_migration", batch_size=3)
+    assert read_checkpoint(scratch_engine, "test_migration_visits", "test_migration") == (["V005"], 6)
+
+    rows = migrate_table_streaming("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                   schema="test_migration", batch_size=3)
+    assert rows == 10
+    copied = pd.read_sql('SELECT * FROM test_migration.test_migration_visits ORDER BY visit_id', scratch_engine)
+    assert copied["visit_id"].tolist() == [f"V{i:03d}" for i in range(10)]
+
+# Test a partitioned migration copies every row exactly once, partitioning on a date column
+@pytest.mark.requires_postgres
+def test_migrate_table_partitioned_copies_every_row(scratch_engine, source_visits):
+    assert len(compute_partition_boundaries(scratch_engine, "test_migration_visits", "visit_id", 3)) == 2
+    rows = migrate_table_partitioned("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                     schema="test_migration", partitions=3, partition_column="visit_date", batch_size=2)
+    assert rows == 10
+    copied = pd.read_sql('SELECT * FROM test_migration.test_migration_visits ORDER BY visit_id', scratch_engine)
+    assert copied["visit_id"].tolist() == [f"V{i:03d}" for i in range(10)]
+    assert checkpoint_names(scratch_engine, "test_migration_visits", "test_migration") == []
+
+# Test a partitioned run that fails resumes every partition after its own last committed batch
+@pytest.mark.requires_postgres
+def test_migrate_table_partitioned_resumes_after_failure(scratch_engine, source_visits):
+    save_checkpoint = table_migration.save_checkpoint
+
+    # Fail the second batch of the last partition; the other partitions complete
+    def failing_checkpoint(connection, checkpoint_name, last_key, rows_copied, schema):
+        if checkpoint_name == "test_migration_visits#2" and rows_copied > 2:
+            raise RuntimeError("connection lost")
+        return save_checkpoint(connection, checkpoint_name, last_key, rows_copied, schema)
+
+    with patch("table_migration.save_checkpoint", side_effect=failing_checkpoint):
+        with pytest.raises(RuntimeError):
+            migrate_table_partitioned("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                      schema="test_migration", partitions=3, batch_size=2)
+    assert read_checkpoint(scratch_engine, "test_migration_visits#2", "test_migration")[1] == 2
+
+    migrate_table_partitioned("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                              schema="test_migration", partitions=3, batch_size=2)
+    copied = pd.read_sql('SELECT * FROM test_migration.test_migration_visits ORDER BY visit_id', scratch_engine)
+    assert copied["visit_id"].tolist() == [f"V{i:03d}" for i in range(10)]
+
+# Test the keyset is the given keys when they are unique, gains the primary key when they are not, and ctid without one
+@pytest.mark.requires_postgres
+def test_checkpoint_keys(scratch_engine, source_visits):
+    assert checkpoint_keys(scratch_engine, "test_migration_visits", ["visit_id"]) == ["visit_id"]
+    assert checkpoint_keys(scratch_engine, "test_migration_visits", ["patient_id"]) == ["patient_id", "visit_id"]
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("ALTER TABLE test_migration_visits DROP CONSTRAINT test_migration_visits_pkey")
+    assert checkpoint_keys(scratch_engine, "test_migration_visits", ["patient_id"]) == ["patient_id", ROW_ID]
+
+# Test resuming on a key that is not unique copies the rows sharing a key across a batch boundary exactly once
+@pytest.mark.requires_postgres
+def test_migrate_table_streaming_resumes_on_duplicate_keys(scratch_engine, source_visits):
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("ALTER TABLE test_migration_visits DROP CONSTRAINT test_migration_visits_pkey")
+    save_checkpoint = table_migration.save_checkpoint
+    calls = []
+
+    # Fail after the first batch of 3 rows, which ends in the middle of patient P000's 4 visits
+    def failing_checkpoint(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError("connection lost")
+        return save_checkpoint(*args, **kwargs)
+
+    with patch("table_migration.save_checkpoint", side_effect=failing_checkpoint):
+        with pytest.raises(RuntimeError):
+            migrate_table_streaming("test_migration_visits", scratch_engine, scratch_engine, ["patient_id"],
+                                    schema="test_migration", batch_size=3)
+    assert read_checkpoint(scratch_engine, "test_migration_visits", "test_migration")[0][0] == "P000"
+
+    rows = migrate_table_streaming("test_migration_visits", scratch_engine, scratch_engine, ["patient_id"],
+                                   schema="test_migration", batch_size=3)
+    assert rows == 10
+    copied = pd.read_sql('SELECT * FROM test_migration.test_migration_visits ORDER BY visit_id', scratch_engine)
+    assert copied["visit_id"].tolist() == [f"V{i:03d}" for i in range(10)]
+    assert ROW_ID not in copied.columns
+
+# Fail the second batch of the last of 3 partitions, leaving the checkpoints of an interrupted partitioned run
+def interrupt_partitioned_run(engine):
+    save_checkpoint = table_migration.save_checkpoint
+
+    # Fail the second batch of partition 2
+    def failing_checkpoint(connection, checkpoint_name, last_key, rows_copied, schema):
+        if checkpoint_name == "test_migration_visits#2" and rows_copied > 2:
+            raise RuntimeError("connection lost")
+        return save_checkpoint(connection, checkpoint_name, last_key, rows_copied, schema)
+
+    with patch("table_migration.save_checkpoint", side_effect=failing_checkpoint):
+        with pytest.raises(RuntimeError):
+            migrate_table_partitioned("test_migration_visits", engine, engine, ["visit_id"],
+                                      schema="test_migration", partitions=3, batch_size=2)
+
+# Test checkpoints are not resumed by a run with another number of partitions or in streaming mode, until cleared
+@pytest.mark.requires_postgres
+def test_migration_refuses_mismatched_checkpoints(scratch_engine, source_visits):
+    interrupt_partitioned_run(scratch_engine)
+    checkpoints = checkpoint_names(scratch_engine, "test_migration_visits", "test_migration")
+    assert "test_migration_visits#plan" in checkpoints
+
+    with pytest.raises(ValueError, match="do not match"):
+        migrate_table_partitioned("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                  schema="test_migration", partitions=4, batch_size=2)
+    with pytest.raises(ValueError, match="do not match"):
+        migrate_table_streaming("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                schema="test_migration", batch_size=2)
+    assert checkpoint_names(scratch_engine, "test_migration_visits", "test_migration") == checkpoints
+
+    clear_migration_checkpoints(scratch_engine, "test_migration_visits", "test_migration")
+    rows = migrate_table_streaming("test_migration_visits", scratch_engine, scratch_engine, ["visit_id"],
+                                   schema="test_migration", batch_size=2)
+    assert rows == 10
+    copied = pd.read_sql('SELECT * FROM test_migration.test_migration_visits ORDER BY visit_id', scratch_engine)
+    assert copied["visit_id"].tolist() == [f"V{i:03d}" for i in range(10)]
+
+# Test the partitions streaming at once fit in the pools, shared by the tables migrating at the same time
+def test_partition_threads_fit_the_pools(tmp_path):
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}", poolclass=InstrumentedQueuePool, pool_size=4, max_overflow=2)
+    destination = create_engine(f"sqlite:///{tmp_path / 'destination.db'}", poolclass=InstrumentedQueuePool, pool_size=3, max_overflow=0)
+    assert partition_threads(source, destination, 8) == 3
+    assert partition_threads(source, destination, 2) == 2
+    assert partition_threads(source, source, 8) == 3
+    assert partition_threads(source, destination, 8, tables=2) == 1
+    assert partition_threads(source, destination, 8, tables=5) == 1
+    assert partition_threads(create_engine(f"sqlite:///{tmp_path / 'other.db'}"), destination, 8) == 3
+
+# Test a partitioned migration on a pool smaller than two connections per partition completes without waiting on it
+@pytest.mark.requires_postgres
+def test_migrate_table_partitioned_on_small_pool(scratch_engine, source_visits):
+    engine = create_engine(scratch_engine.url, poolclass=InstrumentedQueuePool, pool_size=2, max_overflow=1, pool_timeout=5,
+                           connect_args={"options": "-csearch_path=test_table_migration"})
+    try:
+        rows = migrate_table_partitioned("test_migration_visits", engine, engine, ["visit_id"],
+                                         schema="test_migration", partitions=4, batch_size=2)
+        assert rows == 10
+        assert engine.pool.stats["waits"] == 0
+    finally:
+        engine.dispose()
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from validation import check_failures, schema_rules, too_long, validate_tables, write_quarantine
+from cleaned_data_io import read_table
+
+TODAY = pd.Timestamp("2024-01-01")
+
+# Test the rules are read from every CREATE TABLE of the schema, column and table constraints alike
+def test_schema_rules():
+    rules = schema_rules()
+    assert list(rules) == ["patient_demographics", "patient_visits", "patient_lab_results", "patient_medications",
+                           "physician_assignments"]
+    visits = rules["patient_visits"]
+    assert visits["primary_key"] == ["visit_id"]
+    assert visits["lengths"]["visit_id"] == 10
+    assert "visit_date" in visits["not_null"]
+    assert "visit_date <= CURRENT_DATE" in visits["checks"]
+    assert visits["foreign_keys"] == [(["patient_id"], "patient_demographics", ["patient_id"])]
+    assert rules["physician_assignments"]["primary_key"] == ["patient_id", "visit_id", "physician_id"]
+    assert "gender IN ('MALE', 'FEMALE', 'UNKNOWN')" in rules["patient_demographics"]["checks"]
+
+# Test comparisons and IN lists fail only known values, as a NULL check passes in SQL
+def test_check_failures_null_semantics():
+    df = pd.DataFrame({"age": [30, -5, None], "gender": ["MALE", "X", None],
+                       "start_date": pd.to_datetime(["2023-01-01", "2023-01-01", None]),
+                       "end_date": pd.to_datetime(["2022-01-01", None, "2023-01-01"])})
+    assert check_failures(df, "age >= -1", TODAY).tolist() == [False, True, False]
+    assert check_failures(df, "gender IN ('MALE', 'FEMALE', 'UNKNOWN')", TODAY).tolist() == [False, True, False]
+    assert check_failures(df, "end_date >= start_date", TODAY).tolist() == [True, False, False]
+    assert check_failures(df, "start_date <= CURRENT_DATE", TODAY).tolist() == [False, False, False]
+    assert check_failures(df, "age BETWEEN 0 AND 120", TODAY) is None
+
+# Test VARCHAR lengths of text and categorical columns
+def test_too_long():
+    values = pd.Series(["V1", "V0123456789", None])
+    assert too_long(values, 10).tolist() == [False, True, False]
+    assert too_long(values.astype("category"), 10).tolist() == [False, True, False]
+
+# Test a quarantined parent takes its children with it, and every failed rule of a row is in its reason
+def test_validate_tables_cascades_foreign_keys():
+    tables = {
+        "patient_demographics": pd.DataFrame({"patient_id": ["P1", "P2"], "age": [30, -5], "gender": ["MALE", "X"]}),
+        "patient_visits": pd.DataFrame({"patient_id": ["P1", "P2", "P1", "P1"], "visit_id": ["V1", "V2", "V3", "V3"],
+                                        "visit_date": pd.to_datetime(["2023-01-01", "2023-01-01", "2023-01-01", "2025-01-01"]),
+                                        "diagnosis": ["A", "B", None, "C"]}),
+    }
+    valid, quarantined, report = validate_tables(tables, today=TODAY)
+    assert valid["patient_demographics"]["patient_id"].tolist() == ["P1"]
+    assert quarantined["patient_demographics"]["reason"].tolist() == [
+        "CHECK (age >= -1); CHECK (gender IN ('MALE', 'FEMALE', 'UNKNOWN'))"]
+    assert valid["patient_visits"]["visit_id"].tolist() == ["V1"]
+    assert quarantined["patient_visits"]["reason"].tolist() == [
+        "FOREIGN KEY (patient_id) REFERENCES patient_demographics",
+        "diagnosis NOT NULL; duplicate PRIMARY KEY (visit_id)",
+        "CHECK (visit_date <= CURRENT_DATE)"]
+    assert report["patient_visits"] == {"rows": 4, "valid": 1, "quarantined": 3, "reasons": {
+        "diagnosis NOT NULL": 1, "CHECK (visit_date <= CURRENT_DATE)": 1, "duplicate PRIMARY KEY (visit_id)": 1,
+        "FOREIGN KEY (patient_id) REFERENCES patient_demographics": 1}}
+
+    valid, _, _ = validate_tables(tables, check_foreign_keys=False, today=TODAY)
+    assert valid["patient_visits"]["visit_id"].tolist() == ["V1", "V2"]
+
+# Test text dates that are not valid dates are quarantined, and only tables with rejected rows get a file
+def test_write_quarantine(tmp_path):
+    tables = {"patient_medications": pd.DataFrame({"medication_id": ["M1", "M2"], "start_date": ["2023-01-01", "2023-02-30"],
+                                                   "end_date": [np.nan, np.nan]}),
+              "patient_demographics": pd.DataFrame({"patient_id": ["P1"], "age": [30]})}
+    _, quarantined, _ = validate_tables(tables, check_foreign_keys=False, today=TODAY)
+    write_quarantine(quarantined, str(tmp_path))
+    assert read_table("patient_medications", tables_dir=str(tmp_path))["reason"].tolist() == [
+        "start_date is not a valid DATE"]
+    assert not (tmp_path / "patient_demographics.parquet").exists()
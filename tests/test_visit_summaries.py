@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+from bulk_load import replace_table, upsert_table
+from visit_summaries import check_visit_summaries, sync_visit_summaries
+
+visits = pd.DataFrame({
+    "patient_id": ["P1", "P1", "P2", "P3"],
+    "visit_id": ["V1", "V2", "V3", "V4"],
+    "visit_date": pd.to_datetime(["2023-01-05", "2023-02-10", "2023-01-20", None]).date
+})
+
+# Read a summary table as {key: count}
+def read_summary(engine, table, key):
+    df = pd.read_sql(f"SELECT {key}, number_of_visits FROM {table}", engine)
+    return dict(zip(df[key], df["number_of_visits"]))
+
+# Test a replace load rebuilds the summaries, and upserts and deletes then keep them in step incrementally
+@pytest.mark.requires_postgres
+def test_summaries_follow_loads(scratch_engine):
+    replace_table(visits, "patient_visits", scratch_engine, None)
+    assert sync_visit_summaries(scratch_engine) is True
+    assert read_summary(scratch_engine, "visit_counts_per_patient", "patient_id") == {"P1": 2, "P2": 1, "P3": 1}
+    assert read_summary(scratch_engine, "visit_counts_per_month", "visit_month") == {1: 2, 2: 1, 0: 1}
+
+    # V3 moves from P2 to P1 and from January to March, V5 is new
+    delta = pd.DataFrame({"patient_id": ["P1", "P2"], "visit_id": ["V3", "V5"],
+                          "visit_date": pd.to_datetime(["2023-03-01", "2023-03-02"]).date})
+    upsert_table(delta, "patient_visits", scratch_engine, None, ["visit_id"])
+    assert sync_visit_summaries(scratch_engine) is False
+    assert read_summary(scratch_engine, "visit_counts_per_patient", "patient_id") == {"P1": 3, "P2": 1, "P3": 1}
+    assert read_summary(scratch_engine, "visit_counts_per_month", "visit_month") == {1: 1, 2: 1, 3: 2, 0: 1}
+
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("DELETE FROM patient_visits WHERE visit_id IN ('V4', 'V5')")
+    assert read_summary(scratch_engine, "visit_counts_per_patient", "patient_id") == {"P1": 3}
+    assert check_visit_summaries(scratch_engine).empty
+
+    replace_table(visits, "patient_visits", scratch_engine, None)
+    assert sync_visit_summaries(scratch_engine) is True
+    assert check_visit_summaries(scratch_engine).empty
+
+# Test the consistency check reports groups whose summary count differs from a recount
+@pytest.mark.requires_postgres
+def test_check_reports_mismatches(scratch_engine):
+    replace_table(visits, "patient_visits", scratch_engine, None)
+    sync_visit_summaries(scratch_engine)
+    with scratch_engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE visit_counts_per_patient SET number_of_visits = 5 WHERE patient_id = 'P2'")
+        connection.exec_driver_sql("DELETE FROM visit_counts_per_month WHERE visit_month = 2")
+
+    mismatches = check_visit_summaries(scratch_engine)
+    assert mismatches[["summary", "key"]].values.tolist() == [["visit_counts_per_patient", "P2"], ["visit_counts_per_month", 2]]
+    assert mismatches["expected"].tolist() == [1, 1]
@@ -0,0 +1,226 @@
+import logging
+import os
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from date_parsing import parse_dates
+from cleaned_data_io import clear_table, table_file, write_table
+from deferred_load import SCHEMA_PATH, schema_statements
+
+# Directory the rows that fail validation are written to, one <table>.parquet per table, with a "reason" column
+QUARANTINE_DIR = os.path.join("data", "quarantine")
+
+# Comparison operators of CHECK constraints
+OPERATORS = {">=": np.greater_equal, "<=": np.less_equal, ">": np.greater, "<": np.less, "=": np.equal,
+             "<>": np.not_equal, "!=": np.not_equal}
+
+CREATE_TABLE = re.compile(r"CREATE TABLE (?:IF NOT EXISTS )?(\w+)\s*\((.*)\)\s*$", re.IGNORECASE | re.DOTALL)
+COMPARISON = re.compile(r"^(\w+)\s*(>=|<=|<>|!=|>|<|=)\s*(.+)$")
+IN_LIST = re.compile(r"^(\w+)\s+IN\s*\((.*)\)$", re.IGNORECASE | re.DOTALL)
+STRING_LITERAL = re.compile(r"'((?:[^']|'')*)'")
+KEY_LIST = re.compile(r"\(([^)]*)\)")
+
+# Split a comma-separated list at its top level, leaving commas inside parentheses and quotes alone
+def split_top_level(text):
+    items, depth, quoted, current = [], 0, False, []
+    for char in text:
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char in "()":
+            depth += 1 if char == "(" else -1
+        elif not quoted and char == "," and depth == 0:
+            items.append("".join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    items.append("".join(current).strip())
+    return [item for item in items if item]
+
+# The text inside the parentheses that open at "start", with nested parentheses kept
+def parenthesized(text, start):
+    depth = 0
+    for position in range(start, len(text)):
+        depth += {"(": 1, ")": -1}.get(text[position], 0)
+        if depth == 0:
+            return text[start + 1:position]
+    return text[start + 1:]
+
+# Strip the outer parentheses of a CHECK expression
+def strip_parentheses(expression):
+    expression = expression.strip()
+    while expression.startswith("(") and parenthesized(expression, 0) == expression[1:-1]:
+        expression = expression[1:-1].strip()
+    return expression
+
+# Column names of a "(a, b)" key list
+def key_columns(text):
+    return [column.strip() for column in KEY_LIST.search(text).group(1).split(",")]
+
+# Parse the CREATE TABLE statements of the schema into the rules validate_tables checks, by table in schema order:
+# {"columns": {column: SQL type}, "lengths": {column: VARCHAR length}, "not_null": [...], "primary_key": [...],
+#  "checks": [CHECK expression, ...], "foreign_keys": [(columns, parent table, parent columns), ...]}
+def schema_rules(schema_path=SCHEMA_PATH):
+    rules = {}
+    for statement in schema_statements(schema_path):
+        match = CREATE_TABLE.match(statement)
+        if not match:
+            continue
+        table = {"columns": {}, "lengths": {}, "not_null": [], "primary_key": [], "checks": [], "foreign_keys": []}
+        for item in split_top_level(match.group(2)):
+            item = re.sub(r"^CONSTRAINT\s+\w+\s+", "", item, flags=re.IGNORECASE)
+            upper = item.upper()
+            if upper.startswith("PRIMARY KEY"):
+                table["primary_key"] = key_columns(item)
+            elif upper.startswith("FOREIGN KEY"):
+                references = item[upper.index("REFERENCES") + len("REFERENCES"):].strip()
+                table["foreign_keys"].append((key_columns(item), references.split("(")[0].strip(), key_columns(references)))
+            elif upper.startswith("CHECK"):
+                table["checks"].append(strip_parentheses(parenthesized(item, item.index("("))))
+            else:
+                column, sql_type = item.split()[:2]
+                table["columns"][column] = sql_type.upper()
+                length = re.match(r"VARCHAR\((\d+)\)", sql_type, re.IGNORECASE)
+                if length:
+                    table["lengths"][column] = int(length.group(1))
+                if "PRIMARY KEY" in upper:
+                    table["primary_key"] = [column]
+                elif "NOT NULL" in upper:
+                    table["not_null"].append(column)
+                if "CHECK" in upper:
+                    table["checks"].append(strip_parentheses(parenthesized(item, item.index("(", upper.index("CHECK")))))
+                if "REFERENCES" in upper:
+                    references = item[upper.index("REFERENCES") + len("REFERENCES"):].strip()
+                    table["foreign_keys"].append(([column], references.split("(")[0].strip(), key_columns(references)))
+        rules[match.group(1)] = table
+    return rules
+
+# Value of a CHECK operand: a column, CURRENT_DATE, a string or a number
+def operand(df, text, today):
+    text = text.strip()
+    if text in df.columns:
+        return df[text]
+    if text.upper() == "CURRENT_DATE":
+        return today
+    if STRING_LITERAL.fullmatch(text):
+        return STRING_LITERAL.fullmatch(text).group(1).replace("''", "'")
+    return float(text)
+
+# Rows that break a CHECK expression, as a boolean array. As in SQL, a row passes when the expression is NULL,
+# so a missing value never fails a check. Supports "column op value" (a column, a number, a string or CURRENT_DATE)
+# and "column IN ('a', 'b', ...)"; returns None for any other expression, which is then left to the database.
+def check_failures(df, expression, today):
+    match = IN_LIST.match(expression)
+    if match and match.group(1) in df.columns:
+        column = df[match.group(1)]
+        allowed = [value.replace("''", "'") for value in STRING_LITERAL.findall(match.group(2))]
+        return (column.notna() & ~column.isin(allowed)).to_numpy()
+    match = COMPARISON.match(expression)
+    if match and match.group(1) in df.columns:
+        left, right = df[match.group(1)], operand(df, match.group(3), today)
+        known = left.notna() & (right.notna() if isinstance(right, pd.Series) else True)
+        with np.errstate(invalid="ignore"):
+            holds = OPERATORS[match.group(2)](left, right)
+        return (known & ~holds.fillna(True).astype(bool)).to_numpy()
+    return None
+
+# Rows whose text is longer than a VARCHAR allows; a categorical column is measured once per category, and other
+# text is measured by Arrow's utf8_length, which avoids the per-value Python call of Series.str.len
+def too_long(series, length):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        lengths = series.cat.categories.astype(str).str.len().to_numpy()
+        return np.append(lengths > length, False)[series.cat.codes.to_numpy()]
+    if not pd.api.types.is_string_dtype(series):
+        series = series.astype("string")
+    lengths = pc.utf8_length(pa.array(series, from_pandas=True, type=pa.string()))
+    return pc.fill_null(pc.greater(lengths, length), False).to_numpy(zero_copy_only=False)
+
+# Rows whose key is missing from the parent's keys (NULL keys pass, as with a MATCH SIMPLE foreign key)
+def missing_parent(df, columns, parent, parent_columns):
+    present = df[columns].notna().all(axis=1).to_numpy()
+    if len(columns) == 1:
+        found = df[columns[0]].isin(parent[parent_columns[0]]).to_numpy()
+    else:
+        found = pd.MultiIndex.from_frame(df[columns]).isin(pd.MultiIndex.from_frame(parent[parent_columns]))
+    return present & ~found
+
+# Evaluate the row rules of one table: every rule as one operation over its columns.
+# Returns the failing rows of each rule as {reason: boolean array}; date columns held as text are parsed first.
+def row_failures(df, table_rules, today):
+    failures, source = {}, df
+    for column, sql_type in table_rules["columns"].items():
+        if column in df.columns and sql_type == "DATE" and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            parsed, _ = parse_dates(df[column])
+            failures[f"{column} is not a valid DATE"] = (df[column].notna() & parsed.isna()).to_numpy()
+            df = df.assign(**{column: parsed})
+    for column in table_rules["primary_key"] + table_rules["not_null"]:
+        if column in df.columns:
+            # Measured on the values as read, so an invalid date is reported once, not as a NULL too
+            failures[f"{column} NOT NULL"] = source[column].isna().to_numpy()
+    for column, length in table_rules["lengths"].items():
+        if column in df.columns:
+            failures[f"{column} longer than VARCHAR({length})"] = too_long(df[column], length)
+    for expression in table_rules["checks"]:
+        failed = check_failures(df, expression, today)
+        if failed is None:
+            logging.warning(f"Cannot evaluate CHECK ({expression}); leaving it to the database")
+        else:
+            failures[f"CHECK ({expression})"] = failed
+    key = [column for column in table_rules["primary_key"] if column in df.columns]
+    if key:
+        # The loaders keep the last row per key, so the earlier ones are quarantined
+        failures[f"duplicate PRIMARY KEY ({', '.join(key)})"] = df.duplicated(subset=key, keep="last").to_numpy()
+    return failures
+
+# Reason column of the quarantined rows: the failed rules of each row, separated by "; "
+def failure_reasons(failures, rejected):
+    reasons = np.full(rejected.sum(), "", dtype=object)
+    for reason, failed in failures.items():
+        failed = failed[rejected]
+        if failed.any():
+            reasons[failed] = np.where(reasons[failed] == "", reason, reasons[failed] + "; " + reason)
+    return reasons
+
+# Validate cleaned tables against the schema's constraints before they are loaded, and split each table into the
+# rows the database will accept and the rows it would reject. The NOT NULL, VARCHAR length, CHECK, primary key and
+# foreign key rules are read from the schema file and evaluated as whole-column operations. Tables are validated
+# in schema order, so a foreign key is checked against the parent rows that passed: a quarantined patient takes
+# its visits, and their lab results, with it. check_foreign_keys=False skips the foreign keys (for tables holding
+# only changed rows, whose parents may already be in the database). "today" is the CURRENT_DATE of the checks.
+# Returns the valid tables, the quarantined rows (with a "reason" column) and a report per table.
+def validate_tables(tables, rules=None, check_foreign_keys=True, today=None):
+    rules = schema_rules() if rules is None else rules
+    today = pd.Timestamp.today().normalize() if today is None else pd.Timestamp(today)
+    valid, quarantined, report = dict(tables), {}, {}
+    for key in (key for key in rules if key in tables):
+        df = tables[key]
+        failures = row_failures(df, rules[key], today)
+        if check_foreign_keys:
+            for columns, parent, parent_columns in rules[key]["foreign_keys"]:
+                if parent in valid and all(column in df.columns for column in columns):
+                    failures[f"FOREIGN KEY ({', '.join(columns)}) REFERENCES {parent}"] = missing_parent(df, columns, valid[parent], parent_columns)
+        rejected = np.logical_or.reduce(list(failures.values())) if failures else np.zeros(len(df), dtype=bool)
+        valid[key] = df[~rejected]
+        quarantined[key] = df[rejected].assign(reason=failure_reasons(failures, rejected))
+        report[key] = {"rows": len(df), "valid": len(valid[key]), "quarantined": int(rejected.sum()),
+                       "reasons": {reason: int(failed.sum()) for reason, failed in failures.items() if failed.any()}}
+        if report[key]["quarantined"]:
+            logging.warning(f"Quarantined {report[key]['quarantined']} of {len(df)} rows of {key}: "
+                            + ", ".join(f"{reason} ({count})" for reason, count in report[key]["reasons"].items()))
+    return valid, quarantined, report
+
+# Write the quarantined rows of each validated table to <directory>/<table>.parquet (CSV too when export_csv is set).
+# Files of earlier runs are removed first, so the directory only holds the rows this run rejected.
+def write_quarantine(quarantined, directory=QUARANTINE_DIR, export_csv=False):
+    for key, df in quarantined.items():
+        clear_table(key, directory)
+        if len(df):
+            write_table(df, key, directory, export_csv=export_csv)
+            logging.info(f"Quarantined rows of {key} saved to {table_file(key, 'parquet', directory)}")
+
+# Print how many rows of each table passed validation and how many were quarantined
+def print_validation_report(report):
+    print(f"{'table':<24} {'rows':>10} {'valid':>10} {'quarantined':>12}")
+    for key, counts in report.items():
+        print(f"{key:<24} {counts['rows']:>10} {counts['valid']:>10} {counts['quarantined']:>12}")
@@ -0,0 +1,162 @@
+import argparse
+import logging
+import os
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import inspect, text
+
+# Summary tables of patient_visits read by the reports in python_integration.py
+PATIENT_SUMMARY = "visit_counts_per_patient"
+MONTH_SUMMARY = "visit_counts_per_month"
+
+# Source table the summaries aggregate
+VISITS_TABLE = "patient_visits"
+
+# Triggers (one per statement type) that apply each write to patient_visits to the summaries, with the
+# transition tables each one receives (TRUNCATE has none: it empties the summaries)
+TRIGGER_FUNCTION = "apply_visit_summary_delta"
+TRIGGERS = {"INSERT": "visit_summaries_insert", "UPDATE": "visit_summaries_update", "DELETE": "visit_summaries_delete",
+            "TRUNCATE": "visit_summaries_truncate"}
+TRANSITION_TABLES = {"INSERT": "REFERENCING NEW TABLE AS new_rows", "UPDATE": "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+                     "DELETE": "REFERENCING OLD TABLE AS old_rows", "TRUNCATE": ""}
+
+# Month of a visit as stored in the summary: 1-12, or 0 when visit_date is NULL (a primary key cannot be NULL)
+MONTH_EXPRESSION = "COALESCE(EXTRACT(MONTH FROM visit_date)::int, 0)"
+
+# Statement-level trigger function. The changed rows arrive as transition tables (new_rows, old_rows), so one COPY
+# or INSERT ... ON CONFLICT of any size updates the summaries with one grouped delta per summary table.
+# Counts that drop to zero are removed, so the summaries hold the same groups as a full recount.
+TRIGGER_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {TRIGGER_FUNCTION}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM {PATIENT_SUMMARY};
+        DELETE FROM {MONTH_SUMMARY};
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO {PATIENT_SUMMARY} AS summary (patient_id, number_of_visits)
+        SELECT patient_id, -COUNT(*) FROM old_rows WHERE patient_id IS NOT NULL GROUP BY patient_id
+        ON CONFLICT (patient_id) DO UPDATE SET number_of_visits = summary.number_of_visits + EXCLUDED.number_of_visits;
+        INSERT INTO {MONTH_SUMMARY} AS summary (visit_month, number_of_visits)
+        SELECT {MONTH_EXPRESSION}, -COUNT(*) FROM old_rows GROUP BY 1
+        ON CONFLICT (visit_month) DO UPDATE SET number_of_visits = summary.number_of_visits + EXCLUDED.number_of_visits;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {PATIENT_SUMMARY} AS summary (patient_id, number_of_visits)
+        SELECT patient_id, COUNT(*) FROM new_rows WHERE patient_id IS NOT NULL GROUP BY patient_id
+        ON CONFLICT (patient_id) DO UPDATE SET number_of_visits = summary.number_of_visits + EXCLUDED.number_of_visits;
+        INSERT INTO {MONTH_SUMMARY} AS summary (visit_month, number_of_visits)
+        SELECT {MONTH_EXPRESSION}, COUNT(*) FROM new_rows GROUP BY 1
+        ON CONFLICT (visit_month) DO UPDATE SET number_of_visits = summary.number_of_visits + EXCLUDED.number_of_visits;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {PATIENT_SUMMARY} WHERE number_of_visits = 0 AND patient_id IN (SELECT patient_id FROM old_rows);
+        DELETE FROM {MONTH_SUMMARY} WHERE number_of_visits = 0;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# Statements computing the summaries from scratch
+RECOUNT_PATIENTS_SQL = (f"SELECT patient_id, COUNT(*) AS number_of_visits FROM {VISITS_TABLE} "
+                        f"WHERE patient_id IS NOT NULL GROUP BY patient_id")
+RECOUNT_MONTHS_SQL = f"SELECT {MONTH_EXPRESSION} AS visit_month, COUNT(*) AS number_of_visits FROM {VISITS_TABLE} GROUP BY 1"
+
+# Create the summary tables and the trigger function if needed; returns whether a summary table had to be created
+def create_summary_tables(connection):
+    created = not inspect(connection).has_table(PATIENT_SUMMARY) or not inspect(connection).has_table(MONTH_SUMMARY)
+    connection.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {PATIENT_SUMMARY} "
+                               f"(patient_id TEXT PRIMARY KEY, number_of_visits BIGINT NOT NULL)")
+    connection.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {MONTH_SUMMARY} "
+                               f"(visit_month INT PRIMARY KEY, number_of_visits BIGINT NOT NULL)")
+    connection.exec_driver_sql(TRIGGER_FUNCTION_SQL)
+    return created
+
+# Whether patient_visits carries all the summary triggers (a replace load recreates the table without them)
+def triggers_installed(connection):
+    installed = connection.execute(
+        text("SELECT tgname FROM pg_trigger WHERE tgrelid = to_regclass(:table) AND tgname = ANY(:names)"),
+        {"table": VISITS_TABLE, "names": list(TRIGGERS.values())}
+    ).scalars().all()
+    return set(installed) == set(TRIGGERS.values())
+
+# Attach the summary triggers to patient_visits
+def install_triggers(connection):
+    for event, name in TRIGGERS.items():
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name} ON {VISITS_TABLE}")
+        connection.exec_driver_sql(f"CREATE TRIGGER {name} AFTER {event} ON {VISITS_TABLE} {TRANSITION_TABLES[event]} "
+                                   f"FOR EACH STATEMENT EXECUTE FUNCTION {TRIGGER_FUNCTION}()")
+
+# Recompute both summaries from patient_visits and (re)attach the triggers, in one transaction.
+# patient_visits is locked against writes meanwhile, so no visit is counted twice or missed.
+def rebuild_visit_summaries(engine):
+    with engine.begin() as connection:
+        create_summary_tables(connection)
+        connection.exec_driver_sql(f"LOCK TABLE {VISITS_TABLE} IN SHARE MODE")
+        connection.exec_driver_sql(f"TRUNCATE {PATIENT_SUMMARY}, {MONTH_SUMMARY}")
+        connection.exec_driver_sql(f"INSERT INTO {PATIENT_SUMMARY} (patient_id, number_of_visits) {RECOUNT_PATIENTS_SQL}")
+        connection.exec_driver_sql(f"INSERT INTO {MONTH_SUMMARY} (visit_month, number_of_visits) {RECOUNT_MONTHS_SQL}")
+        install_triggers(connection)
+    logging.info(f"Rebuilt {PATIENT_SUMMARY} and {MONTH_SUMMARY} from {VISITS_TABLE}")
+
+# Bring the summaries in step with patient_visits after a load. While the triggers are attached every write has
+# already been applied incrementally and nothing is done; when they are missing (first run, or a replace load
+# recreated the table) the summaries are rebuilt from scratch. Returns whether a rebuild ran.
+def sync_visit_summaries(engine):
+    with engine.begin() as connection:
+        if not inspect(connection).has_table(VISITS_TABLE):
+            return False
+        created = create_summary_tables(connection)
+        if not created and triggers_installed(connection):
+            return False
+    rebuild_visit_summaries(engine)
+    return True
+
+# Recount the visits from scratch and compare them with the summaries.
+# Returns the groups whose counts differ: (summary, key, expected, actual), empty when the summaries are consistent.
+def check_visit_summaries(engine):
+    mismatches = []
+    with engine.connect() as connection:
+        for summary, key, recount_sql in [(PATIENT_SUMMARY, "patient_id", RECOUNT_PATIENTS_SQL), (MONTH_SUMMARY, "visit_month", RECOUNT_MONTHS_SQL)]:
+            expected = pd.read_sql(text(recount_sql), connection).set_index(key)["number_of_visits"]
+            actual = pd.read_sql(text(f"SELECT {key}, number_of_visits FROM {summary}"), connection).set_index(key)["number_of_visits"]
+            aligned = pd.concat([expected.rename("expected"), actual.rename("actual")], axis=1)
+            differing = aligned[aligned["expected"].ne(aligned["actual"])]
+            for group, row in differing.iterrows():
+                mismatches.append({"summary": summary, "key": group, "expected": row["expected"], "actual": row["actual"]})
+    mismatches = pd.DataFrame(mismatches, columns=["summary", "key", "expected", "actual"])
+    if mismatches.empty:
+        logging.info("Visit summaries are consistent with patient_visits")
+    else:
+        logging.error(f"Visit summaries differ from patient_visits in {len(mismatches)} groups")
+    return mismatches
+
+if __name__ == "__main__":
+    load_dotenv()
+    from engine_registry import get_engine
+
+    logging.basicConfig(
+        filename=os.path.join("logs", "visit_summaries.log"),
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Maintain and check the visit summary tables")
+    parser.add_argument("--check", action="store_true", help="Recount from patient_visits and report groups that differ from the summaries")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute the summaries from scratch")
+    args = parser.parse_args()
+
+    db_url = (f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('POSTGRES_HOST')}:"
+              f"{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}")
+    engine = get_engine("postgres", db_url)
+    if args.rebuild:
+        rebuild_visit_summaries(engine)
+        print("Visit summaries rebuilt.")
+    if args.check or not args.rebuild:
+        mismatches = check_visit_summaries(engine)
+        if mismatches.empty:
+            print("Visit summaries are consistent with patient_visits.")
+        else:
+            print(mismatches.to_string(index=False))
+            raise SystemExit(1)